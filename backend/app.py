@@ -1,37 +1,71 @@
 import os
 import json
-import smtplib
+import logging
 import secrets
-import requests
 import uuid
 import re
 import base64
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 from email.message import EmailMessage
 from typing import List, Optional
-from pathlib import Path
 
-from dotenv import load_dotenv
 from fastapi import FastAPI, Depends, HTTPException, Request, Body, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware 
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, EmailStr
-from sqlalchemy import create_engine, text
+from sqlalchemy import and_, func, or_
 from sqlalchemy.orm import sessionmaker, Session
-from werkzeug.security import generate_password_hash, check_password_hash
-from models import Base, User, EmailVerification, Chat, Message
+from models import User, EmailVerification, Chat, Message, MessageEmbedding
+from gemini import gemini_client, call_gemini_api, stream_gemini_api
+from response_cache import response_cache
+from scheduler import ModelBusy, model_scheduler
+from gemini_files import resolve_file_references
+from context import estimate_tokens, message_tokens, plan_fold, summarize_messages
+from prompt_cache import prompt_cache
+from search import search_chats
+from recall import embedding_row, recall_index, search_history
+from documents import attach_pdf_text, pdf_extractor, prepare_pdf
+from images import prepare_image, model_filename, variant_urls
+from blobs import inline_blobs, parse_attachments, read_blob, store_inline_attachment
+from uploads import UploadSizeLimitMiddleware, UploadTooLarge, save_upload, read_upload_base64
+from migrations import migrate
+from database import create_db_engine, pool_stats
+from passwords import password_hasher, hash_verification_code, check_verification_code
+from mailer import mailer, mail_configured
+from user_cache import SessionUser, user_cache, remember_user, cached_session_user
+from logs import configure_logging
+from metrics import SEND_PHASE_SECONDS, UPLOAD_BYTES, MetricsMiddleware, instrument_engine, register_collector, render
 
 import config
 
+configure_logging()
+logger = logging.getLogger(__name__)
+
 # DB setup
-engine = create_engine(config.DATABASE_URL, connect_args={"check_same_thread": False} if "sqlite" in config.DATABASE_URL else {})
+engine = create_db_engine()
+instrument_engine(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base.metadata.create_all(bind=engine)
+migrate(engine)
 
 # FastAPI setup
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    password_hasher.start()
+    pdf_extractor.start()
+    yield
+    await gemini_client.aclose()
+    password_hasher.shutdown()
+    pdf_extractor.shutdown()
+    await run_in_threadpool(mailer.close)
+
+app = FastAPI(lifespan=lifespan)
+# Added before CORS so CORS wraps it and its 413 still carries Access-Control-Allow-Origin
+app.add_middleware(UploadSizeLimitMiddleware, path="/api/upload-image", max_bytes=config.UPLOAD_MAX_MB * 1024 * 1024)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -42,6 +76,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 app.add_middleware(SessionMiddleware, secret_key=config.SECRET_KEY)
+if config.METRICS_ENABLED:
+    # Added last so it is outermost and times the whole request
+    app.add_middleware(MetricsMiddleware)
 
 frontend_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'frontend')
 # Serve all frontend assets (HTML, CSS, JS) directly from the frontend folder
@@ -56,6 +93,14 @@ def get_db():
     finally:
         db.close()
 
+def with_session(fn, *args):
+    """Run fn(*args, db) in its own short-lived session so the connection goes back to the pool right after."""
+    db = SessionLocal()
+    try:
+        return fn(*args, db)
+    finally:
+        db.close()
+
 
 def generate_chat_title_from_content(content: str, max_words: int = 6) -> str:
     if not content:
@@ -133,13 +178,15 @@ def generate_numeric_code(length=6):
     return ''.join(secrets.choice('0123456789') for _ in range(length))
 
 def send_verification_email(recipient_email, code):
+    """Queue the verification email; delivery happens on the mailer's background thread."""
     subject = "Your Verification Code"
     body = f"Your verification code is: {code}\n\nThis code expires in {config.VERIFICATION_CODE_EXPIRY_MINUTES} minutes."
 
-    if not config.MAIL_SERVER or not config.MAIL_USERNAME or not config.MAIL_PASSWORD or not config.MAIL_DEFAULT_SENDER:
+    if not mail_configured():
         error_msg = "Email settings not configured."
-        print(f"[Email] {error_msg}")
-        print(f"[Email] Verification code for {recipient_email}: {code}")
+        logger.warning(error_msg)
+        # Local development without SMTP: the code is only available from the log
+        logger.info("Verification code for %s: %s", recipient_email, code)
         return False, error_msg
 
     message = EmailMessage()
@@ -148,203 +195,32 @@ def send_verification_email(recipient_email, code):
     message['To'] = recipient_email
     message.set_content(body)
 
-    try:
-        if config.MAIL_USE_TLS:
-            with smtplib.SMTP(config.MAIL_SERVER, config.MAIL_PORT, timeout=10) as smtp:
-                smtp.starttls()
-                smtp.login(config.MAIL_USERNAME, config.MAIL_PASSWORD)
-                smtp.send_message(message)
-        elif config.MAIL_USE_SSL:
-            with smtplib.SMTP_SSL(config.MAIL_SERVER, config.MAIL_PORT, timeout=10) as smtp:
-                smtp.login(config.MAIL_USERNAME, config.MAIL_PASSWORD)
-                smtp.send_message(message)
-        else:
-            with smtplib.SMTP(config.MAIL_SERVER, config.MAIL_PORT, timeout=10) as smtp:
-                smtp.login(config.MAIL_USERNAME, config.MAIL_PASSWORD)
-                smtp.send_message(message)
-        print(f"[Email] Sent to {recipient_email}")
-        return True, None
-    except Exception as error:
-        print(f"[Email] Send failed: {error}")
-        print(f"[Email] Verification code for {recipient_email}: {code}")
-        return False, str(error)
-
-def call_gemini_api(api_key, messages, user_memory=None):
-    model = 'gemini-2.5-flash'
-    headers = {"Content-Type": "application/json"}
-    params = {"key": api_key}
-
-    contents = []
-    for msg in messages:
-        role = msg.get('role', 'user')
-        if role == 'assistant':
-            role = 'model'
-        content = msg.get('content', '')
-        image_data = msg.get('image_data')
-        parts = []
-        if content:
-            parts.append({"text": content})
-        if image_data:
-            if isinstance(image_data, list):
-                for file_item in image_data:
-                    file_type = file_item.get('type', 'image/jpeg')
-                    file_data = file_item.get('data', '')
-                    if file_type.startswith('image/') and file_data:
-                        parts.append({"inline_data": {"mime_type": file_type, "data": file_data}})
-                    elif file_type == 'application/pdf':
-                        file_name = file_item.get('name', 'document.pdf')
-                        parts.append({"text": f"\n[PDF File: {file_name} - Please analyze the content of this PDF document]"})
-            else:
-                if image_data:
-                    parts.append({"inline_data": {"mime_type": "image/jpeg", "data": image_data}})
-        if not parts:
-            parts.append({"text": "Please analyze this."})
-        contents.append({"role": role, "parts": parts})
-
-    # Build system instruction
-    system_text = "Format every answer in clean Markdown.\n\nUse headings, bullet points, and proper fenced code blocks for any code.\n\nNever use placeholder tokens like INLINECODE_0 or ARTIFACT_0.\n\nGive real code only, inside code fences.\n\nDo not add extra text like 'here is your answer' — just give the formatted Markdown output."
-    
-    # Add user memory/preferences if provided
-    if user_memory and user_memory.strip():
-        system_text = f"{system_text}\n\nUser Preferences and Context:\n{user_memory.strip()}\n\nRemember these preferences and context in all your responses."
-    
-    payload = {
-        "contents": contents,
-        "systemInstruction": {
-            "parts": [{
-                "text": system_text
-            }]
-        },
-        "generationConfig": {
-            "temperature": 0.7,
-            "maxOutputTokens": 2000
-        }
-    }
-
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"
-    try:
-        response = requests.post(url, json=payload, headers=headers, params=params, timeout=30)
-        response.raise_for_status()
+    mailer.send(message)
+    return True, None
 
-        # Parse JSON safely
-        try:
-            result = response.json()
-        except json.JSONDecodeError as json_err:
-            response_text = response.text[:1000]
-            return {"error": f"Invalid JSON response: {str(json_err)}. Preview: {response_text}"}
-
-        if not result:
-            return {"error": "Empty response received"}
-
-        # Flexible text extraction
-        text = None
-
-        if 'candidates' in result and isinstance(result['candidates'], list) and len(result['candidates']) > 0:
-            candidate = result['candidates'][0]
-            if 'finishReason' in candidate:
-                finish_reason = candidate.get('finishReason', '')
-                if finish_reason in ['SAFETY', 'RECITATION', 'OTHER']:
-                    safety_ratings = candidate.get('safetyRatings', [])
-                    safety_info = ', '.join([f"{r.get('category', 'Unknown')}: {r.get('probability', 'Unknown')}" for r in safety_ratings])
-                    return {"error": f"Content blocked by safety filters. Reason: {finish_reason}. Details: {safety_info}"}
-            if 'content' in candidate:
-                content = candidate['content']
-                if isinstance(content, dict) and 'parts' in content:
-                    parts = content['parts']
-                    if isinstance(parts, list):
-                        text_parts = []
-                        for part in parts:
-                            if isinstance(part, dict):
-                                if 'text' in part:
-                                    text_parts.append(str(part['text']))
-                                elif 'content' in part:
-                                    text_parts.append(str(part['content']))
-                        if text_parts:
-                            text = ''.join(text_parts)
-
-        if not text and 'text' in result:
-            text = str(result['text'])
-
-        if not text and 'content' in result:
-            content = result['content']
-            if isinstance(content, str):
-                text = content
-            elif isinstance(content, dict) and 'text' in content:
-                text = str(content['text'])
-
-        if not text and 'message' in result:
-            message = result['message']
-            if isinstance(message, dict) and 'content' in message:
-                text = str(message['content'])
-            elif isinstance(message, str):
-                text = message
-
-        if not text:
-            def extract_text_recursive(obj):
-                if isinstance(obj, str) and obj.strip():
-                    return obj
-                elif isinstance(obj, dict):
-                    for key in ['text', 'content', 'message', 'output', 'response']:
-                        if key in obj:
-                            found_text = extract_text_recursive(obj[key])
-                            if found_text:
-                                return found_text
-                    for value in obj.values():
-                        found_text = extract_text_recursive(value)
-                        if found_text:
-                            return found_text
-                elif isinstance(obj, list):
-                    for item in obj:
-                        found_text = extract_text_recursive(item)
-                        if found_text:
-                            return found_text
-                return None
-
-            text = extract_text_recursive(result)
-
-        if text and text.strip():
-            return {
-                "choices": [{
-                    "message": {
-                        "content": text.strip()
-                    }
-                }]
-            }
-
-        return {"error": "Unexpected response format"}
-    except requests.exceptions.HTTPError as e:
-        error_msg = f"Error {e.response.status_code}: "
-        try:
-            error_data = e.response.json()
-            if 'error' in error_data:
-                error_info = error_data['error']
-                if isinstance(error_info, dict):
-                    detailed_msg = error_info.get('message', error_info.get('status', ''))
-                    error_msg += detailed_msg
-                elif isinstance(error_info, str):
-                    error_msg += error_info
-            else:
-                error_msg += str(error_data)
-        except Exception:
-            try:
-                error_msg += e.response.text[:500]
-            except Exception:
-                error_msg += "Unknown error"
-        return {"error": error_msg}
-    except requests.exceptions.RequestException as e:
-        return {"error": f"Network error: {str(e)}"}
-    except Exception as e:
-        return {"error": f"Unexpected error processing response ({type(e).__name__}): {str(e)}"}
-
-def get_current_user(request: Request, db: Session = Depends(get_db)) -> User:
+def get_current_user(request: Request, db: Session = Depends(get_db)) -> SessionUser:
     user_id = request.session.get("user_id")
     if not user_id:
         raise HTTPException(status_code=401, detail="Not authenticated")
+    snapshot = cached_session_user(request.session, user_id)
+    if snapshot:
+        return snapshot
+    user = db.query(User).filter(User.id == user_id).first()
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return remember_user(request.session, user)
+
+def load_user(user_id: int, db: Session) -> User:
+    """The User row behind a session snapshot, for routes that change the account."""
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     return user
 
+def save_user(user: User, db: Session):
+    db.commit()
+    db.refresh(user)
+
 # Routes
 @app.get("/api/check-username")
 def check_username(username: str, db: Session = Depends(get_db)):
@@ -354,15 +230,7 @@ def check_username(username: str, db: Session = Depends(get_db)):
     exists = db.query(User).filter(User.username == username).first() is not None
     return {"available": not exists, "message": "Username already taken, choose another one" if exists else "Username available"}
 
-@app.post("/api/register")
-def register(payload: RegisterPayload, request: Request, db: Session = Depends(get_db)):
-    payload.username = payload.username.strip()
-    payload.email = payload.email.strip()
-    payload.password = payload.password.strip()
-    
-    if not payload.username or not payload.email or not payload.password or not payload.verification_token:
-        raise HTTPException(status_code=400, detail="Missing required fields")
-
+def check_registration(payload: RegisterPayload, db: Session) -> EmailVerification:
     if db.query(User).filter(User.username == payload.username).first():
         raise HTTPException(status_code=400, detail="Username already taken, choose another one")
     if db.query(User).filter(User.email == payload.email).first():
@@ -376,26 +244,43 @@ def register(payload: RegisterPayload, request: Request, db: Session = Depends(g
         db.delete(verification_record)
         db.commit()
         raise HTTPException(status_code=400, detail="Verification expired. Please request a new code.")
+    return verification_record
 
+def create_user(payload: RegisterPayload, password_hash: str, verification_record: EmailVerification, db: Session) -> User:
     user = User(
         username=payload.username,
         email=payload.email,
-        password_hash=generate_password_hash(payload.password)
+        password_hash=password_hash
     )
     db.add(user)
     db.commit()
 
     db.delete(verification_record)
     db.commit()
+    db.refresh(user)
+    return user
 
-    request.session['user_id'] = user.id
+@app.post("/api/register")
+async def register(payload: RegisterPayload, request: Request, db: Session = Depends(get_db)):
+    payload.username = payload.username.strip()
+    payload.email = payload.email.strip()
+    payload.password = payload.password.strip()
+    
+    if not payload.username or not payload.email or not payload.password or not payload.verification_token:
+        raise HTTPException(status_code=400, detail="Missing required fields")
+
+    verification_record = await run_in_threadpool(check_registration, payload, db)
+    password_hash = await password_hasher.hash(payload.password)
+    user = await run_in_threadpool(create_user, payload, password_hash, verification_record, db)
+
+    remember_user(request.session, user)
     return {"message": "User created successfully", "user_id": user.id}
 
 @app.post("/api/send-verification-code")
 def send_verification_code(payload: SendCodePayload, db: Session = Depends(get_db)):
     email = payload.email.strip()
     code = generate_numeric_code()
-    hashed_code = generate_password_hash(code)
+    hashed_code = hash_verification_code(email, code)
     expires_at = datetime.utcnow() + timedelta(minutes=config.VERIFICATION_CODE_EXPIRY_MINUTES)
 
     record = db.query(EmailVerification).filter(EmailVerification.email == email).first()
@@ -440,7 +325,7 @@ def verify_email_code(payload: VerificationPayload, db: Session = Depends(get_db
         db.commit()
         raise HTTPException(status_code=400, detail="Too many incorrect attempts. Please request a new code.")
 
-    if not check_password_hash(record.code_hash, payload.code):
+    if not check_verification_code(record.code_hash, payload.email, payload.code):
         record.attempts += 1
         db.commit()
         remaining = max(0, config.VERIFICATION_MAX_ATTEMPTS - record.attempts)
@@ -453,12 +338,7 @@ def verify_email_code(payload: VerificationPayload, db: Session = Depends(get_db
 
     return {"message": "Email verified successfully", "verification_token": record.verification_token}
 
-@app.post("/api/forgot-password-reset")
-def forgot_password_reset(payload: ForgotPasswordResetPayload, db: Session = Depends(get_db)):
-    payload.email = payload.email.strip()
-    payload.code = payload.code.strip()
-    payload.new_password = payload.new_password.strip()
-
+def check_password_reset_code(payload: ForgotPasswordResetPayload, db: Session):
     record = db.query(EmailVerification).filter(EmailVerification.email == payload.email).first()
     if not record:
         raise HTTPException(status_code=400, detail="No verification request found")
@@ -468,8 +348,17 @@ def forgot_password_reset(payload: ForgotPasswordResetPayload, db: Session = Dep
         db.commit()
         raise HTTPException(status_code=400, detail="Verification code expired")
 
-    if not check_password_hash(record.code_hash, payload.code):
-        raise HTTPException(status_code=400, detail="Invalid verification code")
+    # Codes are a fast HMAC, so the attempt count is what stops guessing
+    if record.attempts >= config.VERIFICATION_MAX_ATTEMPTS:
+        db.delete(record)
+        db.commit()
+        raise HTTPException(status_code=400, detail="Too many incorrect attempts. Please request a new code.")
+
+    if not check_verification_code(record.code_hash, payload.email, payload.code):
+        record.attempts += 1
+        db.commit()
+        remaining = max(0, config.VERIFICATION_MAX_ATTEMPTS - record.attempts)
+        raise HTTPException(status_code=400, detail=f"Invalid verification code. {remaining} attempts remaining.")
 
     user = db.query(User).filter(User.email == payload.email).first()
     if not user:
@@ -477,22 +366,38 @@ def forgot_password_reset(payload: ForgotPasswordResetPayload, db: Session = Dep
 
     if len(payload.new_password) < 6:
         raise HTTPException(status_code=400, detail="Password must be at least 6 characters")
+    return record, user
 
-    user.password_hash = generate_password_hash(payload.new_password)
+def store_password_reset(record: EmailVerification, user: User, password_hash: str, db: Session):
+    user.password_hash = password_hash
     db.delete(record)
     db.commit()
 
+@app.post("/api/forgot-password-reset")
+async def forgot_password_reset(payload: ForgotPasswordResetPayload, db: Session = Depends(get_db)):
+    payload.email = payload.email.strip()
+    payload.code = payload.code.strip()
+    payload.new_password = payload.new_password.strip()
+
+    record, user = await run_in_threadpool(check_password_reset_code, payload, db)
+    password_hash = await password_hasher.hash(payload.new_password)
+    await run_in_threadpool(store_password_reset, record, user, password_hash, db)
+    user_cache.invalidate(user.id)
+
     return {"message": "Password reset successfully"}
 
+def find_user_by_username(username: str, db: Session):
+    return db.query(User).filter(User.username == username).first()
+
 @app.post("/api/login")
-def login(payload: LoginPayload, request: Request, db: Session = Depends(get_db)):
+async def login(payload: LoginPayload, request: Request, db: Session = Depends(get_db)):
     payload.username = payload.username.strip()
     payload.password = payload.password.strip()
     
-    user = db.query(User).filter(User.username == payload.username).first()
-    if not user or not check_password_hash(user.password_hash, payload.password):
+    user = await run_in_threadpool(find_user_by_username, payload.username, db)
+    if not user or not await password_hasher.verify(user.password_hash, payload.password):
         raise HTTPException(status_code=401, detail="Invalid username or password")
-    request.session['user_id'] = user.id
+    remember_user(request.session, user)
     return {"message": "Login successful", "user_id": user.id}
 
 @app.post("/api/logout")
@@ -501,26 +406,29 @@ def logout(request: Request):
     return {"message": "Logout successful"}
 
 @app.post("/api/reset-password")
-def reset_password(payload: ResetPasswordPayload, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def reset_password(payload: ResetPasswordPayload, request: Request, session_user: SessionUser = Depends(get_current_user), db: Session = Depends(get_db)):
+    user = await run_in_threadpool(load_user, session_user.id, db)
     payload.current_password = payload.current_password.strip()
     payload.new_password = payload.new_password.strip()
 
     if not payload.current_password or not payload.new_password:
         raise HTTPException(status_code=400, detail="Current password and new password are required")
 
-    if not check_password_hash(user.password_hash, payload.current_password):
+    if not await password_hasher.verify(user.password_hash, payload.current_password):
         raise HTTPException(status_code=400, detail="Current password is incorrect")
 
     if len(payload.new_password) < 6:
         raise HTTPException(status_code=400, detail="Password must be at least 6 characters")
 
-    user.password_hash = generate_password_hash(payload.new_password)
-    db.commit()
+    user.password_hash = await password_hasher.hash(payload.new_password)
+    await run_in_threadpool(save_user, user, db)
+    user_cache.invalidate(user.id)
+    remember_user(request.session, user)
 
     return {"message": "Password reset successfully"}
 
 @app.get("/api/check-auth")
-def check_auth(user: User = Depends(get_current_user)):
+def check_auth(user: SessionUser = Depends(get_current_user)):
     return {
         "authenticated": True,
         "user_id": user.id,
@@ -530,22 +438,25 @@ def check_auth(user: User = Depends(get_current_user)):
     }
 
 @app.get("/api/user-memory")
-def get_user_memory(user: User = Depends(get_current_user)):
+def get_user_memory(user: SessionUser = Depends(get_current_user)):
     return {
         "user_memory": user.user_memory or ""
     }
 
 @app.put("/api/user-memory")
-def update_user_memory(payload: UserMemoryPayload, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def update_user_memory(payload: UserMemoryPayload, request: Request, session_user: SessionUser = Depends(get_current_user), db: Session = Depends(get_db)):
+    user = load_user(session_user.id, db)
     user.user_memory = payload.memory.strip() if payload.memory else None
     db.commit()
+    user_cache.invalidate(user.id)
+    remember_user(request.session, user)
     return {
         "message": "Memory updated successfully",
         "user_memory": user.user_memory or ""
     }
 
 @app.post("/api/chats")
-def create_chat(user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def create_chat(user: SessionUser = Depends(get_current_user), db: Session = Depends(get_db)):
     chat = Chat(user_id=user.id, title="New Chat")
     db.add(chat)
     db.commit()
@@ -558,8 +469,51 @@ def create_chat(user: User = Depends(get_current_user), db: Session = Depends(ge
         "archived": chat.archived
     }
 
+def encode_chat_cursor(chat: Chat) -> str:
+    raw = f"{chat.updated_at.isoformat()}|{chat.id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_chat_cursor(cursor: str):
+    try:
+        updated_at, chat_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').rsplit('|', 1)
+        return datetime.fromisoformat(updated_at), int(chat_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def count_messages(chat_ids, db: Session):
+    """Message counts for a page of chats in one grouped query, without loading any rows."""
+    if not chat_ids:
+        return {}
+    rows = db.query(Message.chat_id, func.count(Message.id)).filter(Message.chat_id.in_(chat_ids)).group_by(Message.chat_id).all()
+    return dict(rows)
+
+def serialize_chat_summary(chat: Chat, message_count: int):
+    return {
+        "id": chat.id,
+        "title": chat.title,
+        "created_at": chat.created_at.isoformat(),
+        "updated_at": chat.updated_at.isoformat(),
+        "archived": chat.archived,
+        "message_count": message_count
+    }
+
 @app.get("/api/chats")
-def get_chats(archived: bool = False, search: str = "", user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def get_chats(archived: bool = False, search: str = "", limit: int = config.CHATS_PAGE_SIZE, cursor: Optional[str] = None, user: SessionUser = Depends(get_current_user), db: Session = Depends(get_db)):
+    limit = max(1, min(limit, config.CHATS_PAGE_SIZE_MAX))
+
+    if search:
+        # Ranked full-text search, with a snippet of the best matching message
+        hits = search_chats(db, user.id, archived, search, limit=limit)
+        if hits is not None:
+            hit_ids = [chat_id for chat_id, _ in hits]
+            chats_by_id = {chat.id: chat for chat in db.query(Chat).filter(Chat.id.in_(hit_ids)).all()}
+            counts = count_messages(hit_ids, db)
+            return {
+                "chats": [dict(serialize_chat_summary(chats_by_id[chat_id], counts.get(chat_id, 0)), snippet=snippet)
+                          for chat_id, snippet in hits if chat_id in chats_by_id],
+                "next_cursor": None
+            }
+
     query = db.query(Chat).filter(Chat.user_id == user.id, Chat.archived == archived)
     if search:
         search_term = f"%{search}%"
@@ -568,58 +522,132 @@ def get_chats(archived: bool = False, search: str = "", user: User = Depends(get
             (Chat.title.ilike(search_term)) |
             (Chat.messages.any(Message.content.ilike(search_term)))
         )
-    chats = query.order_by(Chat.updated_at.desc()).all()
-    return [{
-        "id": chat.id,
-        "title": chat.title,
-        "created_at": chat.created_at.isoformat(),
-        "updated_at": chat.updated_at.isoformat(),
-        "archived": chat.archived,
-        "message_count": len(chat.messages)
-    } for chat in chats]
+    if cursor:
+        # Keyset pagination: continue strictly after the last (updated_at, id) already sent
+        cursor_updated_at, cursor_id = decode_chat_cursor(cursor)
+        query = query.filter(or_(
+            Chat.updated_at < cursor_updated_at,
+            and_(Chat.updated_at == cursor_updated_at, Chat.id < cursor_id)
+        ))
+    chats = query.order_by(Chat.updated_at.desc(), Chat.id.desc()).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(chats) > limit:
+        chats = chats[:limit]
+        next_cursor = encode_chat_cursor(chats[-1])
+
+    counts = count_messages([chat.id for chat in chats], db)
+    return {
+        "chats": [serialize_chat_summary(chat, counts.get(chat.id, 0)) for chat in chats],
+        "next_cursor": next_cursor
+    }
+
+def stored_attachments(msg: Message):
+    """Parse a message's image_data column into a list of attachment dicts."""
+    return parse_attachments(msg.image_data)
+
+def attachment_refs(msg: Message):
+    """Attachment references for the client: URLs only, never the file bytes."""
+    refs = []
+    for index, item in enumerate(stored_attachments(msg)):
+        ref = {"type": item.get('type') or 'image/jpeg', "name": item.get('name')}
+        if item.get('filename') or item.get('url'):
+            ref["filename"] = item.get('filename')
+            ref["url"] = item.get('url') or f"/uploads/{item['filename']}"
+            if ref["type"].startswith('image/') and ref["filename"]:
+                ref.update(variant_urls(ref["filename"]))
+        else:
+            ref["url"] = f"/api/messages/{msg.id}/attachments/{index}"
+        refs.append(ref)
+    return refs or None
+
+def serialize_message(msg: Message):
+    return {
+        "id": msg.id,
+        "role": msg.role,
+        "content": msg.content,
+        "image_data": attachment_refs(msg),
+        "created_at": msg.created_at.isoformat()
+    }
+
+def get_message_page(chat_id: int, before: Optional[int], limit: int, db: Session):
+    """Newest `limit` messages older than `before`, oldest first, plus the cursor for the next page."""
+    limit = max(1, min(limit, config.MESSAGES_PAGE_SIZE_MAX))
+    query = db.query(Message).filter(Message.chat_id == chat_id)
+    if before:
+        query = query.filter(Message.id < before)
+    rows = query.order_by(Message.id.desc()).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].id
+    return [serialize_message(msg) for msg in reversed(rows)], next_cursor
 
 @app.get("/api/chats/{chat_id}")
-def get_chat(chat_id: int, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def get_chat(chat_id: int, limit: int = config.MESSAGES_PAGE_SIZE, user: SessionUser = Depends(get_current_user), db: Session = Depends(get_db)):
     chat = db.query(Chat).filter(Chat.id == chat_id, Chat.user_id == user.id).first()
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
-    messages = []
-    for msg in chat.messages:
-        parsed_image_data = None
-        if msg.image_data:
-            try:
-                parsed = json.loads(msg.image_data)
-                parsed_image_data = parsed
-            except Exception:
-                parsed_image_data = [{"data": msg.image_data, "type": "image/jpeg"}]
-
-        messages.append({
-            "id": msg.id,
-            "role": msg.role,
-            "content": msg.content,
-            "image_data": parsed_image_data,
-            "created_at": msg.created_at.isoformat()
-        })
+    # Only the newest page is sent; older messages come from /api/chats/{chat_id}/messages
+    messages, next_cursor = get_message_page(chat.id, None, limit, db)
     return {
         "id": chat.id,
         "title": chat.title,
         "created_at": chat.created_at.isoformat(),
         "updated_at": chat.updated_at.isoformat(),
         "archived": chat.archived,
-        "messages": messages
+        "messages": messages,
+        "next_cursor": next_cursor
     }
 
+@app.get("/api/chats/{chat_id}/messages")
+def get_chat_messages(chat_id: int, before: Optional[int] = None, limit: int = config.MESSAGES_PAGE_SIZE, user: SessionUser = Depends(get_current_user), db: Session = Depends(get_db)):
+    chat = db.query(Chat).filter(Chat.id == chat_id, Chat.user_id == user.id).first()
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    messages, next_cursor = get_message_page(chat.id, before, limit, db)
+    return {"messages": messages, "next_cursor": next_cursor}
+
+@app.get("/api/messages/{message_id}/attachments/{index}")
+def get_message_attachment(message_id: int, index: int, user: SessionUser = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Serve an attachment that was sent inline (pasted) rather than uploaded as a file."""
+    msg = db.query(Message).join(Chat).filter(Message.id == message_id, Chat.user_id == user.id).first()
+    if not msg:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    attachments = stored_attachments(msg)
+    if index < 0 or index >= len(attachments):
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    item = attachments[index]
+    if item.get('blob'):
+        content = read_blob(item['blob'])
+    else:
+        try:
+            # Rows written before the blob store still hold base64
+            content = base64.b64decode(item['data']) if item.get('data') else None
+        except Exception:
+            content = None
+    if not content:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    # Stored messages never change, so the browser can keep this for a long time
+    return Response(content=content, media_type=item.get('type') or 'image/jpeg',
+                    headers={"Cache-Control": "private, max-age=86400, immutable"})
+
 @app.delete("/api/chats/{chat_id}")
-def delete_chat(chat_id: int, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def delete_chat(chat_id: int, user: SessionUser = Depends(get_current_user), db: Session = Depends(get_db)):
     chat = db.query(Chat).filter(Chat.id == chat_id, Chat.user_id == user.id).first()
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
+    message_ids = db.query(Message.id).filter(Message.chat_id == chat_id).scalar_subquery()
+    db.query(MessageEmbedding).filter(MessageEmbedding.message_id.in_(message_ids)).delete(synchronize_session=False)
     db.delete(chat)
     db.commit()
+    prompt_cache.invalidate(chat_id)
+    recall_index.forget(user.id)
     return {"message": "Chat deleted successfully"}
 
 @app.post("/api/chats/{chat_id}/archive")
-def archive_chat(chat_id: int, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def archive_chat(chat_id: int, user: SessionUser = Depends(get_current_user), db: Session = Depends(get_db)):
     chat = db.query(Chat).filter(Chat.id == chat_id, Chat.user_id == user.id).first()
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
@@ -628,7 +656,7 @@ def archive_chat(chat_id: int, user: User = Depends(get_current_user), db: Sessi
     return {"message": "Chat archived successfully"}
 
 @app.put("/api/chats/{chat_id}/title")
-def update_chat_title(chat_id: int, title: str = Body(..., embed=True), user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def update_chat_title(chat_id: int, title: str = Body(..., embed=True), user: SessionUser = Depends(get_current_user), db: Session = Depends(get_db)):
     chat = db.query(Chat).filter(Chat.id == chat_id, Chat.user_id == user.id).first()
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
@@ -637,178 +665,253 @@ def update_chat_title(chat_id: int, title: str = Body(..., embed=True), user: Us
     return {"message": "Title updated successfully"}
 
 @app.post("/api/upload-image")
-async def upload_image(file: UploadFile = File(...), user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def upload_image(file: UploadFile = File(...), include_base64: bool = False, user: SessionUser = Depends(get_current_user)):
     # Validate file type
     if not file.content_type or not (file.content_type.startswith('image/') or file.content_type == 'application/pdf'):
         raise HTTPException(status_code=400, detail="Only images and PDF files are allowed")
-    
-    # Generate unique filename
-    file_ext = Path(file.filename).suffix if file.filename else '.jpg'
-    unique_filename = f"{uuid.uuid4()}{file_ext}"
-    file_path = config.UPLOAD_FOLDER_PATH / unique_filename
+
+    max_bytes = config.UPLOAD_MAX_MB * 1024 * 1024
     
     # Save file
     try:
-        # Ensure we're at the start of the file
+        # Files are stored by content hash, so identical uploads share one copy. The copy runs in
+        # the threadpool, a chunk at a time, and stops as soon as the size limit is passed
         await file.seek(0)
-        content = await file.read()
-        
-        file_size = len(content)
-        print(f"[Debug] Uploading file: {unique_filename}, Size: {file_size} bytes, Type: {file.content_type}")
-        
-        if file_size == 0:
+        unique_filename, file_size = await run_in_threadpool(save_upload, file.file, file.content_type, file.filename, max_bytes)
+
+        if not unique_filename:
             raise HTTPException(status_code=400, detail="Empty file uploaded")
 
-        with open(file_path, "wb") as buffer:
-            buffer.write(content)
-        
-        # For images, also read as base64 for Gemini API
-        image_base64 = None
-        if file.content_type.startswith('image/'):
-            image_base64 = base64.b64encode(content).decode('utf-8')
-        
-        return {
+        logger.debug("Uploaded file %s (%d bytes, %s)", unique_filename, file_size, file.content_type)
+        UPLOAD_BYTES.observe(file_size, type='pdf' if file.content_type == 'application/pdf' else 'image')
+
+        result = {
             "filename": unique_filename,
             "url": f"/uploads/{unique_filename}",
             "type": file.content_type,
-            "base64": image_base64,
             "name": file.filename
         }
+        if file.content_type.startswith('image/'):
+            result.update(await prepare_image(unique_filename))
+        elif file.content_type == 'application/pdf':
+            result.update(await prepare_pdf(unique_filename))
+        # The client already has the bytes; only echo them back when asked
+        if include_base64 and file.content_type.startswith('image/'):
+            result["base64"] = await run_in_threadpool(read_upload_base64, unique_filename)
+        return result
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except HTTPException:
         raise
     except Exception as e:
-        print(f"[Error] Upload failed: {str(e)}")
+        logger.exception("Upload failed")
         raise HTTPException(status_code=500, detail=f"Failed to save file: {str(e)}")
 
-@app.post("/api/chats/{chat_id}/messages")
-def send_message(chat_id: int, payload: MessagePayload, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    chat = db.query(Chat).filter(Chat.id == chat_id, Chat.user_id == user.id).first()
+def model_error_status(response):
+    """HTTP status and headers for a failed model call, from the error class the model client reported."""
+    error_class = response.get('error_class') or ''
+    if error_class == 'circuit_open':
+        return 503, {"Retry-After": str(response.get('retry_after', 30))}
+    if error_class in ('timeout', 'http_408'):
+        return 504, None
+    if error_class == 'http_429':
+        # The provider is still rate limiting after our retries
+        return 503, None
+    if error_class.startswith('http_5') or error_class in ('network', 'invalid_json'):
+        return 502, None
+    # Other 4xx mean a bad key or a request we built wrong, which is our error, not the gateway's
+    return 500, None
+
+def format_model_error(error_msg):
+    if any(term in error_msg.lower() for term in ['invalid', 'unauthorized', 'authentication', 'key']):
+        return f"Invalid key: {error_msg}. Please check your GEMINI_API_KEY in .env file. Get your key from https://aistudio.google.com/"
+    if any(term in error_msg.lower() for term in ['quota', 'rate limit']):
+        return f"Quota/rate limit: {error_msg}. Please try again later or check your quota at https://aistudio.google.com/"
+    return error_msg
+
+def file_item_for_api(item: dict):
+    """Model-side reference for a stored upload; its URI or bytes are attached just before the call."""
+    return {
+        "filename": item.get('filename', item.get('url', '').split('/')[-1]),
+        "type": item.get('type') or 'image/jpeg',
+        "name": item.get('name'),
+        "file_uri": item.get('file_uri'),
+        "file_expires_at": item.get('file_expires_at')
+    }
+
+def inline_file_data(messages_for_model):
+    """Attach base64 bytes to stored-upload references when the file API is disabled."""
+    inlined = []
+    for msg in messages_for_model:
+        image_data = msg.get('image_data')
+        if isinstance(image_data, list) and any(isinstance(i, dict) and i.get('filename') for i in image_data):
+            api_images = []
+            for item in image_data:
+                if isinstance(item, dict) and item.get('filename') and not item.get('data'):
+                    base64_data = read_upload_base64(model_filename(item['filename']))
+                    if not base64_data:
+                        logger.error("File not found or empty: %s", item['filename'])
+                        continue
+                    item = {"data": base64_data, "type": item['type'], "name": item.get('name')}
+                api_images.append(item)
+            # Copy rather than mutate: the original dicts are shared with the prompt cache
+            msg = dict(msg, image_data=api_images)
+        inlined.append(msg)
+    return inlined
+
+def store_file_references(updates, db: Session):
+    """Save refreshed file-API URIs back onto the stored image_data entries."""
+    for message in db.query(Message).filter(Message.id.in_(list(updates.keys()))).all():
+        try:
+            entries = json.loads(message.image_data)
+        except Exception:
+            continue
+        if not isinstance(entries, list):
+            continue
+        references = updates[message.id]
+        for entry in entries:
+            if isinstance(entry, dict) and entry.get('filename') in references:
+                entry.update(references[entry['filename']])
+        message.image_data = json.dumps(entries)
+    db.commit()
+
+def message_entry(msg: Message) -> dict:
+    """Model-side dict for a stored message: text, token estimate and attachment references."""
+    msg_dict = {'id': msg.id, 'role': msg.role, 'content': msg.content, 'tokens': message_tokens(msg)}
+    if msg.image_data:
+        try:
+            parsed = json.loads(msg.image_data)
+            # Convert stored file paths back to model-side entries
+            if isinstance(parsed, list):
+                api_images = []
+                for img in parsed:
+                    if isinstance(img, dict) and ('filename' in img or 'url' in img):
+                        api_images.append(file_item_for_api(img))
+                    elif isinstance(img, dict) and ('blob' in img or 'data' in img):
+                        api_images.append(img)
+                if api_images:
+                    msg_dict['image_data'] = api_images
+            else:
+                msg_dict['image_data'] = parsed
+        except Exception:
+            pass
+    return msg_dict
+
+def get_user_chat(chat_id: int, user_id: int, db: Session) -> Chat:
+    chat = db.query(Chat).filter(Chat.id == chat_id, Chat.user_id == user_id).first()
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
+    return chat
 
-    if not config.GEMINI_API_KEY or config.GEMINI_API_KEY.strip() == '':
-        raise HTTPException(status_code=400, detail="Key not configured. Please set GEMINI_API_KEY in .env file.")
-
+def prepare_user_turn(chat_id: int, user_id: int, payload: MessagePayload, db: Session):
+    """Persist the user's message and build the message list to send to the model."""
+    chat = get_user_chat(chat_id, user_id, db)
     content = (payload.content or "").strip()
     image_data = payload.image_data
 
     if not content and not image_data:
         raise HTTPException(status_code=400, detail="Message content or files are required")
 
-    # Determine if this is the first message before we add a new one
-    is_first_message = db.query(Message).filter(Message.chat_id == chat_id).count() == 0
+    summary = chat.summary
+    summary_message_id = chat.summary_message_id
+    last_message_id = db.query(func.max(Message.id)).filter(Message.chat_id == chat_id).scalar()
 
-    # Process image data - convert file paths to base64 for Gemini API
-    image_data_for_storage = None
-    image_data_for_api = None
-    
+    # Determine if this is the first message before we add a new one
+    is_first_message = last_message_id is None
+
+    # Reuse the assembled history when nothing was written to the chat since it was cached
+    messages_for_model = prompt_cache.get(chat_id, last_message_id)
+    if messages_for_model is None:
+        # Turns already folded into the chat summary are not loaded again
+        previous_query = db.query(Message).filter(Message.chat_id == chat_id)
+        if summary_message_id:
+            previous_query = previous_query.filter(Message.id > summary_message_id)
+        messages_for_model = [message_entry(msg) for msg in previous_query.order_by(Message.created_at).all()]
+
+    # Keep only references for saved files; their bytes are attached just before the call
+    image_data_json = None
     if image_data:
-        if isinstance(image_data, list):
-            image_data_for_storage = []
-            image_data_for_api = []
-            for item in image_data:
-                if isinstance(item, dict):
-                    # If it has a filename/url, it's a saved file
-                    if 'filename' in item or 'url' in item:
-                        filename = item.get('filename', item.get('url', '').split('/')[-1])
-                        file_path = config.UPLOAD_FOLDER_PATH / filename
-                        print(f"[Debug] Processing file for chat: {file_path}")
-                        if file_path.exists():
-                            with open(file_path, 'rb') as f:
-                                file_content = f.read()
-                                print(f"[Debug] Read {len(file_content)} bytes from {filename}")
-                                if len(file_content) > 0:
-                                    base64_data = base64.b64encode(file_content).decode('utf-8')
-                                    image_data_for_api.append({
-                                        "data": base64_data,
-                                        "type": item.get('type', 'image/jpeg')
-                                    })
-                                else:
-                                    print(f"[Warning] Empty file: {filename}")
-                        else:
-                            print(f"[Error] File not found: {file_path}")
-                        image_data_for_storage.append({
-                            "filename": item.get('filename'),
-                            "url": item.get('url'),
-                            "type": item.get('type'),
-                            "name": item.get('name')
-                        })
-                    elif 'data' in item:
-                        # Base64 data (for backward compatibility or pasted images)
-                        image_data_for_api.append(item)
-                        image_data_for_storage.append(item)
-        else:
-            image_data_for_storage = image_data
-            image_data_for_api = image_data
-        
+        image_data_for_storage = []
+        for item in image_data:
+            if isinstance(item, dict):
+                # If it has a filename/url, it's a saved file
+                if 'filename' in item or 'url' in item:
+                    image_data_for_storage.append({
+                        "filename": item.get('filename'),
+                        "url": item.get('url'),
+                        "type": item.get('type'),
+                        "name": item.get('name')
+                    })
+                elif 'data' in item:
+                    # Pasted files arrive as base64; only a reference to the stored bytes is kept on the row
+                    image_data_for_storage.append(store_inline_attachment(item))
         image_data_json = json.dumps(image_data_for_storage)
-    else:
-        image_data_json = None
 
     user_message = Message(
         chat_id=chat_id,
         role='user',
         content=content or 'Files uploaded',
-        image_data=image_data_json
+        image_data=image_data_json,
+        token_count=estimate_tokens(content or 'Files uploaded', image_data_json)
     )
     db.add(user_message)
+    db.flush()
+    embedding = embedding_row(user_message, user_id)
+    if embedding is not None:
+        db.add(embedding)
+    # Also persists token counts computed for rows that did not have one yet
     db.commit()
 
-    previous_messages = db.query(Message).filter(Message.chat_id == chat_id).order_by(Message.created_at).all()
-    messages_for_model = []
-    for msg in previous_messages:
-        msg_dict = {'role': msg.role, 'content': msg.content}
-        if msg.image_data:
-            try:
-                parsed = json.loads(msg.image_data)
-                # Convert stored file paths back to base64 for API
-                if isinstance(parsed, list):
-                    api_images = []
-                    for img in parsed:
-                        if isinstance(img, dict) and ('filename' in img or 'url' in img):
-                            file_path = config.UPLOAD_FOLDER_PATH / img.get('filename', img.get('url', '').split('/')[-1])
-                            if file_path.exists():
-                                with open(file_path, 'rb') as f:
-                                    file_content = f.read()
-                                    base64_data = base64.b64encode(file_content).decode('utf-8')
-                                    api_images.append({
-                                        "data": base64_data,
-                                        "type": img.get('type', 'image/jpeg')
-                                    })
-                        elif isinstance(img, dict) and 'data' in img:
-                            api_images.append(img)
-                    if api_images:
-                        msg_dict['image_data'] = api_images
-                else:
-                    msg_dict['image_data'] = parsed
-            except Exception:
-                pass
-        messages_for_model.append(msg_dict)
-
-    current_msg = {'role': 'user', 'content': content or 'What do you see in these files?'}
-    if image_data_for_api:
-        current_msg['image_data'] = image_data_for_api
+    current_msg = message_entry(user_message)
+    if not content:
+        current_msg['content'] = 'What do you see in these files?'
     messages_for_model.append(current_msg)
+    prompt_cache.put(chat_id, user_message.id, messages_for_model)
 
-    # Include user memory in API call
-    response = call_gemini_api(config.GEMINI_API_KEY, messages_for_model, user_memory=user.user_memory)
+    return user_message.id, messages_for_model, is_first_message, summary
 
-    if 'error' in response:
-        error_msg = response['error']
-        if any(term in error_msg.lower() for term in ['invalid', 'unauthorized', 'authentication', 'key']):
-            error_msg = f"Invalid key: {error_msg}. Please check your GEMINI_API_KEY in .env file. Get your key from https://aistudio.google.com/"
-        elif any(term in error_msg.lower() for term in ['quota', 'rate limit']):
-            error_msg = f"Quota/rate limit: {error_msg}. Please try again later or check your quota at https://aistudio.google.com/"
-        raise HTTPException(status_code=500, detail=error_msg)
+def store_chat_summary(chat_id: int, summary: str, summary_message_id: int, db: Session):
+    chat = db.query(Chat).filter(Chat.id == chat_id).first()
+    chat.summary = summary
+    chat.summary_message_id = summary_message_id
+    db.commit()
 
-    assistant_content = response.get('choices', [{}])[0].get('message', {}).get('content', 'No response')
+async def fit_context_window(chat_id: int, messages_for_model, summary):
+    """Fold the oldest turns into the chat summary when the window exceeds its token budget."""
+    fold_count = plan_fold(messages_for_model)
+    if not fold_count:
+        return messages_for_model, summary
+
+    folded = messages_for_model[:fold_count]
+    new_summary = await summarize_messages(config.GEMINI_API_KEY, summary, folded)
+    if not new_summary:
+        # Keep the old summary and send as many verbatim turns as the full budget allows;
+        # only the turns that cannot fit at all are left out of this prompt
+        keep_from = plan_fold(messages_for_model, target=config.CONTEXT_TOKEN_BUDGET)
+        logger.warning("Summary update failed for chat %s; leaving %d of %d older turns out of this prompt",
+                       chat_id, keep_from, fold_count)
+        return messages_for_model[keep_from:], summary
+
+    summary = new_summary
+    await run_in_threadpool(with_session, store_chat_summary, chat_id, summary, folded[-1]['id'])
+    prompt_cache.drop_through(chat_id, folded[-1]['id'])
+    return messages_for_model[fold_count:], summary
+
+def save_assistant_reply(chat: Chat, user_message_id: int, assistant_content: str, is_first_message: bool, payload: MessagePayload, db: Session) -> Message:
+    content = (payload.content or "").strip()
+    image_data = payload.image_data
 
     assistant_message = Message(
-        chat_id=chat_id,
+        chat_id=chat.id,
         role='assistant',
-        content=assistant_content
+        content=assistant_content,
+        token_count=estimate_tokens(assistant_content)
     )
     db.add(assistant_message)
+    db.flush()
+    embedding = embedding_row(assistant_message, chat.user_id)
+    if embedding is not None:
+        db.add(embedding)
 
     if is_first_message:
         if content:
@@ -824,30 +927,185 @@ def send_message(chat_id: int, payload: MessagePayload, user: User = Depends(get
 
     chat.updated_at = datetime.utcnow()
     db.commit()
+    prompt_cache.append(chat.id, user_message_id, message_entry(assistant_message))
+    return assistant_message
 
-    user_msg_response = {
-        'id': user_message.id,
-        'role': user_message.role,
-        'content': user_message.content,
-        'created_at': user_message.created_at.isoformat()
-    }
-    if user_message.image_data:
-        try:
-            parsed = json.loads(user_message.image_data)
-            user_msg_response['image_data'] = parsed if isinstance(parsed, list) else parsed
-        except Exception:
-            user_msg_response['image_data'] = user_message.image_data
+def recall_snippets(user_id: int, chat_id: int, question: str, db: Session):
+    """Past messages from the user's other chats that look related to question, for the prompt."""
+    if not question or config.RECALL_PROMPT_SNIPPETS <= 0:
+        return []
+    return search_history(db, user_id, question, config.RECALL_PROMPT_SNIPPETS,
+                          exclude_chat_id=chat_id, min_score=config.RECALL_MIN_SCORE)
+
+def format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
+def save_reply(chat_id: int, user_message_id: int, assistant_content: str, is_first_message: bool, payload: MessagePayload, db: Session):
+    chat = db.query(Chat).filter(Chat.id == chat_id).first()
+    if not chat:
+        return None
+    assistant_message = save_assistant_reply(chat, user_message_id, assistant_content, is_first_message, payload, db)
+    user_message = db.query(Message).filter(Message.id == user_message_id).first()
     return {
-        'user_message': user_msg_response,
-        'assistant_message': {
-            'id': assistant_message.id,
-            'role': assistant_message.role,
-            'content': assistant_message.content,
-            'created_at': assistant_message.created_at.isoformat()
-        }
+        'user_message': serialize_message(user_message),
+        'assistant_message': serialize_message(assistant_message),
+        'title': chat.title
     }
 
+async def stream_assistant_reply(slot, chat_id: int, user_message_id: int, messages_for_model, user_memory, summary, recalled, is_first_message: bool, payload: MessagePayload):
+    """Relay model chunks as Server-Sent Events, then save the finished reply once."""
+    async with slot:
+        text_parts = []
+        async for chunk in stream_gemini_api(config.GEMINI_API_KEY, messages_for_model, user_memory=user_memory, summary=summary, recalled=recalled):
+            if 'error' in chunk:
+                yield format_sse('error', {'error': format_model_error(chunk['error'])})
+                return
+            text_parts.append(chunk['text'])
+            yield format_sse('chunk', {'text': chunk['text']})
+
+        assistant_content = ''.join(text_parts).strip()
+        if not assistant_content:
+            yield format_sse('error', {'error': 'Unexpected response format'})
+            return
+
+        with SEND_PHASE_SECONDS.time(phase='save'):
+            result = await run_in_threadpool(with_session, save_reply, chat_id, user_message_id, assistant_content, is_first_message, payload)
+        if not result:
+            yield format_sse('error', {'error': 'Chat not found'})
+            return
+        yield format_sse('done', result)
+
+@app.post("/api/chats/{chat_id}/messages")
+async def send_message(chat_id: int, payload: MessagePayload, stream: bool = False, user: SessionUser = Depends(get_current_user), db: Session = Depends(get_db)):
+    user_id, user_memory = user.id, user.user_memory
+    # Hand the request session's connection back now: each step below runs its own short
+    # transaction, so no pooled connection is held while the model is generating
+    await run_in_threadpool(db.close)
+
+    if not config.GEMINI_API_KEY or config.GEMINI_API_KEY.strip() == '':
+        raise HTTPException(status_code=400, detail="Key not configured. Please set GEMINI_API_KEY in .env file.")
+
+    # Admission comes first, so a refused turn leaves nothing behind in the chat
+    try:
+        with SEND_PHASE_SECONDS.time(phase='queue'):
+            slot = await model_scheduler.acquire(user_id)
+    except ModelBusy as busy:
+        raise HTTPException(status_code=429, detail=str(busy), headers={"Retry-After": str(busy.retry_after)})
+    try:
+        response = await answer_message(slot, chat_id, user_id, user_memory, payload, stream)
+    except BaseException:
+        slot.release()
+        raise
+    # A streamed reply holds its slot until the stream ends
+    if not isinstance(response, StreamingResponse):
+        slot.release()
+    return response
+
+async def answer_message(slot, chat_id: int, user_id: int, user_memory, payload: MessagePayload, stream: bool):
+    """The turn itself, run while holding a model slot."""
+    with SEND_PHASE_SECONDS.time(phase='prepare'):
+        user_message_id, messages_for_model, is_first_message, summary = await run_in_threadpool(with_session, prepare_user_turn, chat_id, user_id, payload)
+    with SEND_PHASE_SECONDS.time(phase='context'):
+        messages_for_model, summary = await fit_context_window(chat_id, messages_for_model, summary)
+    with SEND_PHASE_SECONDS.time(phase='recall'):
+        recalled = await run_in_threadpool(with_session, recall_snippets, user_id, chat_id, (payload.content or "").strip())
+    with SEND_PHASE_SECONDS.time(phase='attachments'):
+        await attach_pdf_text(messages_for_model, messages_for_model[-1].get('content'))
+        messages_for_model = await run_in_threadpool(inline_blobs, messages_for_model)
+
+        if config.GEMINI_USE_FILE_API:
+            file_updates = await resolve_file_references(config.GEMINI_API_KEY, messages_for_model)
+            if file_updates:
+                await run_in_threadpool(with_session, store_file_references, file_updates)
+        else:
+            messages_for_model = await run_in_threadpool(inline_file_data, messages_for_model)
+
+    if stream:
+        return StreamingResponse(
+            stream_assistant_reply(slot, chat_id, user_message_id, messages_for_model, user_memory, summary, recalled, is_first_message, payload),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            # Also frees the slot if the client disconnects before the stream starts
+            background=BackgroundTask(slot.release)
+        )
+
+    # Include user memory in API call
+    with SEND_PHASE_SECONDS.time(phase='model'):
+        response = await call_gemini_api(config.GEMINI_API_KEY, messages_for_model, user_memory=user_memory, summary=summary, recalled=recalled)
+
+    if 'error' in response:
+        status_code, headers = model_error_status(response)
+        raise HTTPException(status_code=status_code, detail=format_model_error(response['error']), headers=headers)
+
+    assistant_content = response.get('choices', [{}])[0].get('message', {}).get('content', 'No response')
+    with SEND_PHASE_SECONDS.time(phase='save'):
+        result = await run_in_threadpool(with_session, save_reply, chat_id, user_message_id, assistant_content, is_first_message, payload)
+    if not result:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    return result
+
+@app.get("/api/recall")
+def recall_messages(q: str, limit: int = 5, user: SessionUser = Depends(get_current_user), db: Session = Depends(get_db)):
+    """The user's past messages closest in meaning to q, best match first."""
+    limit = max(1, min(limit, 50))
+    return {"results": search_history(db, user.id, q, limit)}
+
+def require_metrics():
+    # Internal counters are only exposed where /metrics is
+    if not config.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+@app.get("/api/metrics/db-pool", dependencies=[Depends(require_metrics)])
+def get_db_pool_metrics():
+    return pool_stats(engine)
+
+@app.get("/api/metrics/response-cache", dependencies=[Depends(require_metrics)])
+def get_response_cache_metrics():
+    return response_cache.stats()
+
+@app.get("/api/metrics/model-scheduler", dependencies=[Depends(require_metrics)])
+async def get_model_scheduler_metrics():
+    return model_scheduler.stats()
+
+def collect_pool_metrics():
+    stats = pool_stats(engine)
+    samples = [
+        ("obsidian_db_pool_checkouts_total", "counter", "Connections checked out of the pool.", stats["checkouts"]),
+        ("obsidian_db_pool_timeouts_total", "counter", "Checkouts that timed out waiting for a connection.", stats["timeouts"]),
+    ]
+    if "size" in stats:
+        samples += [
+            ("obsidian_db_pool_size", "gauge", "Configured pool size.", stats["size"]),
+            ("obsidian_db_pool_checked_out", "gauge", "Connections in use.", stats["checked_out"]),
+            ("obsidian_db_pool_idle", "gauge", "Idle connections in the pool.", stats["idle"]),
+        ]
+    return samples
+
+def collect_response_cache_metrics():
+    if not response_cache.enabled:
+        return []
+    usage = response_cache.backend.usage()
+    return [
+        ("obsidian_response_cache_entries", "gauge", "Replies held in the response cache.", usage["entries"]),
+        ("obsidian_response_cache_bytes", "gauge", "Size of the cached replies.", usage["bytes"]),
+    ]
+
+def collect_scheduler_metrics():
+    return [
+        ("obsidian_model_turns_in_flight", "gauge", "Chat turns holding a model slot.", model_scheduler.in_flight),
+        ("obsidian_model_turns_queued", "gauge", "Chat turns waiting for a model slot.", model_scheduler.queued),
+    ]
+
+register_collector(collect_pool_metrics)
+register_collector(collect_response_cache_metrics)
+register_collector(collect_scheduler_metrics)
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    if not config.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/")
 def index():
     return FileResponse(os.path.join(frontend_path, "index.html"))
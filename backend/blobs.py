@@ -0,0 +1,228 @@
+"""Storage for attachments that arrive inline as base64 (pasted images).
+
+These used to be kept as base64 inside ``Message.image_data``, so every page of
+history and every prompt rebuild pulled megabytes of text through the database
+and the ORM. They are now decoded once, stored as raw bytes under their SHA-256
+and referenced from the message as ``{"blob": <hash>, "type", "name", "size"}``.
+
+``BLOB_BACKEND`` picks the store: ``filesystem`` (files under ``BLOB_FOLDER``)
+or ``sqlite`` (a single database file at ``BLOB_SQLITE_PATH``). Rows written
+before this existed are converted by running ``python blobs.py``.
+"""
+import base64
+import binascii
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+import config
+from uploads import base64_cache
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_BATCH = 200
+
+
+class BlobStore(ABC):
+    """Content-addressed byte storage: put returns the SHA-256 key of the data."""
+
+    @abstractmethod
+    def put(self, data: bytes) -> str:
+        ...
+
+    @abstractmethod
+    def get(self, key: str):
+        ...
+
+
+class FilesystemBlobStore(BlobStore):
+    def __init__(self, root: Path):
+        self.root = root
+
+    def _path(self, key: str) -> Path:
+        # Two-character fan-out keeps directories small
+        return self.root / key[:2] / key
+
+    def put(self, data: bytes) -> str:
+        key = hashlib.sha256(data).hexdigest()
+        path = self._path(key)
+        if path.exists():
+            return key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{key}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        return key
+
+    def get(self, key: str):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+class SqliteBlobStore(BlobStore):
+    """Blobs in one SQLite file; each thread keeps its own connection."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS blob (key TEXT PRIMARY KEY, data BLOB NOT NULL)")
+            self._local.conn = conn
+        return conn
+
+    def put(self, data: bytes) -> str:
+        key = hashlib.sha256(data).hexdigest()
+        self._connection().execute("INSERT OR IGNORE INTO blob (key, data) VALUES (?, ?)", (key, data))
+        return key
+
+    def get(self, key: str):
+        row = self._connection().execute("SELECT data FROM blob WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+
+def create_blob_store() -> BlobStore:
+    if config.BLOB_BACKEND == 'sqlite':
+        return SqliteBlobStore(config.BLOB_SQLITE_PATH)
+    return FilesystemBlobStore(config.BLOB_FOLDER_PATH)
+
+
+blob_store = create_blob_store()
+
+
+def parse_attachments(image_data):
+    """Attachment dicts from a Message.image_data value, including legacy formats."""
+    if not image_data:
+        return []
+    try:
+        parsed = json.loads(image_data)
+    except Exception:
+        # Legacy rows stored a bare base64 string
+        return [{"data": image_data, "type": "image/jpeg"}]
+    if isinstance(parsed, list):
+        return [item for item in parsed if isinstance(item, dict)]
+    if isinstance(parsed, dict):
+        return [parsed]
+    return [{"data": parsed, "type": "image/jpeg"}]
+
+
+def store_inline_attachment(item: dict) -> dict:
+    """Move an inline base64 attachment into the blob store and return its reference.
+
+    Data that does not decode is returned unchanged, as before.
+    """
+    data = item.get('data')
+    if not isinstance(data, str) or not data:
+        return item
+    try:
+        content = base64.b64decode(data, validate=True)
+    except (binascii.Error, ValueError):
+        return item
+    return {
+        "blob": blob_store.put(content),
+        "type": item.get('type') or 'image/jpeg',
+        "name": item.get('name'),
+        "size": len(content)
+    }
+
+
+def read_blob(key: str):
+    return blob_store.get(key)
+
+
+def read_blob_base64(key: str):
+    """The blob as base64 for the model, or None if it is missing."""
+    cache_key = ('blob', key)
+    cached = base64_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    content = blob_store.get(key)
+    if not content:
+        return None
+    encoded = base64.b64encode(content).decode('utf-8')
+    base64_cache.put(cache_key, encoded)
+    return encoded
+
+
+def inline_blobs(messages_for_model):
+    """Give blob references in messages their base64 bytes just before the model call.
+
+    Messages are replaced with copies because the originals are shared with the
+    prompt cache. Blobs that cannot be read are left out.
+    """
+    inlined = []
+    for msg in messages_for_model:
+        image_data = msg.get('image_data')
+        if isinstance(image_data, list) and any(isinstance(item, dict) and item.get('blob') for item in image_data):
+            items = []
+            for item in image_data:
+                if isinstance(item, dict) and item.get('blob'):
+                    data = read_blob_base64(item['blob'])
+                    if not data:
+                        logger.error("Blob not found: %s", item['blob'])
+                        continue
+                    item = {"data": data, "type": item.get('type') or 'image/jpeg', "name": item.get('name')}
+                items.append(item)
+            msg = dict(msg, image_data=items)
+        inlined.append(msg)
+    return inlined
+
+
+def backfill(engine):
+    """Convert inline base64 attachments already stored in Message rows to blob references."""
+    from sqlalchemy import or_
+    from sqlalchemy.orm import Session
+
+    from models import Message
+
+    last_id = 0
+    converted = 0
+    while True:
+        with Session(engine) as db:
+            rows = db.query(Message).filter(
+                Message.id > last_id,
+                Message.image_data.isnot(None),
+                # JSON rows with inline data, or legacy rows holding a bare base64 string
+                or_(Message.image_data.like('%"data"%'), ~Message.image_data.like('[%'))
+            ).order_by(Message.id).limit(BACKFILL_BATCH).all()
+            if not rows:
+                break
+            for message in rows:
+                entries = parse_attachments(message.image_data)
+                stored = [store_inline_attachment(item) if 'data' in item else item for item in entries]
+                if stored != entries:
+                    message.image_data = json.dumps(stored)
+                    converted += 1
+            db.commit()
+            last_id = rows[-1].id
+            logger.info("Converted %d messages (up to id %d)", converted, last_id)
+    return converted
+
+
+if __name__ == "__main__":
+    from database import create_db_engine
+    from logs import configure_logging
+    from migrations import migrate
+
+    configure_logging()
+    engine = create_db_engine()
+    migrate(engine)
+    backfill(engine)
@@ -6,8 +6,47 @@ load_dotenv()
 
 # Basic Config
 SECRET_KEY = os.getenv("SECRET_KEY", "change-me")
+# Logging: DEBUG, INFO, WARNING or ERROR; text for development, json for log shippers
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+# Prometheus metrics at /metrics and the /api/metrics/* endpoints; off by default since they are unauthenticated
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'False').lower() == 'true'
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///chatbot.db")
 UPLOAD_FOLDER = os.getenv("UPLOAD_FOLDER", "uploads")
+UPLOAD_MAX_MB = int(os.getenv("UPLOAD_MAX_MB", "20"))
+# Image variants built on upload: the copy sent to the model, the chat preview and the thumbnail
+IMAGE_MODEL_MAX_SIDE = int(os.getenv('IMAGE_MODEL_MAX_SIDE', '3072'))
+IMAGE_PREVIEW_MAX_SIDE = int(os.getenv('IMAGE_PREVIEW_MAX_SIDE', '1024'))
+IMAGE_THUMBNAIL_SIZE = int(os.getenv('IMAGE_THUMBNAIL_SIZE', '256'))
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '2'))
+# PDF text is extracted once per document; prompts carry only the most relevant pages within this budget
+PDF_CONTEXT_TOKENS = int(os.getenv('PDF_CONTEXT_TOKENS', '8000'))
+PDF_WORKERS = int(os.getenv('PDF_WORKERS', '1'))
+PDF_CACHE_DOCUMENTS = int(os.getenv('PDF_CACHE_DOCUMENTS', '32'))
+# Memory budget for base64-encoded attachments reused across chat turns
+UPLOAD_BASE64_CACHE_MB = int(os.getenv("UPLOAD_BASE64_CACHE_MB", "64"))
+# Pasted (inline base64) attachments are stored as raw bytes: filesystem (BLOB_FOLDER) or sqlite (BLOB_SQLITE_PATH)
+BLOB_BACKEND = os.getenv('BLOB_BACKEND', 'filesystem').lower()
+BLOB_SQLITE_PATH = os.getenv('BLOB_SQLITE_PATH', 'blobs.db')
+
+# Database engine: connection pool for every backend; pre-ping and recycle apply to server databases
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '20'))
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', '30'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'True').lower() == 'true'
+# Connection checkouts that wait at least this long are logged and counted as slow
+DB_POOL_SLOW_WAIT_MS = int(os.getenv('DB_POOL_SLOW_WAIT_MS', '100'))
+# SQLite: WAL lets readers run alongside the writer; writers wait this long for the lock instead of failing
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+
+# Signed-in user snapshots: per-process cache, optionally mirrored into the signed session cookie
+USER_CACHE_TTL_SECONDS = int(os.getenv('USER_CACHE_TTL_SECONDS', '60'))
+USER_CACHE_MAX_USERS = int(os.getenv('USER_CACHE_MAX_USERS', '10000'))
+SESSION_USER_CLAIMS = os.getenv('SESSION_USER_CLAIMS', 'False').lower() == 'true'
+SESSION_CLAIMS_MAX_AGE_SECONDS = int(os.getenv('SESSION_CLAIMS_MAX_AGE_SECONDS', '300'))
 
 # Email Configuration
 MAIL_SERVER = os.environ.get('MAIL_SERVER') or 'smtp.gmail.com'
@@ -17,16 +56,92 @@ MAIL_USE_SSL = os.environ.get('MAIL_USE_SSL', 'False').lower() == 'true'
 MAIL_USERNAME = os.environ.get('MAIL_USERNAME') or ''
 MAIL_PASSWORD = (os.environ.get('MAIL_PASSWORD') or '').replace(' ', '')
 MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER') or MAIL_USERNAME
+# Background delivery: one reused SMTP connection, closed after MAIL_IDLE_TIMEOUT seconds without mail
+MAIL_TIMEOUT = int(os.getenv('MAIL_TIMEOUT', '10'))
+MAIL_IDLE_TIMEOUT = int(os.getenv('MAIL_IDLE_TIMEOUT', '60'))
+MAIL_BATCH_SIZE = int(os.getenv('MAIL_BATCH_SIZE', '20'))
+MAIL_MAX_RETRIES = int(os.getenv('MAIL_MAX_RETRIES', '3'))
+MAIL_RETRY_BACKOFF_SECONDS = float(os.getenv('MAIL_RETRY_BACKOFF_SECONDS', '2'))
 
 # Verification Logic
 VERIFICATION_CODE_EXPIRY_MINUTES = int(os.getenv('VERIFICATION_CODE_EXPIRY_MINUTES', '10'))
 VERIFICATION_MAX_ATTEMPTS = int(os.getenv('VERIFICATION_MAX_ATTEMPTS', '5'))
+# Password hashing runs in its own process pool (0 = request threadpool), with a cap on queued jobs
+AUTH_HASH_WORKERS = int(os.getenv('AUTH_HASH_WORKERS', str(max(1, (os.cpu_count() or 2) // 2))))
+AUTH_MAX_CONCURRENCY = int(os.getenv('AUTH_MAX_CONCURRENCY', '32'))
 
 # AI Configuration
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+# Max seconds to wait between streamed chunks before giving up on a reply
+GEMINI_STREAM_READ_TIMEOUT = int(os.getenv('GEMINI_STREAM_READ_TIMEOUT', '60'))
+GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-2.5-flash')
+GEMINI_API_BASE = os.getenv('GEMINI_API_BASE', 'https://generativelanguage.googleapis.com/v1beta')
+GEMINI_UPLOAD_URL = os.getenv('GEMINI_UPLOAD_URL', 'https://generativelanguage.googleapis.com/upload/v1beta/files')
+# Send attachments through the file API (referenced by URI) instead of inline base64
+GEMINI_USE_FILE_API = os.getenv('GEMINI_USE_FILE_API', 'True').lower() == 'true'
+# Re-upload a file this long before the provider expires it
+GEMINI_FILE_REFRESH_MARGIN_MINUTES = int(os.getenv('GEMINI_FILE_REFRESH_MARGIN_MINUTES', '60'))
+# Provider file references remembered in memory (uploads are content-addressed, so this is per distinct file)
+GEMINI_KNOWN_FILES_MAX = int(os.getenv('GEMINI_KNOWN_FILES_MAX', '5000'))
+
+# Context window: recent turns sent verbatim, older ones folded into a rolling summary
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '32000'))
+CONTEXT_SUMMARY_TARGET_TOKENS = int(os.getenv('CONTEXT_SUMMARY_TARGET_TOKENS', str(CONTEXT_TOKEN_BUDGET // 2)))
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.getenv('CONTEXT_SUMMARY_MAX_TOKENS', '800'))
+CONTEXT_FILE_TOKENS = int(os.getenv('CONTEXT_FILE_TOKENS', '1500'))
+# Chats whose assembled prompt history is kept in memory between turns
+PROMPT_CACHE_MAX_CHATS = int(os.getenv('PROMPT_CACHE_MAX_CHATS', '1000'))
+# Semantic recall over each user's past messages (needs numpy; hnswlib adds an approximate index for long histories)
+RECALL_ENABLED = os.getenv('RECALL_ENABLED', 'True').lower() == 'true'
+RECALL_DIMENSIONS = int(os.getenv('RECALL_DIMENSIONS', '256'))
+# Snippets from the user's other chats added to each prompt (0 turns this off), and how close they must be
+RECALL_PROMPT_SNIPPETS = int(os.getenv('RECALL_PROMPT_SNIPPETS', '3'))
+RECALL_MIN_SCORE = float(os.getenv('RECALL_MIN_SCORE', '0.35'))
+RECALL_SNIPPET_CHARS = int(os.getenv('RECALL_SNIPPET_CHARS', '400'))
+RECALL_CACHE_MB = int(os.getenv('RECALL_CACHE_MB', '256'))
+RECALL_ANN_MIN_VECTORS = int(os.getenv('RECALL_ANN_MIN_VECTORS', '50000'))
+GEMINI_TIMEOUT = int(os.getenv('GEMINI_TIMEOUT', '30'))
+GEMINI_HTTP2 = os.getenv('GEMINI_HTTP2', 'True').lower() == 'true'
+# Generations allowed in flight at once, and the HTTP connection pool they share
+GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', '256'))
+GEMINI_MAX_CONNECTIONS = int(os.getenv('GEMINI_MAX_CONNECTIONS', '20'))
+GEMINI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('GEMINI_MAX_KEEPALIVE_CONNECTIONS', '20'))
+# Lighter model used while the main one is failing or its circuit breaker is open (empty = none)
+GEMINI_FALLBACK_MODEL = os.getenv('GEMINI_FALLBACK_MODEL', 'gemini-2.5-flash-lite')
+# Transient model errors are retried with exponential backoff and full jitter, all within one deadline per call
+MODEL_RETRIES = int(os.getenv('MODEL_RETRIES', '2'))
+MODEL_RETRY_BACKOFF_SECONDS = float(os.getenv('MODEL_RETRY_BACKOFF_SECONDS', '0.5'))
+MODEL_RETRY_BACKOFF_MAX_SECONDS = float(os.getenv('MODEL_RETRY_BACKOFF_MAX_SECONDS', '8'))
+MODEL_DEADLINE_SECONDS = float(os.getenv('MODEL_DEADLINE_SECONDS', '60'))
+# Send a second copy of a blocking model call still unanswered after this long (0 = off; doubles cost when it fires)
+MODEL_HEDGE_AFTER_MS = int(os.getenv('MODEL_HEDGE_AFTER_MS', '0'))
+# Fail fast after this many transient failures in a row (0 = never), probing again after the cooldown
+MODEL_BREAKER_FAILURES = int(os.getenv('MODEL_BREAKER_FAILURES', '5'))
+MODEL_BREAKER_COOLDOWN_SECONDS = float(os.getenv('MODEL_BREAKER_COOLDOWN_SECONDS', '30'))
+# Model call admission, per process (0 turns a limit off): turns in flight overall and per user,
+# a per-user token bucket, and a fair queue for turns that cannot start yet
+MODEL_MAX_IN_FLIGHT = int(os.getenv('MODEL_MAX_IN_FLIGHT', '64'))
+MODEL_MAX_IN_FLIGHT_PER_USER = int(os.getenv('MODEL_MAX_IN_FLIGHT_PER_USER', '2'))
+MODEL_USER_RATE_PER_MINUTE = float(os.getenv('MODEL_USER_RATE_PER_MINUTE', '20'))
+MODEL_USER_BURST = int(os.getenv('MODEL_USER_BURST', '10'))
+MODEL_QUEUE_MAX = int(os.getenv('MODEL_QUEUE_MAX', '256'))
+MODEL_QUEUE_MAX_PER_USER = int(os.getenv('MODEL_QUEUE_MAX_PER_USER', '4'))
+MODEL_QUEUE_TIMEOUT_SECONDS = float(os.getenv('MODEL_QUEUE_TIMEOUT_SECONDS', '10'))
+# Replies to identical prompts served from a cache: off, memory (per process) or sqlite (shared file)
+RESPONSE_CACHE_BACKEND = os.getenv('RESPONSE_CACHE_BACKEND', 'off').lower()
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv('RESPONSE_CACHE_TTL_SECONDS', '3600'))
+RESPONSE_CACHE_MAX_MB = int(os.getenv('RESPONSE_CACHE_MAX_MB', '64'))
+RESPONSE_CACHE_PATH = os.getenv('RESPONSE_CACHE_PATH', 'response_cache.db')
+
+# Chat list and message history pagination
+CHATS_PAGE_SIZE = int(os.getenv('CHATS_PAGE_SIZE', '50'))
+CHATS_PAGE_SIZE_MAX = int(os.getenv('CHATS_PAGE_SIZE_MAX', '200'))
+MESSAGES_PAGE_SIZE = int(os.getenv('MESSAGES_PAGE_SIZE', '30'))
+MESSAGES_PAGE_SIZE_MAX = int(os.getenv('MESSAGES_PAGE_SIZE_MAX', '200'))
 
 # Paths
 BASE_DIR = Path(__file__).resolve().parent
 UPLOAD_FOLDER_PATH = BASE_DIR / os.getenv("UPLOAD_FOLDER", "uploads")
 UPLOAD_FOLDER_PATH.mkdir(parents=True, exist_ok=True)
-UPLOAD_FOLDER = str(UPLOAD_FOLDER_PATH)
\ No newline at end of file
+UPLOAD_FOLDER = str(UPLOAD_FOLDER_PATH)
+BLOB_FOLDER_PATH = BASE_DIR / os.getenv("BLOB_FOLDER", "blobs")
\ No newline at end of file
@@ -0,0 +1,105 @@
+"""Token-budgeted context window for chat prompts.
+
+Only the most recent turns that fit in ``CONTEXT_TOKEN_BUDGET`` are sent to the
+model verbatim. Older turns are folded into a running summary stored on the
+chat. Folding trims the window down to ``CONTEXT_SUMMARY_TARGET_TOKENS``, so a
+summary call happens once every several turns rather than on every turn.
+"""
+import json
+import logging
+
+import config
+from gemini import resilient_client
+
+logger = logging.getLogger(__name__)
+
+# Gemini bills each image at a flat rate; other attachments get a rough estimate
+IMAGE_TOKENS = 258
+CHARS_PER_TOKEN = 4
+
+SUMMARY_INSTRUCTION = (
+    "You maintain a running summary of a conversation between a user and an AI assistant. "
+    "Merge the new messages into the existing summary. Keep facts, decisions, names, numbers, "
+    "code identifiers, the user's goals and any open questions; drop pleasantries. "
+    "Reply with the updated summary only, as plain prose or short bullet points."
+)
+
+
+def estimate_tokens(content, image_data=None):
+    """Cheap token estimate for a stored message (text length plus attachments)."""
+    tokens = len(content or '') // CHARS_PER_TOKEN + 1
+    if not image_data:
+        return tokens
+    try:
+        entries = json.loads(image_data) if isinstance(image_data, str) else image_data
+    except Exception:
+        return tokens + IMAGE_TOKENS
+    if not isinstance(entries, list):
+        return tokens + IMAGE_TOKENS
+    for entry in entries:
+        file_type = (entry.get('type') if isinstance(entry, dict) else None) or 'image/jpeg'
+        tokens += IMAGE_TOKENS if file_type.startswith('image/') else config.CONTEXT_FILE_TOKENS
+    return tokens
+
+
+def message_tokens(message):
+    """Token count for a Message row, computed once and cached on the row."""
+    if message.token_count is None:
+        message.token_count = estimate_tokens(message.content, message.image_data)
+    return message.token_count
+
+
+def plan_fold(messages, budget=None, target=None):
+    """Return how many leading messages should be folded into the summary.
+
+    Nothing is folded while the window fits the budget. Once it overflows, the
+    oldest messages are folded until the rest fits the (smaller) target. The
+    newest message is always kept, and the kept window starts on a user turn.
+    """
+    budget = budget or config.CONTEXT_TOKEN_BUDGET
+    target = target or config.CONTEXT_SUMMARY_TARGET_TOKENS
+    total = sum(msg.get('tokens', 0) for msg in messages)
+    if total <= budget:
+        return 0
+
+    fold_count = 0
+    while fold_count < len(messages) - 1 and total > target:
+        total -= messages[fold_count].get('tokens', 0)
+        fold_count += 1
+    while fold_count < len(messages) - 1 and messages[fold_count].get('role') != 'user':
+        fold_count += 1
+    return fold_count
+
+
+def format_transcript(messages):
+    lines = []
+    for msg in messages:
+        speaker = 'Assistant' if msg.get('role') == 'assistant' else 'User'
+        text = msg.get('content') or ''
+        names = [item.get('name') or item.get('filename') or 'file'
+                 for item in (msg.get('image_data') or []) if isinstance(item, dict)]
+        if names:
+            text = f"{text}\n[Attached: {', '.join(names)}]"
+        lines.append(f"{speaker}: {text}")
+    return "\n\n".join(lines)
+
+
+async def summarize_messages(api_key, previous_summary, messages):
+    """Fold messages into previous_summary with one model call; None on failure."""
+    prompt = (
+        f"Existing summary:\n{previous_summary or '(none yet)'}\n\n"
+        f"New messages:\n{format_transcript(messages)}"
+    )
+    payload = {
+        "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+        "systemInstruction": {"parts": [{"text": SUMMARY_INSTRUCTION}]},
+        "generationConfig": {
+            "temperature": 0.2,
+            "maxOutputTokens": config.CONTEXT_SUMMARY_MAX_TOKENS
+        }
+    }
+    response = await resilient_client.generate(api_key, payload)
+    if 'error' in response:
+        logger.warning("Summary update failed: %s", response['error'])
+        return None
+    return response['choices'][0]['message']['content']
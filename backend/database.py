@@ -0,0 +1,124 @@
+"""Database engine factory.
+
+SQLite runs in WAL mode with synchronous=NORMAL and a busy timeout: readers no
+longer block behind a writer, and concurrent commits queue for the write lock
+instead of failing with ``database is locked``. Server databases get a sized
+pool with pre-ping and connection recycling.
+
+Pooled engines record how long each connection checkout waited, so pool
+exhaustion shows up in ``pool_stats`` before it turns into timeouts.
+"""
+import logging
+import threading
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class PoolWaitStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.slow_checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float, timed_out: bool = False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+                return
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            if wait * 1000 >= config.DB_POOL_SLOW_WAIT_MS:
+                self.slow_checkouts += 1
+        if wait * 1000 >= config.DB_POOL_SLOW_WAIT_MS:
+            logger.warning("Waited %.0f ms for a database connection", wait * 1000)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "slow_checkouts": self.slow_checkouts,
+                "avg_wait_ms": round(self.total_wait * 1000 / self.checkouts, 3) if self.checkouts else 0.0,
+                "max_wait_ms": round(self.max_wait * 1000, 3),
+            }
+
+
+pool_wait_stats = PoolWaitStats()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that reports how long callers wait to check out a connection."""
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            pool_wait_stats.record(time.perf_counter() - started, timed_out=True)
+            raise
+        pool_wait_stats.record(time.perf_counter() - started)
+        return connection
+
+
+def pool_stats(engine):
+    """Current pool occupancy plus the checkout wait statistics."""
+    pool = engine.pool
+    stats = pool_wait_stats.snapshot()
+    if isinstance(pool, QueuePool):
+        stats.update({
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            "idle": pool.checkedin(),
+        })
+    return stats
+
+
+def create_db_engine(url=None):
+    url = make_url(url or config.DATABASE_URL)
+    if url.get_backend_name() != 'sqlite':
+        return create_engine(
+            url,
+            poolclass=TimedQueuePool,
+            pool_size=config.DB_POOL_SIZE,
+            max_overflow=config.DB_MAX_OVERFLOW,
+            pool_timeout=config.DB_POOL_TIMEOUT,
+            pool_recycle=config.DB_POOL_RECYCLE,
+            pool_pre_ping=config.DB_POOL_PRE_PING,
+        )
+
+    in_memory = url.database in (None, '', ':memory:')
+    pool_options = {} if in_memory else {
+        "poolclass": TimedQueuePool,
+        "pool_size": config.DB_POOL_SIZE,
+        "max_overflow": config.DB_MAX_OVERFLOW,
+        "pool_timeout": config.DB_POOL_TIMEOUT,
+    }
+    engine = create_engine(
+        url,
+        connect_args={"check_same_thread": False, "timeout": config.SQLITE_BUSY_TIMEOUT_MS / 1000},
+        **pool_options,
+    )
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not in_memory:
+            cursor.execute(f"PRAGMA journal_mode={config.SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={config.SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.close()
+
+    return engine
@@ -0,0 +1,257 @@
+"""Text extraction for PDF attachments.
+
+Each uploaded PDF is parsed once, page by page, and the text is saved next to
+the original as ``<hash>.pages.json``. Because uploads are content-addressed,
+that file doubles as the cache: the same document attached again, in any chat,
+is never parsed twice. Parsing runs in a worker process since pypdf is pure
+Python and would otherwise hold the GIL for the length of a large document.
+
+At prompt time only the pages most relevant to the user's question are sent,
+within ``PDF_CONTEXT_TOKENS`` for the whole prompt. pypdf is optional: without
+it PDFs are sent as before.
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import re
+import threading
+import uuid
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from fastapi.concurrency import run_in_threadpool
+
+import config
+from context import CHARS_PER_TOKEN
+from uploads import upload_path
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+logger = logging.getLogger(__name__)
+
+# Numbers of any length, words of three letters or more
+WORD_RE = re.compile(r'\d+|\w{3,}', re.UNICODE)
+# Pages scoring below this fraction of the best page are left out even when the budget has room
+RELEVANCE_CUTOFF = 0.25
+
+
+def extract_pdf_pages(path: str):
+    """Text of every page, whitespace collapsed; runs in a worker process."""
+    reader = PdfReader(path)
+    pages = []
+    for page in reader.pages:
+        try:
+            text = page.extract_text() or ''
+        except Exception:
+            text = ''
+        pages.append(' '.join(text.split()))
+    return pages
+
+
+class ParsedDocument:
+    def __init__(self, pages):
+        self.pages = pages
+        self.terms = [Counter(WORD_RE.findall(page.lower())) for page in pages]
+        self.document_frequency = Counter()
+        for page_terms in self.terms:
+            self.document_frequency.update(page_terms.keys())
+
+
+class PdfExtractor:
+    def __init__(self, workers: int, max_documents: int):
+        self.workers = workers
+        self.max_documents = max_documents
+        self._executor = None
+        self._documents = OrderedDict()
+        self._lock = threading.Lock()
+        self._parse_locks = {}
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def start(self):
+        """Start the workers at startup, before request threads exist."""
+        if PdfReader is not None and self.workers > 0:
+            self._get_executor().submit(len, '').result()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _cached(self, filename: str):
+        with self._lock:
+            document = self._documents.get(filename)
+            if document is not None:
+                self._documents.move_to_end(filename)
+            return document
+
+    def _remember(self, filename: str, pages):
+        document = ParsedDocument(pages)
+        with self._lock:
+            self._documents[filename] = document
+            self._documents.move_to_end(filename)
+            while len(self._documents) > self.max_documents:
+                self._documents.popitem(last=False)
+        return document
+
+    async def _parse(self, path: str):
+        if self.workers <= 0:
+            return await run_in_threadpool(extract_pdf_pages, path)
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._get_executor(), extract_pdf_pages, path)
+        except BrokenProcessPool:
+            logger.error("PDF extraction pool died; starting a new one")
+            self.shutdown()
+            return await loop.run_in_executor(self._get_executor(), extract_pdf_pages, path)
+
+    async def get_document(self, filename: str):
+        """Parsed pages of a stored PDF, from memory, the on-disk cache, or a fresh parse."""
+        document = self._cached(filename)
+        if document is not None:
+            return document
+
+        lock = self._parse_locks.setdefault(filename, asyncio.Lock())
+        try:
+            async with lock:
+                document = self._cached(filename)
+                if document is not None:
+                    return document
+
+                pages = await run_in_threadpool(read_pages_file, filename)
+                if pages is None:
+                    if PdfReader is None or not upload_path(filename).exists():
+                        return None
+                    try:
+                        pages = await self._parse(str(upload_path(filename)))
+                    except Exception as error:
+                        # Remember the failure so a broken file is not parsed on every turn
+                        logger.warning("Could not extract text from %s: %s", filename, error)
+                        pages = []
+                    await run_in_threadpool(write_pages_file, filename, pages)
+                return self._remember(filename, pages)
+        finally:
+            # Requests already waiting on this lock find the parsed pages once they get it
+            if self._parse_locks.get(filename) is lock:
+                del self._parse_locks[filename]
+
+
+pdf_extractor = PdfExtractor(config.PDF_WORKERS, config.PDF_CACHE_DOCUMENTS)
+
+
+def pages_path(filename: str):
+    return upload_path(f"{upload_path(filename).stem}.pages.json")
+
+
+def read_pages_file(filename: str):
+    try:
+        with open(pages_path(filename), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_pages_file(filename: str, pages):
+    path = pages_path(filename)
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(pages, f)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def select_pages(document: ParsedDocument, question: str, budget_tokens: int):
+    """Indexes of the pages to send, in document order, best matches first within the budget.
+
+    Pages are ranked by how many of the question's terms they contain, weighted
+    by how rare each term is in the document, so words found on every page count
+    for nothing and weak matches are dropped. A question that matches nothing ("summarize this") gets the
+    pages from the start.
+    """
+    terms = set(WORD_RE.findall((question or '').lower()))
+    page_count = len(document.pages)
+    scores = []
+    for index, page_terms in enumerate(document.terms):
+        score = sum(
+            math.log(1 + page_terms[term]) * math.log(page_count / document.document_frequency[term])
+            for term in terms if page_terms[term]
+        )
+        if score > 0:
+            scores.append((score, index))
+    best = max((score for score, _ in scores), default=0)
+    ranked = [index for score, index in sorted(scores, key=lambda item: (-item[0], item[1]))
+              if score >= best * RELEVANCE_CUTOFF]
+    if not ranked:
+        ranked = list(range(page_count))
+
+    selected = []
+    remaining = budget_tokens
+    for index in ranked:
+        tokens = len(document.pages[index]) // CHARS_PER_TOKEN + 1
+        if tokens > remaining:
+            continue
+        selected.append(index)
+        remaining -= tokens
+    return sorted(selected)
+
+
+def format_pages(document: ParsedDocument, indexes):
+    return "\n\n".join(f"--- Page {index + 1} ---\n{document.pages[index]}" for index in indexes)
+
+
+def is_stored_pdf(item):
+    return isinstance(item, dict) and item.get('type') == 'application/pdf' and bool(item.get('filename'))
+
+
+async def attach_pdf_text(messages, question: str):
+    """Replace stored-PDF references in messages with the text of their relevant pages.
+
+    Newer messages are served first from the shared PDF_CONTEXT_TOKENS budget.
+    Entries are replaced with copies, never changed in place, because they are
+    shared with the prompt cache. PDFs without extractable text are left as-is.
+    """
+    budget = config.PDF_CONTEXT_TOKENS
+    for index in reversed(range(len(messages))):
+        msg = messages[index]
+        image_data = msg.get('image_data')
+        if not isinstance(image_data, list) or not any(is_stored_pdf(item) for item in image_data):
+            continue
+
+        items = []
+        for item in image_data:
+            if is_stored_pdf(item):
+                document = await pdf_extractor.get_document(item['filename'])
+                if document is not None and any(document.pages):
+                    selected = select_pages(document, question, budget) if budget > 0 else []
+                    page_count = len(document.pages)
+                    if selected:
+                        text = format_pages(document, selected)
+                        budget -= len(text) // CHARS_PER_TOKEN + 1
+                        if len(selected) < page_count:
+                            text = f"(Showing {len(selected)} of {page_count} pages, chosen for relevance)\n\n{text}"
+                    else:
+                        text = f"({page_count} pages; not included because the document budget for this prompt is used up)"
+                    item = {"type": item['type'], "name": item.get('name'), "text": text}
+            items.append(item)
+        messages[index] = dict(msg, image_data=items)
+    return messages
+
+
+async def prepare_pdf(filename: str) -> dict:
+    """Extract a newly uploaded PDF so its first question does not wait on parsing."""
+    document = await pdf_extractor.get_document(filename)
+    if document is None:
+        return {}
+    return {"pages": len(document.pages)}
@@ -0,0 +1,459 @@
+"""Async client for the Gemini generateContent API.
+
+A single pooled, keep-alive HTTP/2 connection is shared by every request in
+the process, and a semaphore caps how many generations are in flight at once.
+With ``RESPONSE_CACHE_BACKEND`` set, replies to identical prompts come from
+the response cache instead. Every call records its latency, token usage and
+error class in ``metrics``, and goes through ``resilience`` for retries,
+circuit breaking and the fallback model.
+"""
+import asyncio
+import json
+import time
+
+import httpx
+from fastapi.concurrency import run_in_threadpool
+
+import config
+from metrics import MODEL_ERRORS, MODEL_FIRST_TOKEN_SECONDS, MODEL_REQUEST_SECONDS, MODEL_REPLY_TOKENS, MODEL_TOKENS
+from resilience import ResilientClient
+from response_cache import response_cache
+
+BLOCKED_FINISH_REASONS = ['SAFETY', 'RECITATION', 'OTHER']
+
+
+def build_gemini_payload(messages, user_memory=None, summary=None, recalled=None):
+    contents = []
+    for msg in messages:
+        role = msg.get('role', 'user')
+        if role == 'assistant':
+            role = 'model'
+        content = msg.get('content', '')
+        image_data = msg.get('image_data')
+        parts = []
+        if content:
+            parts.append({"text": content})
+        if image_data:
+            if isinstance(image_data, list):
+                for file_item in image_data:
+                    file_type = file_item.get('type', 'image/jpeg')
+                    file_data = file_item.get('data', '')
+                    file_uri = file_item.get('file_uri')
+                    if file_uri:
+                        # Uploaded through the file API: reference it instead of inlining the bytes
+                        parts.append({"file_data": {"mime_type": file_type, "file_uri": file_uri}})
+                    elif file_type.startswith('image/') and file_data:
+                        parts.append({"inline_data": {"mime_type": file_type, "data": file_data}})
+                    elif file_type == 'application/pdf' and file_item.get('text'):
+                        # Extracted pages, selected for the current question
+                        file_name = file_item.get('name') or 'document.pdf'
+                        parts.append({"text": f"\n[PDF File: {file_name}]\n{file_item['text']}"})
+                    elif file_type == 'application/pdf':
+                        file_name = file_item.get('name', 'document.pdf')
+                        parts.append({"text": f"\n[PDF File: {file_name} - Please analyze the content of this PDF document]"})
+            else:
+                if image_data:
+                    parts.append({"inline_data": {"mime_type": "image/jpeg", "data": image_data}})
+        if not parts:
+            parts.append({"text": "Please analyze this."})
+        contents.append({"role": role, "parts": parts})
+
+    # Build system instruction
+    system_text = "Format every answer in clean Markdown.\n\nUse headings, bullet points, and proper fenced code blocks for any code.\n\nNever use placeholder tokens like INLINECODE_0 or ARTIFACT_0.\n\nGive real code only, inside code fences.\n\nDo not add extra text like 'here is your answer' — just give the formatted Markdown output."
+    
+    # Add user memory/preferences if provided
+    if user_memory and user_memory.strip():
+        system_text = f"{system_text}\n\nUser Preferences and Context:\n{user_memory.strip()}\n\nRemember these preferences and context in all your responses."
+
+    # Earlier turns that no longer fit the context window
+    if summary and summary.strip():
+        system_text = f"{system_text}\n\nSummary of the earlier conversation:\n{summary.strip()}"
+
+    # Past messages from the user's other chats that look related to this turn
+    if recalled:
+        excerpts = "\n".join(f"- [{item['role']}, chat \"{item['chat_title']}\"] {item['snippet']}" for item in recalled)
+        system_text = f"{system_text}\n\nPossibly relevant excerpts from the user's other conversations (use only if helpful):\n{excerpts}"
+    
+    return {
+        "contents": contents,
+        "systemInstruction": {
+            "parts": [{
+                "text": system_text
+            }]
+        },
+        "generationConfig": {
+            "temperature": 0.7,
+            "maxOutputTokens": 2000
+        }
+    }
+
+
+def get_blocked_reason(candidate):
+    finish_reason = candidate.get('finishReason', '')
+    if finish_reason in BLOCKED_FINISH_REASONS:
+        safety_ratings = candidate.get('safetyRatings', [])
+        safety_info = ', '.join([f"{r.get('category', 'Unknown')}: {r.get('probability', 'Unknown')}" for r in safety_ratings])
+        return f"Content blocked by safety filters. Reason: {finish_reason}. Details: {safety_info}"
+    return None
+
+
+def extract_candidate_text(candidate):
+    content = candidate.get('content')
+    if isinstance(content, dict) and isinstance(content.get('parts'), list):
+        text_parts = []
+        for part in content['parts']:
+            if isinstance(part, dict):
+                if 'text' in part:
+                    text_parts.append(str(part['text']))
+                elif 'content' in part:
+                    text_parts.append(str(part['content']))
+        if text_parts:
+            return ''.join(text_parts)
+    return None
+
+
+def format_gemini_http_error(response):
+    error_msg = f"Error {response.status_code}: "
+    try:
+        error_data = response.json()
+        if 'error' in error_data:
+            error_info = error_data['error']
+            if isinstance(error_info, dict):
+                detailed_msg = error_info.get('message', error_info.get('status', ''))
+                error_msg += detailed_msg
+            elif isinstance(error_info, str):
+                error_msg += error_info
+        else:
+            error_msg += str(error_data)
+    except Exception:
+        try:
+            error_msg += response.text[:500]
+        except Exception:
+            error_msg += "Unknown error"
+    return error_msg
+
+
+def parse_gemini_result(result):
+    if not result:
+        return {"error": "Empty response received"}
+
+    # Flexible text extraction
+    text = None
+
+    if 'candidates' in result and isinstance(result['candidates'], list) and len(result['candidates']) > 0:
+        candidate = result['candidates'][0]
+        blocked_reason = get_blocked_reason(candidate)
+        if blocked_reason:
+            return {"error": blocked_reason}
+        text = extract_candidate_text(candidate)
+
+    if not text and 'text' in result:
+        text = str(result['text'])
+
+    if not text and 'content' in result:
+        content = result['content']
+        if isinstance(content, str):
+            text = content
+        elif isinstance(content, dict) and 'text' in content:
+            text = str(content['text'])
+
+    if not text and 'message' in result:
+        message = result['message']
+        if isinstance(message, dict) and 'content' in message:
+            text = str(message['content'])
+        elif isinstance(message, str):
+            text = message
+
+    if not text:
+        def extract_text_recursive(obj):
+            if isinstance(obj, str) and obj.strip():
+                return obj
+            elif isinstance(obj, dict):
+                for key in ['text', 'content', 'message', 'output', 'response']:
+                    if key in obj:
+                        found_text = extract_text_recursive(obj[key])
+                        if found_text:
+                            return found_text
+                for value in obj.values():
+                    found_text = extract_text_recursive(value)
+                    if found_text:
+                        return found_text
+            elif isinstance(obj, list):
+                for item in obj:
+                    found_text = extract_text_recursive(item)
+                    if found_text:
+                        return found_text
+            return None
+
+        text = extract_text_recursive(result)
+
+    if text and text.strip():
+        return {
+            "choices": [{
+                "message": {
+                    "content": text.strip()
+                }
+            }]
+        }
+
+    return {"error": "Unexpected response format"}
+
+
+def record_model_call(kind: str, model: str, started: float, error_class=None, usage=None):
+    """Record one finished model call; error_class is None on success."""
+    MODEL_REQUEST_SECONDS.observe(time.perf_counter() - started, kind=kind, model=model, outcome='error' if error_class else 'ok')
+    if error_class:
+        MODEL_ERRORS.inc(kind=kind, model=model, error_class=error_class)
+    if usage:
+        MODEL_TOKENS.inc(usage.get('promptTokenCount') or 0, type='prompt')
+        MODEL_TOKENS.inc(usage.get('candidatesTokenCount') or 0, type='reply')
+        if usage.get('candidatesTokenCount'):
+            MODEL_REPLY_TOKENS.observe(usage['candidatesTokenCount'])
+
+
+def http_error_class(error) -> str:
+    if isinstance(error, httpx.HTTPStatusError):
+        return f"http_{error.response.status_code}"
+    if isinstance(error, httpx.TimeoutException):
+        return 'timeout'
+    return 'network'
+
+
+class GeminiClient:
+    """Shared async HTTP client for the model API.
+
+    The underlying ``httpx.AsyncClient`` is created lazily on first use so it
+    binds to the running event loop, and is torn down by ``aclose`` on shutdown.
+    """
+
+    def __init__(self, base_url, upload_url, model, max_concurrency, max_connections, max_keepalive_connections,
+                 http2=True, timeout=30, stream_read_timeout=60):
+        self.base_url = base_url
+        self.upload_url = upload_url
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections
+        )
+        self.http2 = http2
+        self.timeout = httpx.Timeout(timeout, connect=10)
+        # Streams may run well past the blocking timeout; only the gap between chunks is bounded
+        self.stream_timeout = httpx.Timeout(10, read=stream_read_timeout)
+        self._client = None
+        self._semaphore = None
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                http2=self.http2,
+                limits=self.limits,
+                timeout=self.timeout,
+                headers={"Content-Type": "application/json"}
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._semaphore = None
+
+    async def generate(self, api_key, payload, model=None):
+        """One generateContent call; failures come back as {"error": msg, "error_class": class}."""
+        client = self._get_client()
+        model = model or self.model
+        url = f"/models/{model}:generateContent"
+        started = time.perf_counter()
+        try:
+            async with self._semaphore:
+                response = await client.post(url, json=payload, params={"key": api_key})
+            response.raise_for_status()
+
+            # Parse JSON safely
+            try:
+                result = response.json()
+            except json.JSONDecodeError as json_err:
+                record_model_call('generate', model, started, 'invalid_json')
+                response_text = response.text[:1000]
+                return {"error": f"Invalid JSON response: {str(json_err)}. Preview: {response_text}", "error_class": 'invalid_json'}
+
+            parsed = parse_gemini_result(result)
+            usage = result.get('usageMetadata') if isinstance(result, dict) else None
+            if 'error' in parsed:
+                parsed['error_class'] = 'response'
+            record_model_call('generate', model, started, parsed.get('error_class'), usage)
+            return parsed
+        except httpx.HTTPStatusError as e:
+            error_class = http_error_class(e)
+            record_model_call('generate', model, started, error_class)
+            return {"error": format_gemini_http_error(e.response), "error_class": error_class}
+        except httpx.HTTPError as e:
+            error_class = http_error_class(e)
+            record_model_call('generate', model, started, error_class)
+            return {"error": f"Network error: {str(e)}", "error_class": error_class}
+        except Exception as e:
+            record_model_call('generate', model, started, 'unexpected')
+            return {"error": f"Unexpected error processing response ({type(e).__name__}): {str(e)}", "error_class": 'unexpected'}
+
+    async def upload_file(self, api_key, content, mime_type, display_name=None):
+        """Push bytes to the file API and return {"uri", "expires_at"} or {"error": msg}."""
+        client = self._get_client()
+        try:
+            async with self._semaphore:
+                start = await client.post(
+                    self.upload_url,
+                    params={"key": api_key},
+                    headers={
+                        "X-Goog-Upload-Protocol": "resumable",
+                        "X-Goog-Upload-Command": "start",
+                        "X-Goog-Upload-Header-Content-Length": str(len(content)),
+                        "X-Goog-Upload-Header-Content-Type": mime_type
+                    },
+                    json={"file": {"display_name": display_name or "upload"}}
+                )
+                start.raise_for_status()
+                upload_url = start.headers.get("x-goog-upload-url")
+                if not upload_url:
+                    return {"error": "File upload did not return an upload URL"}
+
+                response = await client.post(
+                    upload_url,
+                    headers={
+                        "Content-Type": mime_type,
+                        "X-Goog-Upload-Offset": "0",
+                        "X-Goog-Upload-Command": "upload, finalize"
+                    },
+                    content=content
+                )
+                response.raise_for_status()
+            file_info = response.json().get("file") or {}
+            if not file_info.get("uri"):
+                return {"error": "File upload response had no URI"}
+            return {"uri": file_info["uri"], "expires_at": file_info.get("expirationTime")}
+        except httpx.HTTPStatusError as e:
+            return {"error": format_gemini_http_error(e.response)}
+        except httpx.HTTPError as e:
+            return {"error": f"Network error: {str(e)}"}
+        except Exception as e:
+            return {"error": f"Unexpected error uploading file ({type(e).__name__}): {str(e)}"}
+
+    async def stream(self, api_key, payload, model=None):
+        """Yield {"text": chunk} dicts as the model streams its reply, or a single {"error": msg, "error_class": class}."""
+        client = self._get_client()
+        model = model or self.model
+        url = f"/models/{model}:streamGenerateContent"
+        started = time.perf_counter()
+        first_chunk = True
+        # Each chunk repeats the running totals, so the last one seen is the whole reply's usage
+        usage = None
+        try:
+            async with self._semaphore:
+                async with client.stream("POST", url, json=payload, params={"key": api_key, "alt": "sse"},
+                                         timeout=self.stream_timeout) as response:
+                    if response.is_error:
+                        await response.aread()
+                        error_class = f"http_{response.status_code}"
+                        record_model_call('stream', model, started, error_class)
+                        yield {"error": format_gemini_http_error(response), "error_class": error_class}
+                        return
+                    async for line in response.aiter_lines():
+                        if not line or not line.startswith('data:'):
+                            continue
+                        try:
+                            chunk = json.loads(line[len('data:'):].strip())
+                        except json.JSONDecodeError as json_err:
+                            record_model_call('stream', model, started, 'invalid_json', usage)
+                            yield {"error": f"Invalid JSON chunk: {str(json_err)}. Preview: {line[:500]}", "error_class": 'invalid_json'}
+                            return
+                        usage = chunk.get('usageMetadata') or usage
+                        candidates = chunk.get('candidates') or []
+                        if not candidates:
+                            continue
+                        blocked_reason = get_blocked_reason(candidates[0])
+                        if blocked_reason:
+                            record_model_call('stream', model, started, 'response', usage)
+                            yield {"error": blocked_reason, "error_class": 'response'}
+                            return
+                        text = extract_candidate_text(candidates[0])
+                        if text:
+                            if first_chunk:
+                                MODEL_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - started)
+                                first_chunk = False
+                            yield {"text": text}
+            record_model_call('stream', model, started, None, usage)
+        except httpx.HTTPError as e:
+            error_class = http_error_class(e)
+            record_model_call('stream', model, started, error_class, usage)
+            yield {"error": f"Network error: {str(e)}", "error_class": error_class}
+        except Exception as e:
+            record_model_call('stream', model, started, 'unexpected', usage)
+            yield {"error": f"Unexpected error processing response ({type(e).__name__}): {str(e)}", "error_class": 'unexpected'}
+
+
+gemini_client = GeminiClient(
+    base_url=config.GEMINI_API_BASE,
+    upload_url=config.GEMINI_UPLOAD_URL,
+    model=config.GEMINI_MODEL,
+    max_concurrency=config.GEMINI_MAX_CONCURRENCY,
+    max_connections=config.GEMINI_MAX_CONNECTIONS,
+    max_keepalive_connections=config.GEMINI_MAX_KEEPALIVE_CONNECTIONS,
+    http2=config.GEMINI_HTTP2,
+    timeout=config.GEMINI_TIMEOUT,
+    stream_read_timeout=config.GEMINI_STREAM_READ_TIMEOUT
+)
+
+
+resilient_client = ResilientClient(
+    gemini_client,
+    fallback_model=config.GEMINI_FALLBACK_MODEL,
+    retries=config.MODEL_RETRIES,
+    backoff_seconds=config.MODEL_RETRY_BACKOFF_SECONDS,
+    backoff_max_seconds=config.MODEL_RETRY_BACKOFF_MAX_SECONDS,
+    deadline_seconds=config.MODEL_DEADLINE_SECONDS,
+    hedge_after_ms=config.MODEL_HEDGE_AFTER_MS,
+    breaker_failures=config.MODEL_BREAKER_FAILURES,
+    breaker_cooldown_seconds=config.MODEL_BREAKER_COOLDOWN_SECONDS
+)
+
+
+async def call_gemini_api(api_key, messages, user_memory=None, summary=None, recalled=None):
+    payload = build_gemini_payload(messages, user_memory, summary, recalled)
+    if not response_cache.enabled:
+        return await resilient_client.generate(api_key, payload)
+
+    key, cached = await run_in_threadpool(response_cache.lookup, payload)
+    if cached is not None:
+        return {"choices": [{"message": {"content": cached}}]}
+    result = await resilient_client.generate(api_key, payload)
+    # Fallback-model replies are not cached under the main model's key
+    if 'error' not in result and result.get('model') == gemini_client.model:
+        await run_in_threadpool(response_cache.store, key, result['choices'][0]['message']['content'])
+    return result
+
+
+async def stream_gemini_api(api_key, messages, user_memory=None, summary=None, recalled=None):
+    payload = build_gemini_payload(messages, user_memory, summary, recalled)
+    if not response_cache.enabled:
+        async for chunk in resilient_client.stream(api_key, payload):
+            yield chunk
+        return
+
+    key, cached = await run_in_threadpool(response_cache.lookup, payload)
+    if cached is not None:
+        yield {"text": cached}
+        return
+    text_parts = []
+    model = None
+    async for chunk in resilient_client.stream(api_key, payload):
+        if 'error' in chunk:
+            # A failed or blocked stream is never cached, even if part of it arrived
+            yield chunk
+            return
+        text_parts.append(chunk['text'])
+        model = chunk.get('model')
+        yield chunk
+    if model == gemini_client.model:
+        await run_in_threadpool(response_cache.store, key, ''.join(text_parts).strip())
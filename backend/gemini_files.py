@@ -0,0 +1,137 @@
+"""Provider file-API references for stored uploads.
+
+Each upload is pushed to the Gemini file API once. The returned URI and expiry
+are saved on the message's image_data entry and reused until shortly before
+the provider expires the file, at which point it is uploaded again.
+"""
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from fastapi.concurrency import run_in_threadpool
+
+import config
+from gemini import gemini_client
+from images import model_filename
+from uploads import upload_path, read_upload_base64
+
+logger = logging.getLogger(__name__)
+
+# Uploads are content-addressed, so one provider file serves every chat that attaches it.
+# Bounded LRU of filename -> reference; entries past their expiry are dropped as they are seen.
+_known_files = OrderedDict()
+# One lock per upload in flight, removed once it finishes
+_upload_locks = {}
+
+
+def parse_expiry(value):
+    if not value:
+        return None
+    try:
+        # The API returns RFC 3339 timestamps in UTC, sometimes with fractional seconds
+        return datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+    except ValueError:
+        return None
+
+
+def is_fresh(file_uri, file_expires_at):
+    expires_at = parse_expiry(file_expires_at)
+    if not file_uri or not expires_at:
+        return False
+    return expires_at - timedelta(minutes=config.GEMINI_FILE_REFRESH_MARGIN_MINUTES) > datetime.utcnow()
+
+
+def known_file(filename):
+    known = _known_files.get(filename)
+    if known is None:
+        return None
+    if not is_fresh(known['file_uri'], known['file_expires_at']):
+        del _known_files[filename]
+        return None
+    _known_files.move_to_end(filename)
+    return known
+
+
+def remember_file(filename, known):
+    _known_files[filename] = known
+    _known_files.move_to_end(filename)
+    while len(_known_files) > config.GEMINI_KNOWN_FILES_MAX:
+        _known_files.popitem(last=False)
+
+
+async def get_file_reference(api_key, filename, mime_type, display_name=None):
+    known = known_file(filename)
+    if known:
+        return known
+
+    lock = _upload_locks.setdefault(filename, asyncio.Lock())
+    try:
+        async with lock:
+            # Another request may have uploaded it while we waited
+            known = known_file(filename)
+            if known:
+                return known
+
+            try:
+                content = await run_in_threadpool(upload_path(model_filename(filename)).read_bytes)
+            except FileNotFoundError:
+                logger.error("File not found: %s", filename)
+                return None
+
+            result = await gemini_client.upload_file(api_key, content, mime_type, display_name or filename)
+            if 'error' in result:
+                logger.error("File API upload failed for %s: %s", filename, result['error'])
+                return None
+
+            known = {"file_uri": result['uri'], "file_expires_at": result['expires_at']}
+            remember_file(filename, known)
+            return known
+    finally:
+        # Requests already waiting on this lock re-check _known_files once they get it
+        if _upload_locks.get(filename) is lock:
+            del _upload_locks[filename]
+
+
+async def resolve_file_references(api_key, messages):
+    """Give every stored upload in messages a live file URI, falling back to inline base64.
+
+    Refreshed references are written into the shared entries so later turns reuse them;
+    inline fallbacks replace entries in ``messages`` with copies instead. Returns
+    {message_id: {filename: reference}} for the rows whose saved entries changed.
+    """
+    pending = []
+    for msg in messages:
+        image_data = msg.get('image_data')
+        if not isinstance(image_data, list):
+            continue
+        for item in image_data:
+            if not isinstance(item, dict) or not item.get('filename') or item.get('data'):
+                continue
+            if is_fresh(item.get('file_uri'), item.get('file_expires_at')):
+                continue
+            pending.append((msg, item))
+
+    references = await asyncio.gather(*[
+        get_file_reference(api_key, item['filename'], item.get('type') or 'image/jpeg', item.get('name'))
+        for _, item in pending
+    ])
+
+    updates = {}
+    fallbacks = {}
+    for (msg, item), reference in zip(pending, references):
+        if reference:
+            item.update(reference)
+            if msg.get('id'):
+                updates.setdefault(msg['id'], {})[item['filename']] = reference
+        else:
+            base64_data = await run_in_threadpool(read_upload_base64, model_filename(item['filename']))
+            fallbacks[id(item)] = dict(item, file_uri=None, data=base64_data) if base64_data else None
+
+    if fallbacks:
+        for index, msg in enumerate(messages):
+            image_data = msg.get('image_data')
+            if isinstance(image_data, list) and any(id(item) in fallbacks for item in image_data):
+                api_images = [fallbacks[id(item)] if id(item) in fallbacks else item for item in image_data]
+                messages[index] = dict(msg, image_data=[item for item in api_images if item])
+    return updates
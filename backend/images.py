@@ -0,0 +1,120 @@
+"""Derived versions of uploaded images.
+
+Each stored image gets up to three siblings in the upload folder:
+
+- ``<hash>.model.<ext>``: the copy sent to the model, downscaled to
+  ``IMAGE_MODEL_MAX_SIDE`` (the model resizes anything larger anyway, so the
+  extra pixels only make the request bigger). Same format and extension as
+  the original, and only written when the original is over the cap.
+- ``<hash>.thumb.webp``: a small square-bounded thumbnail for previews.
+- ``<hash>.preview.webp``: the version shown in the chat history.
+
+Variants are built in a small worker pool right after upload and never change
+afterwards, since the original is content-addressed. Pillow is optional: without
+it, or for files it cannot decode, everything falls back to the original.
+"""
+import asyncio
+import logging
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from uploads import upload_path
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Formats re-encoded for the model; anything else is sent in its original form
+MODEL_FORMATS = {'JPEG', 'PNG', 'WEBP'}
+WEBP_QUALITY = 80
+
+# Pillow's resize and encode release the GIL, so threads are enough here
+_executor = ThreadPoolExecutor(max_workers=config.IMAGE_WORKERS, thread_name_prefix="images")
+
+
+def variant_name(filename: str, variant: str, ext: str) -> str:
+    stem = upload_path(filename).stem
+    return f"{stem}.{variant}{ext}"
+
+
+def model_filename(filename: str) -> str:
+    """The stored file to send to the model: the downscaled copy when there is one."""
+    candidate = variant_name(filename, 'model', upload_path(filename).suffix)
+    return candidate if upload_path(candidate).exists() else filename
+
+
+def variant_urls(filename: str) -> dict:
+    """URLs of the thumbnail and preview for a stored image, for the ones that exist."""
+    urls = {}
+    for key, variant in (('thumbnail_url', 'thumb'), ('preview_url', 'preview')):
+        name = variant_name(filename, variant, '.webp')
+        if upload_path(name).exists():
+            urls[key] = f"/uploads/{name}"
+    return urls
+
+
+def save_image(image, filename: str, image_format: str, **options):
+    # Write beside the target and rename, so readers never see a partial file
+    path = upload_path(filename)
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        image.save(tmp_path, image_format, **options)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def build_variants(filename: str):
+    if Image is None:
+        return
+    try:
+        with Image.open(upload_path(filename)) as original:
+            image_format = original.format
+            image = ImageOps.exif_transpose(original)
+            image.load()
+    except Exception as error:
+        logger.warning("Could not read image %s: %s", filename, error)
+        return
+
+    if image_format in MODEL_FORMATS and max(image.size) > config.IMAGE_MODEL_MAX_SIDE:
+        name = variant_name(filename, 'model', upload_path(filename).suffix)
+        if not upload_path(name).exists():
+            try:
+                model_image = image.copy()
+                model_image.thumbnail((config.IMAGE_MODEL_MAX_SIDE, config.IMAGE_MODEL_MAX_SIDE), Image.LANCZOS)
+                options = {'quality': 90} if image_format in ('JPEG', 'WEBP') else {'optimize': True}
+                save_image(model_image, name, image_format, **options)
+            except Exception as error:
+                # model_filename falls back to the original when the copy is missing
+                logger.warning("Could not build the model copy of %s: %s", filename, error)
+
+    try:
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+    except Exception as error:
+        logger.warning("Could not convert image %s: %s", filename, error)
+        return
+    for variant, side in (('preview', config.IMAGE_PREVIEW_MAX_SIDE), ('thumb', config.IMAGE_THUMBNAIL_SIZE)):
+        name = variant_name(filename, variant, '.webp')
+        if upload_path(name).exists():
+            continue
+        try:
+            resized = image.copy()
+            resized.thumbnail((side, side), Image.LANCZOS)
+            save_image(resized, name, 'WEBP', quality=WEBP_QUALITY, method=4)
+        except Exception as error:
+            # variant_urls leaves out a variant that is missing, so the chat shows the original
+            logger.warning("Could not build the %s of %s: %s", variant, filename, error)
+
+
+async def prepare_image(filename: str) -> dict:
+    """Build the variants for a stored image and return the URLs of its thumbnail and preview."""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_executor, build_variants, filename)
+    return await loop.run_in_executor(_executor, variant_urls, filename)
@@ -0,0 +1,50 @@
+"""Leveled, structured logging for the backend.
+
+Modules log through ``logging.getLogger(__name__)`` with %-style arguments, so
+a message below ``LOG_LEVEL`` is dropped before it is formatted. ``LOG_FORMAT``
+chooses plain text for development or one JSON object per line for log
+shippers; fields passed with ``extra=`` become JSON keys.
+"""
+import json
+import logging
+import sys
+from datetime import datetime, timezone
+
+import config
+
+# Attributes every LogRecord has; anything else came in through extra=
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging():
+    """Send the backend's logs to stderr at LOG_LEVEL; safe to call more than once."""
+    root = logging.getLogger()
+    if any(getattr(handler, '_obsidian', False) for handler in root.handlers):
+        return
+    handler = logging.StreamHandler(sys.stderr)
+    handler._obsidian = True
+    if config.LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s] %(message)s'))
+    root.addHandler(handler)
+    root.setLevel(config.LOG_LEVEL)
+    # httpx logs every request at INFO; keep that for DEBUG runs only
+    if root.getEffectiveLevel() > logging.DEBUG:
+        logging.getLogger('httpx').setLevel(logging.WARNING)
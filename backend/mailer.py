@@ -0,0 +1,138 @@
+"""Background email delivery.
+
+Messages are queued and sent by a single worker thread that keeps one
+authenticated SMTP connection open between sends, so a request never waits on
+connect, STARTTLS and login. Queued messages go out in batches over that
+connection; failed sends are retried with exponential backoff on a fresh
+connection, and the connection is closed after ``MAIL_IDLE_TIMEOUT`` seconds
+without mail. A message that still cannot be sent is logged at INFO, so local
+setups without working SMTP can read verification codes from the log.
+"""
+import logging
+import queue
+import random
+import smtplib
+import threading
+import time
+
+import config
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def mail_configured():
+    return bool(config.MAIL_SERVER and config.MAIL_USERNAME and config.MAIL_PASSWORD and config.MAIL_DEFAULT_SENDER)
+
+
+class Mailer:
+    def __init__(self, max_retries: int, retry_backoff: float, batch_size: int, idle_timeout: float):
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.batch_size = batch_size
+        self.idle_timeout = idle_timeout
+        self._queue = queue.Queue()
+        self._smtp = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        """Queue message for delivery and return immediately."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="mailer", daemon=True)
+                self._thread.start()
+        self._queue.put(message)
+
+    def close(self, timeout: float = 10):
+        """Deliver what is already queued, then stop the worker."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            try:
+                message = self._queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                self._disconnect()
+                continue
+            if message is _STOP:
+                break
+
+            batch = [message]
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    message = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if message is _STOP:
+                    stop = True
+                    break
+                batch.append(message)
+
+            for message in batch:
+                self._deliver(message)
+            if stop:
+                break
+        self._disconnect()
+
+    def _connect(self):
+        if config.MAIL_USE_SSL and not config.MAIL_USE_TLS:
+            smtp = smtplib.SMTP_SSL(config.MAIL_SERVER, config.MAIL_PORT, timeout=config.MAIL_TIMEOUT)
+        else:
+            smtp = smtplib.SMTP(config.MAIL_SERVER, config.MAIL_PORT, timeout=config.MAIL_TIMEOUT)
+            if config.MAIL_USE_TLS:
+                smtp.starttls()
+        smtp.login(config.MAIL_USERNAME, config.MAIL_PASSWORD)
+        return smtp
+
+    def _disconnect(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except Exception:
+            pass
+        self._smtp = None
+
+    def _deliver(self, message):
+        attempt = 0
+        while True:
+            reused = self._smtp is not None
+            try:
+                if self._smtp is None:
+                    self._smtp = self._connect()
+                self._smtp.send_message(message)
+                logger.info("Sent email to %s", message['To'])
+                return True
+            except smtplib.SMTPRecipientsRefused as error:
+                # Retrying will not change the server's answer for a bad address
+                logger.warning("Recipient refused %s: %s", message['To'], error)
+                return False
+            except Exception as error:
+                self._disconnect()
+                if reused and isinstance(error, smtplib.SMTPServerDisconnected):
+                    # The server dropped the idle connection; reconnecting is not a failed attempt
+                    continue
+                if attempt >= self.max_retries:
+                    logger.error("Email to %s failed after %d attempts: %s", message['To'], attempt + 1, error)
+                    # As before the queue existed, keep the content (e.g. a verification code) reachable from the log
+                    logger.info("Undelivered email to %s:\n%s", message['To'], message.get_content())
+                    return False
+                delay = self.retry_backoff * (2 ** attempt)
+                delay += random.uniform(0, delay / 2)
+                logger.warning("Email to %s failed (%s); retrying in %.1fs", message['To'], error, delay)
+                time.sleep(delay)
+                attempt += 1
+
+
+mailer = Mailer(
+    config.MAIL_MAX_RETRIES,
+    config.MAIL_RETRY_BACKOFF_SECONDS,
+    config.MAIL_BATCH_SIZE,
+    config.MAIL_IDLE_TIMEOUT,
+)
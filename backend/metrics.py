@@ -0,0 +1,263 @@
+"""Prometheus metrics for the backend, served at ``/metrics``.
+
+A small in-process registry of counters, gauges and histograms rendered in the
+Prometheus text exposition format, so no client library is needed. Every metric
+is created here and updated from the module that owns the work:
+
+- ``MetricsMiddleware`` times each request by route template and counts the
+  database queries and query time spent on its behalf.
+- The model client records call latency, time to first token, token usage and
+  error classes, plus retries, hedges, fallbacks and circuit breaker state.
+- The model scheduler records queue waits and refused turns.
+- Caches count hits and misses; uploads record their size.
+
+Values are per process; run one scrape target per worker.
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from a fast cache hit to a long model generation
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+SIZE_BUCKETS = (16 * 1024, 64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2)
+TOKEN_BUCKETS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000)
+
+_metrics = []
+_collectors = []
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_samples(items))
+        return lines
+
+    def _render_samples(self, items):
+        return [f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}" for key, value in items]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_samples(self, items):
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labelnames, key, [('le', format_value(float(bound)))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def register_collector(collect):
+    """Add a function returning [(name, kind, documentation, value)] read at scrape time."""
+    _collectors.append(collect)
+
+
+def render() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        try:
+            samples = collect()
+        except Exception:
+            continue
+        for name, kind, documentation, value in samples:
+            lines.extend([f"# HELP {name} {documentation}", f"# TYPE {name} {kind}", f"{name} {format_value(value)}"])
+    return '\n'.join(lines) + '\n'
+
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'obsidian_http_request_duration_seconds', 'HTTP request latency by route template.',
+    ('method', 'route', 'status'))
+DB_QUERIES_PER_REQUEST = Histogram(
+    'obsidian_db_queries_per_request', 'Database queries executed while serving a request.',
+    ('route',), buckets=COUNT_BUCKETS)
+DB_SECONDS_PER_REQUEST = Histogram(
+    'obsidian_db_seconds_per_request', 'Time spent in database queries while serving a request.',
+    ('route',))
+DB_QUERIES = Counter('obsidian_db_queries_total', 'Database queries executed.')
+SEND_PHASE_SECONDS = Histogram(
+    'obsidian_send_message_phase_seconds', 'Time spent in each phase of sending a chat message.', ('phase',))
+MODEL_REQUEST_SECONDS = Histogram(
+    'obsidian_model_request_duration_seconds', 'Model API call latency, to the end of the reply.',
+    ('kind', 'model', 'outcome'))
+MODEL_FIRST_TOKEN_SECONDS = Histogram(
+    'obsidian_model_first_token_seconds', 'Time from a streaming model call to its first chunk.')
+MODEL_TOKENS = Counter('obsidian_model_tokens_total', 'Tokens reported by the model API.', ('type',))
+MODEL_REPLY_TOKENS = Histogram(
+    'obsidian_model_reply_tokens', 'Reply size in tokens, as reported by the model API.', buckets=TOKEN_BUCKETS)
+MODEL_ERRORS = Counter(
+    'obsidian_model_errors_total', 'Failed model API calls by error class.', ('kind', 'model', 'error_class'))
+MODEL_RETRIES = Counter('obsidian_model_retries_total', 'Model calls retried after a transient error.', ('model', 'error_class'))
+MODEL_HEDGES = Counter(
+    'obsidian_model_hedges_total', 'Hedged model requests sent, by which copy answered first.', ('winner',))
+MODEL_FALLBACKS = Counter('obsidian_model_fallbacks_total', 'Calls moved to the fallback model, by reason.', ('reason',))
+MODEL_BREAKER_OPEN = Gauge('obsidian_model_circuit_open', '1 while the circuit breaker for a model is open.', ('model',))
+MODEL_QUEUE_SECONDS = Histogram(
+    'obsidian_model_queue_wait_seconds', 'Time a chat turn waited in the model queue before starting.')
+MODEL_REJECTIONS = Counter(
+    'obsidian_model_rejections_total', 'Chat turns refused with 429 by the model scheduler.', ('reason',))
+CACHE_LOOKUPS = Counter('obsidian_cache_lookups_total', 'Cache lookups by cache and result.', ('cache', 'result'))
+UPLOAD_BYTES = Histogram('obsidian_upload_bytes', 'Size of uploaded files.', ('type',), buckets=SIZE_BUCKETS)
+
+
+def cache_lookup(cache: str, hit: bool):
+    CACHE_LOOKUPS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+class RequestStats:
+    __slots__ = ('queries', 'db_seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+# Database work done for the current request, including in threadpool workers (they copy the context)
+_request_stats = contextvars.ContextVar('request_stats', default=None)
+
+
+def instrument_engine(engine):
+    """Count queries and their time, globally and against the request that ran them."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['query_started'].pop()
+        DB_QUERIES.inc()
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += time.perf_counter() - started
+
+
+class MetricsMiddleware:
+    """Time every HTTP request and record the database work done for it.
+
+    Requests are labelled with the route template (``/api/chats/{chat_id}``),
+    not the raw path, so label cardinality stays fixed.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._route_paths = None
+
+    def _route_label(self, scope):
+        if self._route_paths is None:
+            routes = getattr(scope.get('app'), 'routes', None) or []
+            # Mounts (static files) match with their app as the endpoint
+            self._route_paths = {getattr(route, 'endpoint', None) or getattr(route, 'app', None): route.path or '/'
+                                 for route in routes}
+        endpoint = scope.get('endpoint')
+        if endpoint is None:
+            return 'unmatched'
+        return self._route_paths.get(endpoint) or 'unmatched'
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        status = {'code': 500}
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status['code'] = message['status']
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_stats.reset(token)
+            route = self._route_label(scope)
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                         method=scope['method'], route=route, status=status['code'])
+            DB_QUERIES_PER_REQUEST.observe(stats.queries, route=route)
+            DB_SECONDS_PER_REQUEST.observe(stats.db_seconds, route=route)
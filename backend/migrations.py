@@ -0,0 +1,137 @@
+"""Versioned schema migrations.
+
+Applied versions are recorded in a ``schema_version`` table and every pending
+step runs once, in order, at startup (or via ``python migrations.py``). Steps
+are written to be idempotent, so a database created before versioning existed
+is brought up to date by replaying them. On PostgreSQL the whole run holds an
+advisory lock, so workers starting at the same time apply each step once. On
+SQLite, run ``python migrations.py`` before starting several workers against a
+database that has pending steps.
+
+To change the schema, update models.py and append a new step to MIGRATIONS;
+never edit a step that has already shipped.
+"""
+import logging
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import DBAPIError, IntegrityError
+
+from database import create_db_engine
+from models import Base, Chat, Message
+from search import setup_search_index
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary key for pg_advisory_lock, shared by every worker running migrations
+MIGRATION_LOCK_KEY = 72_140_001
+
+
+def create_tables(engine):
+    # Creates only the tables that are missing; a fresh database gets the full current schema here
+    Base.metadata.create_all(bind=engine)
+
+
+def column_names(engine, table):
+    return {column['name'] for column in inspect(engine).get_columns(table.name)}
+
+
+def add_columns(table, columns):
+    def step(engine):
+        existing = column_names(engine, table)
+        for name in columns:
+            if name in existing:
+                continue
+            column = table.columns[name]
+            try:
+                with engine.begin() as conn:
+                    conn.execute(text(
+                        f'ALTER TABLE "{table.name}" ADD COLUMN {name} {column.type.compile(engine.dialect)}'
+                    ))
+            except DBAPIError:
+                # Fine if someone else added it since we looked; anything else is a real failure
+                if name not in column_names(engine, table):
+                    raise
+    return step
+
+
+def create_indexes(*indexes):
+    def step(engine):
+        if engine.dialect.name == 'postgresql':
+            # Build without blocking writes; CONCURRENTLY cannot run inside a transaction
+            with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                for index in indexes:
+                    columns = ", ".join(column.name for column in index.columns)
+                    conn.execute(text(
+                        f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {index.name} ON "{index.table.name}" ({columns})'
+                    ))
+        else:
+            for index in indexes:
+                index.create(bind=engine, checkfirst=True)
+    return step
+
+
+def find_index(table, name):
+    return next(index for index in table.indexes if index.name == name)
+
+
+MIGRATIONS = [
+    (1, "create tables", create_tables),
+    (2, "rolling chat summary columns", add_columns(Chat.__table__, ["summary", "summary_message_id"])),
+    (3, "cached message token counts", add_columns(Message.__table__, ["token_count"])),
+    (4, "full-text search index", setup_search_index),
+    (5, "chat list and message history indexes", create_indexes(
+        find_index(Chat.__table__, "ix_chat_user_id_archived_updated_at"),
+        find_index(Message.__table__, "ix_message_chat_id_created_at"),
+        find_index(Message.__table__, "ix_message_chat_id_id"),
+    )),
+    (6, "message embeddings for semantic recall", create_tables),
+]
+
+
+def current_version(engine):
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, applied_at TIMESTAMP)"
+        ))
+        return conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0
+
+
+def migrate(engine):
+    """Apply every migration newer than the database's recorded version."""
+    if engine.dialect.name != 'postgresql':
+        apply_pending(engine)
+        return
+    # Session-level lock on its own connection; the steps use other connections from the pool
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock_conn:
+        lock_conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        try:
+            apply_pending(engine)
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+
+
+def apply_pending(engine):
+    # Read inside the lock so a worker that waited sees the steps the first one applied
+    version = current_version(engine)
+    for number, description, step in MIGRATIONS:
+        if number <= version:
+            continue
+        logger.info("Applying migration %d: %s", number, description)
+        step(engine)
+        try:
+            with engine.begin() as conn:
+                conn.execute(
+                    text("INSERT INTO schema_version (version, applied_at) VALUES (:version, :applied_at)"),
+                    {"version": number, "applied_at": datetime.utcnow()}
+                )
+        except IntegrityError:
+            # Another worker applied the same step first
+            pass
+
+
+if __name__ == "__main__":
+    from logs import configure_logging
+
+    configure_logging()
+    migrate(create_db_engine())
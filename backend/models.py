@@ -7,6 +7,8 @@ from sqlalchemy import (
     DateTime,
     Boolean,
     ForeignKey,
+    Index,
+    LargeBinary,
 )
 from sqlalchemy.orm import declarative_base, relationship
 
@@ -44,11 +46,18 @@ class Chat(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     archived = Column(Boolean, default=False)
+    summary = Column(Text, nullable=True)  # Rolling summary of turns folded out of the context window
+    summary_message_id = Column(Integer, nullable=True)  # Last message folded into the summary
     messages = relationship(
         "Message", back_populates="chat", cascade="all, delete-orphan", order_by="Message.created_at"
     )
     user = relationship("User", back_populates="chats")
 
+    __table_args__ = (
+        # Sidebar listing: filter by owner and archive state, newest first, keyset on (updated_at, id)
+        Index("ix_chat_user_id_archived_updated_at", "user_id", "archived", "updated_at", "id"),
+    )
+
 
 class Message(Base):
     __tablename__ = "message"
@@ -57,5 +66,23 @@ class Message(Base):
     role = Column(String(20), nullable=False)  # 'user' or 'assistant'
     content = Column(Text, nullable=False)
     image_data = Column(Text, nullable=True)
+    token_count = Column(Integer, nullable=True)  # Cached prompt-size estimate, filled on first use
     created_at = Column(DateTime, default=datetime.utcnow)
-    chat = relationship("Chat", back_populates="messages")
\ No newline at end of file
+    chat = relationship("Chat", back_populates="messages")
+
+    __table_args__ = (
+        # History rebuilds order by created_at; pagination and last-message lookups use id
+        Index("ix_message_chat_id_created_at", "chat_id", "created_at"),
+        Index("ix_message_chat_id_id", "chat_id", "id"),
+    )
+
+class MessageEmbedding(Base):
+    __tablename__ = "message_embedding"
+    message_id = Column(Integer, ForeignKey("message.id", ondelete="CASCADE"), primary_key=True)
+    user_id = Column(Integer, nullable=False)  # Copied from the chat so a user's vectors load without a join
+    vector = Column(LargeBinary, nullable=False)  # float16 hashed embedding of the message content
+
+    __table_args__ = (
+        # Loading and catching up a user's index: everything after the last message_id already loaded
+        Index("ix_message_embedding_user_id_message_id", "user_id", "message_id"),
+    )
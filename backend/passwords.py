@@ -0,0 +1,83 @@
+"""Password hashing off the request path.
+
+werkzeug's password hashes are deliberately slow. They run in a small process
+pool so a burst of logins cannot hold the GIL or the request threadpool that
+chat traffic relies on, and at most ``AUTH_MAX_CONCURRENCY`` hashing jobs are
+queued at once.
+
+Six-digit verification codes live for minutes and are rate limited by
+attempt count, so they are stored as a keyed HMAC-SHA256 instead.
+"""
+import asyncio
+import hashlib
+import hmac
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from fastapi.concurrency import run_in_threadpool
+from werkzeug.security import generate_password_hash, check_password_hash
+
+import config
+
+logger = logging.getLogger(__name__)
+
+CODE_HASH_PREFIX = 'hmac-sha256$'
+
+
+class PasswordHasher:
+    def __init__(self, workers: int, max_concurrency: int):
+        self.workers = workers
+        self.max_concurrency = max_concurrency
+        self._executor = None
+        self._semaphore = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def start(self):
+        """Start the workers at startup, before request threads exist, rather than on the first login."""
+        if self.workers > 0:
+            self._get_executor().submit(len, '').result()
+
+    async def _run(self, fn, *args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            if self.workers <= 0:
+                return await run_in_threadpool(fn, *args)
+            loop = asyncio.get_running_loop()
+            try:
+                return await loop.run_in_executor(self._get_executor(), fn, *args)
+            except BrokenProcessPool:
+                logger.error("Password hashing pool died; starting a new one")
+                self.shutdown()
+                return await loop.run_in_executor(self._get_executor(), fn, *args)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(generate_password_hash, password)
+
+    async def verify(self, password_hash: str, password: str) -> bool:
+        return await self._run(check_password_hash, password_hash, password)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+password_hasher = PasswordHasher(config.AUTH_HASH_WORKERS, config.AUTH_MAX_CONCURRENCY)
+
+
+def hash_verification_code(email: str, code: str) -> str:
+    message = f"{email.lower()}:{code}".encode()
+    return CODE_HASH_PREFIX + hmac.new(config.SECRET_KEY.encode(), message, hashlib.sha256).hexdigest()
+
+
+def check_verification_code(code_hash: str, email: str, code: str) -> bool:
+    if code_hash.startswith(CODE_HASH_PREFIX):
+        return hmac.compare_digest(code_hash, hash_verification_code(email, code))
+    # Codes issued before the switch were stored as password hashes; they expire within minutes
+    return check_password_hash(code_hash, code)
@@ -0,0 +1,65 @@
+"""Per-chat cache of assembled prompt entries.
+
+Each chat's entry holds the model-side message dicts (role, content, token
+estimate and attachment references) for the turns after its summary, tagged
+with the id of the newest message they cover. A new turn is appended to the
+cached list instead of re-querying and re-parsing every row. Any mismatch with
+the database (another worker wrote to the chat, the process restarted) simply
+falls back to a rebuild.
+"""
+import threading
+from collections import OrderedDict
+
+import config
+from metrics import cache_lookup
+
+
+class PromptCache:
+    def __init__(self, max_chats: int):
+        self.max_chats = max_chats
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chat_id: int, last_message_id):
+        """Return a copy of the cached entries if they end at last_message_id, else None."""
+        with self._lock:
+            cached = self._entries.get(chat_id)
+            if cached is not None and cached[0] == last_message_id:
+                self._entries.move_to_end(chat_id)
+                entries = list(cached[1])
+            else:
+                entries = None
+        cache_lookup('prompt', entries is not None)
+        return entries
+
+    def put(self, chat_id: int, last_message_id: int, entries):
+        with self._lock:
+            self._entries[chat_id] = (last_message_id, list(entries))
+            self._entries.move_to_end(chat_id)
+            while len(self._entries) > self.max_chats:
+                self._entries.popitem(last=False)
+
+    def append(self, chat_id: int, previous_message_id: int, entry: dict):
+        """Add one turn if the cache still ends at previous_message_id; otherwise drop it."""
+        with self._lock:
+            cached = self._entries.get(chat_id)
+            if cached is None:
+                return
+            if cached[0] != previous_message_id:
+                del self._entries[chat_id]
+                return
+            self._entries[chat_id] = (entry['id'], cached[1] + [entry])
+
+    def drop_through(self, chat_id: int, message_id: int):
+        """Forget turns up to message_id once they are folded into the chat summary."""
+        with self._lock:
+            cached = self._entries.get(chat_id)
+            if cached is not None:
+                self._entries[chat_id] = (cached[0], [e for e in cached[1] if e['id'] > message_id])
+
+    def invalidate(self, chat_id: int):
+        with self._lock:
+            self._entries.pop(chat_id, None)
+
+
+prompt_cache = PromptCache(config.PROMPT_CACHE_MAX_CHATS)
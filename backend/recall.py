@@ -0,0 +1,294 @@
+"""Semantic recall over a user's past messages.
+
+Every saved message gets a small embedding, stored in ``message_embedding``
+with its owner's id. The vectors are built locally by feature hashing: words
+and word pairs are hashed into ``RECALL_DIMENSIONS`` signed buckets, so similar
+wording lands close together without an embedding model or API call.
+
+Each process keeps an in-memory index per active user, loaded on first use and
+caught up incrementally afterwards (only rows after the last message id it has
+seen), with least recently used users evicted beyond ``RECALL_CACHE_MB``. A
+query only ever scans the asking user's vectors. Small histories are searched
+exactly with NumPy; once a user has ``RECALL_ANN_MIN_VECTORS`` messages and
+hnswlib is installed, an approximate HNSW index is built for them instead.
+
+NumPy is optional: without it recall is switched off. Messages saved before
+this existed are indexed by running ``python recall.py``.
+"""
+import hashlib
+import logging
+import math
+import re
+import threading
+from collections import Counter, OrderedDict
+
+from sqlalchemy import func
+
+import config
+from models import Chat, Message, MessageEmbedding
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+logger = logging.getLogger(__name__)
+
+# Numbers of any length, words of three letters or more
+WORD_RE = re.compile(r'\d+|\w{3,}', re.UNICODE)
+# Frequent words that would otherwise make every message look alike
+STOPWORDS = frozenset("""
+    about after all also and any are because been but can could did does for from get had has have
+    her here his how into its just like more not now one only our out she should some than that the
+    their them then there these they this was were what when where which while who why will with
+    would you your
+""".split())
+# Candidates fetched per requested result, leaving room for ones filtered out afterwards
+OVERSAMPLE = 4
+BACKFILL_BATCH = 1000
+
+
+def recall_enabled():
+    return config.RECALL_ENABLED and np is not None
+
+
+def embed(text: str):
+    """Unit-length hashed embedding of text, or None when it has no usable words."""
+    tokens = [token for token in WORD_RE.findall((text or '').lower()) if token not in STOPWORDS]
+    if not tokens:
+        return None
+    features = Counter(tokens)
+    features.update(f"{first} {second}" for first, second in zip(tokens, tokens[1:]))
+
+    vector = np.zeros(config.RECALL_DIMENSIONS, dtype=np.float32)
+    for feature, count in features.items():
+        value = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), 'little')
+        sign = 1.0 if value >> 63 else -1.0
+        vector[value % config.RECALL_DIMENSIONS] += sign * (1.0 + math.log(count))
+    norm = np.linalg.norm(vector)
+    if not norm:
+        return None
+    return vector / norm
+
+
+def embedding_row(message: Message, user_id: int):
+    """The MessageEmbedding to save with a new message, or None when recall is off."""
+    if not recall_enabled():
+        return None
+    vector = embed(message.content)
+    if vector is None:
+        return None
+    return MessageEmbedding(message_id=message.id, user_id=user_id, vector=vector.astype(np.float16).tobytes())
+
+
+class UserIndex:
+    """One user's vectors, grown in place as new messages are caught up.
+
+    Vectors are stored as float16 but held as float32: NumPy has no fast
+    float16 matrix product, and widening on every query costs more than the scan.
+    """
+
+    def __init__(self, dimensions: int):
+        self.dimensions = dimensions
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.vectors = np.zeros((0, dimensions), dtype=np.float32)
+        self.size = 0
+        self.last_id = 0
+        self.ann = None
+        self.lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.vectors.nbytes
+
+    def add(self, ids, vectors):
+        needed = self.size + len(ids)
+        if needed > len(self.ids):
+            capacity = max(needed, len(self.ids) * 2, 1024)
+            grown_ids = np.zeros(capacity, dtype=np.int64)
+            grown_vectors = np.zeros((capacity, self.dimensions), dtype=np.float32)
+            grown_ids[:self.size] = self.ids[:self.size]
+            grown_vectors[:self.size] = self.vectors[:self.size]
+            self.ids, self.vectors = grown_ids, grown_vectors
+        self.ids[self.size:needed] = ids
+        self.vectors[self.size:needed] = vectors
+        self.size = needed
+        self.last_id = int(ids[-1])
+
+        if self.ann is not None:
+            self._ann_add(ids, vectors)
+        elif hnswlib is not None and self.size >= config.RECALL_ANN_MIN_VECTORS:
+            self.ann = hnswlib.Index(space='ip', dim=self.dimensions)
+            self.ann.init_index(max_elements=len(self.ids), ef_construction=100, M=16)
+            self._ann_add(self.ids[:self.size], self.vectors[:self.size])
+
+    def _ann_add(self, ids, vectors):
+        if self.ann.get_current_count() + len(ids) > self.ann.get_max_elements():
+            self.ann.resize_index(max(len(self.ids), self.ann.get_current_count() + len(ids)))
+        self.ann.add_items(vectors, ids)
+
+    def nearest(self, query, k: int):
+        """[(message_id, score)] for the k vectors closest to query, best first."""
+        if not self.size:
+            return []
+        k = min(k, self.size)
+        if self.ann is not None:
+            self.ann.set_ef(max(64, k * 2))
+            labels, distances = self.ann.knn_query(query, k=k)
+            return [(int(label), 1.0 - float(distance)) for label, distance in zip(labels[0], distances[0])]
+
+        scores = self.vectors[:self.size] @ query
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(self.ids[i]), float(scores[i])) for i in top]
+
+
+class RecallIndex:
+    def __init__(self, dimensions: int, max_bytes: int):
+        self.dimensions = dimensions
+        self.max_bytes = max_bytes
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _user_index(self, user_id: int) -> UserIndex:
+        with self._lock:
+            index = self._users.get(user_id)
+            if index is None:
+                index = self._users[user_id] = UserIndex(self.dimensions)
+            self._users.move_to_end(user_id)
+            return index
+
+    def _evict(self):
+        with self._lock:
+            total = sum(index.nbytes for index in self._users.values())
+            # The most recently used user always stays, however large
+            while total > self.max_bytes and len(self._users) > 1:
+                _, index = self._users.popitem(last=False)
+                total -= index.nbytes
+
+    def forget(self, user_id: int):
+        """Drop a user's index so the next query reloads it, e.g. after their messages were deleted."""
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def _catch_up(self, index: UserIndex, user_id: int, db):
+        expected = self.dimensions * 2
+        while True:
+            rows = db.query(MessageEmbedding.message_id, MessageEmbedding.vector).filter(
+                MessageEmbedding.user_id == user_id,
+                MessageEmbedding.message_id > index.last_id
+            ).order_by(MessageEmbedding.message_id).limit(BACKFILL_BATCH * 10).all()
+            if not rows:
+                return
+            # Vectors written under a different RECALL_DIMENSIONS are skipped until re-indexed
+            usable = [row for row in rows if len(row.vector) == expected]
+            if usable:
+                ids = np.fromiter((row.message_id for row in usable), dtype=np.int64, count=len(usable))
+                vectors = np.frombuffer(b''.join(row.vector for row in usable), dtype=np.float16)
+                index.add(ids, vectors.reshape(len(usable), self.dimensions).astype(np.float32))
+            index.last_id = rows[-1].message_id
+
+    def nearest(self, db, user_id: int, query, k: int):
+        index = self._user_index(user_id)
+        with index.lock:
+            self._catch_up(index, user_id, db)
+            results = index.nearest(query, k)
+        self._evict()
+        return results
+
+
+recall_index = RecallIndex(config.RECALL_DIMENSIONS, config.RECALL_CACHE_MB * 1024 * 1024)
+
+
+def snippet(content: str, limit: int) -> str:
+    text = ' '.join((content or '').split())
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(' ', 1)[0] + '…'
+
+
+def search_history(db, user_id: int, query: str, limit: int, exclude_chat_id: int = None, min_score: float = 0.0):
+    """The user's past messages most similar to query, best first, as dicts with a snippet.
+
+    Returns an empty list when recall is off or the query has no usable words.
+    Candidates are re-checked against the database, so messages deleted since
+    the index was loaded never come back.
+    """
+    if not recall_enabled() or limit <= 0:
+        return []
+    query_vector = embed(query)
+    if query_vector is None:
+        return []
+
+    candidates = [(message_id, score) for message_id, score in
+                  recall_index.nearest(db, user_id, query_vector, limit * OVERSAMPLE) if score > 0 and score >= min_score]
+    if not candidates:
+        return []
+    rows = db.query(Message.id, Message.chat_id, Message.role, Message.content, Message.created_at, Chat.title).join(
+        Chat, Chat.id == Message.chat_id
+    ).filter(Message.id.in_([message_id for message_id, _ in candidates]), Chat.user_id == user_id).all()
+    rows_by_id = {row.id: row for row in rows}
+
+    results = []
+    for message_id, score in candidates:
+        row = rows_by_id.get(message_id)
+        if row is None or row.chat_id == exclude_chat_id:
+            continue
+        results.append({
+            "message_id": row.id,
+            "chat_id": row.chat_id,
+            "chat_title": row.title,
+            "role": row.role,
+            "snippet": snippet(row.content, config.RECALL_SNIPPET_CHARS),
+            "score": round(score, 4),
+            "created_at": row.created_at.isoformat() if row.created_at else None
+        })
+        if len(results) >= limit:
+            break
+    return results
+
+
+def backfill(engine):
+    """Embed every message that has no vector yet (or one of the wrong size), in batches."""
+    from sqlalchemy.orm import Session
+
+    expected = config.RECALL_DIMENSIONS * 2
+    last_id = 0
+    indexed = 0
+    while True:
+        with Session(engine) as db:
+            rows = db.query(Message, Chat.user_id).join(Chat, Chat.id == Message.chat_id).outerjoin(
+                MessageEmbedding, MessageEmbedding.message_id == Message.id
+            ).filter(
+                Message.id > last_id,
+                (MessageEmbedding.message_id.is_(None)) | (func.length(MessageEmbedding.vector) != expected)
+            ).order_by(Message.id).limit(BACKFILL_BATCH).all()
+            if not rows:
+                break
+            for message, user_id in rows:
+                row = embedding_row(message, user_id)
+                if row is not None:
+                    db.merge(row)
+                    indexed += 1
+            db.commit()
+            last_id = rows[-1][0].id
+            logger.info("Indexed %d messages (up to id %d)", indexed, last_id)
+    return indexed
+
+
+if __name__ == "__main__":
+    from database import create_db_engine
+    from logs import configure_logging
+    from migrations import migrate
+
+    configure_logging()
+    if not recall_enabled():
+        raise SystemExit("Recall is disabled: set RECALL_ENABLED=True and install numpy")
+    engine = create_db_engine()
+    migrate(engine)
+    backfill(engine)
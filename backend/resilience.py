@@ -0,0 +1,246 @@
+"""Retries, hedging, circuit breaking and fallback around model calls.
+
+``ResilientClient`` wraps ``GeminiClient`` with the same ``generate`` and
+``stream`` interface. A failed call is classified by the ``error_class`` the
+client reports:
+
+- Transient errors (timeouts, network failures, 408/429/5xx) are retried up
+  to ``MODEL_RETRIES`` times with exponential backoff and full jitter. Every
+  attempt stays within ``MODEL_DEADLINE_SECONDS`` for the whole call.
+- Anything else (blocked content, a bad request or key) is returned at once.
+  A retry would not change the answer.
+- With ``MODEL_HEDGE_AFTER_MS`` set, a blocking call that has not answered in
+  that time gets a second copy, and the first reply wins.
+- Each model has a circuit breaker. After ``MODEL_BREAKER_FAILURES`` transient
+  failures in a row it opens, and calls fail fast for
+  ``MODEL_BREAKER_COOLDOWN_SECONDS``. After that, a single probe call decides
+  whether it closes again.
+- When the main model keeps failing, or its breaker is open, the call moves to
+  ``GEMINI_FALLBACK_MODEL``.
+
+A stream is only retried before its first chunk; once text has reached the
+user, an error ends the reply.
+"""
+import asyncio
+import logging
+import random
+import time
+
+from metrics import MODEL_BREAKER_OPEN, MODEL_FALLBACKS, MODEL_HEDGES, MODEL_RETRIES
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_ERRORS = {'timeout', 'network', 'http_408', 'http_429', 'http_500', 'http_502', 'http_503', 'http_504'}
+
+
+def is_retryable(result) -> bool:
+    return result.get('error_class') in RETRYABLE_ERRORS
+
+
+class CircuitBreaker:
+    """Closed, open or half-open; lives on the event loop and is not thread-safe."""
+
+    def __init__(self, model: str, failure_threshold: int, cooldown_seconds: float):
+        self.model = model
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_started_at = None
+
+    @property
+    def is_open(self):
+        return self.state == 'open'
+
+    def retry_after(self) -> float:
+        return max(1.0, self.opened_at + self.cooldown_seconds - time.monotonic())
+
+    def allow(self) -> bool:
+        """Whether a call may go out now; after the cooldown, lets one probe through."""
+        if self.state == 'closed' or self.failure_threshold <= 0:
+            return True
+        if self.state == 'open':
+            if time.monotonic() < self.opened_at + self.cooldown_seconds:
+                return False
+            self.state = 'half_open'
+            self._probe_started_at = None
+        # A probe whose caller went away never reports back; let another through after a cooldown
+        now = time.monotonic()
+        if self._probe_started_at is not None and now < self._probe_started_at + self.cooldown_seconds:
+            return False
+        self._probe_started_at = now
+        return True
+
+    def record(self, result):
+        if self.failure_threshold <= 0:
+            return
+        if 'error' in result and is_retryable(result):
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                self._open(result)
+        elif self.state != 'closed' or self.failures:
+            if self.state != 'closed':
+                logger.info("Circuit for %s closed", self.model)
+                MODEL_BREAKER_OPEN.set(0, model=self.model)
+            self.state = 'closed'
+            self.failures = 0
+            self._probe_started_at = None
+
+    def _open(self, result):
+        if self.state != 'open':
+            logger.warning("Circuit for %s opened after %d failures (last: %s)",
+                           self.model, self.failures, result.get('error_class'))
+            MODEL_BREAKER_OPEN.set(1, model=self.model)
+        self.state = 'open'
+        self.opened_at = time.monotonic()
+        self._probe_started_at = None
+
+
+class ResilientClient:
+    def __init__(self, client, fallback_model: str, retries: int, backoff_seconds: float, backoff_max_seconds: float,
+                 deadline_seconds: float, hedge_after_ms: int, breaker_failures: int, breaker_cooldown_seconds: float):
+        self.client = client
+        self.models = [client.model]
+        if fallback_model and fallback_model != client.model:
+            self.models.append(fallback_model)
+        self.retries = max(0, retries)
+        self.backoff_seconds = backoff_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.deadline_seconds = deadline_seconds
+        self.hedge_after = hedge_after_ms / 1000
+        self.breakers = {model: CircuitBreaker(model, breaker_failures, breaker_cooldown_seconds) for model in self.models}
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter: a burst of failed calls spreads its retries instead of returning in step
+        return random.uniform(0, min(self.backoff_max_seconds, self.backoff_seconds * 2 ** attempt))
+
+    def _circuit_open(self, breaker):
+        return {
+            "error": "The model service is temporarily unavailable. Please try again shortly.",
+            "error_class": 'circuit_open',
+            "retry_after": int(breaker.retry_after() + 0.5),
+        }
+
+    def _candidates(self):
+        """Models to try in order, skipping ones whose breaker is open; (None, breaker) marks a skip."""
+        for index, model in enumerate(self.models):
+            breaker = self.breakers[model]
+            if breaker.allow():
+                yield model, breaker
+            else:
+                if index + 1 < len(self.models):
+                    MODEL_FALLBACKS.inc(reason='circuit_open')
+                yield None, breaker
+
+    async def _attempt(self, api_key, payload, model, timeout):
+        try:
+            return await asyncio.wait_for(self.client.generate(api_key, payload, model=model), timeout)
+        except asyncio.TimeoutError:
+            return {"error": f"No reply from the model within {timeout:.1f}s", "error_class": 'timeout'}
+
+    async def _hedged(self, api_key, payload, model, timeout):
+        if self.hedge_after <= 0 or timeout <= self.hedge_after:
+            return await self._attempt(api_key, payload, model, timeout)
+        first = asyncio.ensure_future(self._attempt(api_key, payload, model, timeout))
+        pending = {first}
+        result = None
+        try:
+            done, pending = await asyncio.wait(pending, timeout=self.hedge_after)
+            if done:
+                return first.result()
+
+            hedge = asyncio.ensure_future(self._attempt(api_key, payload, model, timeout - self.hedge_after))
+            pending.add(hedge)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if 'error' not in result:
+                        MODEL_HEDGES.inc(winner='hedge' if task is hedge else 'original')
+                        return result
+            MODEL_HEDGES.inc(winner='neither')
+            return result
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _generate_with_retries(self, api_key, payload, model, breaker, deadline):
+        attempt = 0
+        while True:
+            result = await self._hedged(api_key, payload, model, deadline - time.monotonic())
+            breaker.record(result)
+            if 'error' not in result or not is_retryable(result) or attempt >= self.retries or breaker.is_open:
+                return result
+            delay = self._backoff(attempt)
+            if time.monotonic() + delay >= deadline:
+                return result
+            MODEL_RETRIES.inc(model=model, error_class=result['error_class'])
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def generate(self, api_key, payload):
+        deadline = time.monotonic() + self.deadline_seconds
+        result = None
+        for model, breaker in self._candidates():
+            if model is None:
+                result = result if result is not None else self._circuit_open(breaker)
+                continue
+            if time.monotonic() >= deadline:
+                break
+            if model != self.models[0] and result is not None and 'error_class' in result:
+                logger.warning("Falling back to %s after %s", model, result['error_class'])
+                if result['error_class'] != 'circuit_open':
+                    MODEL_FALLBACKS.inc(reason=result['error_class'])
+            result = await self._generate_with_retries(api_key, payload, model, breaker, deadline)
+            if 'error' not in result:
+                result['model'] = model
+                return result
+            if not is_retryable(result):
+                return result
+        return result
+
+    async def stream(self, api_key, payload):
+        """Like GeminiClient.stream; text chunks also carry the model that wrote them."""
+        deadline = time.monotonic() + self.deadline_seconds
+        error = None
+        for model, breaker in self._candidates():
+            if model is None:
+                error = error if error is not None else self._circuit_open(breaker)
+                continue
+            if model != self.models[0] and error is not None:
+                logger.warning("Falling back to %s after %s", model, error['error_class'])
+                if error['error_class'] != 'circuit_open':
+                    MODEL_FALLBACKS.inc(reason=error['error_class'])
+            attempt = 0
+            while True:
+                started = False
+                error = None
+                async for chunk in self.client.stream(api_key, payload, model=model):
+                    if 'error' in chunk:
+                        breaker.record(chunk)
+                        if started:
+                            yield chunk
+                            return
+                        error = chunk
+                        break
+                    if not started:
+                        breaker.record(chunk)
+                        started = True
+                    yield dict(chunk, model=model)
+                if error is None:
+                    if not started:
+                        breaker.record({})
+                    return
+                if not is_retryable(error):
+                    yield error
+                    return
+                delay = self._backoff(attempt)
+                if attempt >= self.retries or breaker.is_open or time.monotonic() + delay >= deadline:
+                    break
+                MODEL_RETRIES.inc(model=model, error_class=error['error_class'])
+                await asyncio.sleep(delay)
+                attempt += 1
+            if time.monotonic() >= deadline:
+                break
+        yield error
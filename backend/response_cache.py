@@ -0,0 +1,232 @@
+"""Opt-in cache of model replies for repeated identical prompts.
+
+The key is a SHA-256 of the request as the model would see it: the model name,
+the conversation ``contents`` (text parts trimmed, line endings normalized),
+the system instruction (which carries the user's memory, chat summary and
+recalled snippets) and the generation config. Only successful replies are
+stored, and entries expire after ``RESPONSE_CACHE_TTL_SECONDS``.
+
+``RESPONSE_CACHE_BACKEND`` picks the store: ``memory`` is an LRU per process,
+``sqlite`` is a file shared by every worker on the host. Both evict least
+recently used entries beyond ``RESPONSE_CACHE_MAX_MB``. Off by default, since
+a cached reply is returned verbatim where the model would have sampled anew.
+"""
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import config
+from metrics import cache_lookup
+
+logger = logging.getLogger(__name__)
+
+# The SQLite store checks its total size once every this many writes
+SQLITE_EVICT_EVERY = 50
+
+
+def normalize_part(part):
+    if isinstance(part, dict) and isinstance(part.get('text'), str):
+        return dict(part, text=part['text'].replace('\r\n', '\n').strip())
+    return part
+
+
+def cache_key(payload, model: str) -> str:
+    material = {
+        "model": model,
+        "contents": [
+            dict(content, parts=[normalize_part(part) for part in content.get('parts', [])])
+            for content in payload.get('contents', [])
+        ],
+        "systemInstruction": payload.get('systemInstruction'),
+        "generationConfig": payload.get('generationConfig'),
+    }
+    encoded = json.dumps(material, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+class MemoryBackend:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is None:
+                return None, 0
+            expires_at, text, size = cached
+            if expires_at < time.time():
+                del self._entries[key]
+                self._bytes -= size
+                return None, 1
+            self._entries.move_to_end(key)
+            return text, 0
+
+    def put(self, key: str, text: str, ttl_seconds: int):
+        size = len(text.encode('utf-8'))
+        if size > self.max_bytes:
+            return 0
+        evicted = 0
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[2]
+            self._entries[key] = (time.time() + ttl_seconds, text, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, _, old_size) = self._entries.popitem(last=False)
+                self._bytes -= old_size
+                evicted += 1
+        return evicted
+
+    def usage(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes}
+
+
+class SqliteBackend:
+    """Cache rows in a SQLite file; each thread keeps its own connection."""
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS response_cache (
+                key TEXT PRIMARY KEY, text TEXT NOT NULL, size INTEGER NOT NULL,
+                expires_at REAL NOT NULL, accessed_at REAL NOT NULL
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_response_cache_accessed_at ON response_cache (accessed_at)")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str):
+        conn = self._connection()
+        row = conn.execute("SELECT text, expires_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None, 0
+        now = time.time()
+        if row[1] < now:
+            conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+            return None, 1
+        conn.execute("UPDATE response_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return row[0], 0
+
+    def put(self, key: str, text: str, ttl_seconds: int):
+        size = len(text.encode('utf-8'))
+        if size > self.max_bytes:
+            return 0
+        conn = self._connection()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO response_cache (key, text, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (key, text, size, now + ttl_seconds, now)
+        )
+        with self._lock:
+            self._writes += 1
+            if self._writes % SQLITE_EVICT_EVERY:
+                return 0
+        return self._evict(conn, now)
+
+    def _evict(self, conn, now: float):
+        evicted = conn.execute("DELETE FROM response_cache WHERE expires_at < ?", (now,)).rowcount
+        total = 0
+        stale = []
+        for key, size in conn.execute("SELECT key, size FROM response_cache ORDER BY accessed_at DESC"):
+            total += size
+            if total > self.max_bytes:
+                stale.append((key,))
+        if stale:
+            conn.executemany("DELETE FROM response_cache WHERE key = ?", stale)
+        return evicted + len(stale)
+
+    def usage(self):
+        entries, size = self._connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM response_cache").fetchone()
+        return {"entries": entries, "bytes": size}
+
+
+class ResponseCache:
+    def __init__(self, backend, ttl_seconds: int, model: str):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.model = model
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def lookup(self, payload):
+        """Return (key, cached reply text or None) for a request payload."""
+        key = cache_key(payload, self.model)
+        try:
+            text, expired = self.backend.get(key)
+        except Exception as error:
+            logger.error("Response cache lookup failed: %s", error)
+            text, expired = None, 0
+        cache_lookup('response', text is not None)
+        with self._lock:
+            if text is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            self.evictions += expired
+        return key, text
+
+    def store(self, key: str, text: str):
+        if not text:
+            return
+        try:
+            evicted = self.backend.put(key, text, self.ttl_seconds)
+        except Exception as error:
+            logger.error("Response cache write failed: %s", error)
+            return
+        with self._lock:
+            self.stores += 1
+            self.evictions += evicted
+
+    def stats(self):
+        if not self.enabled:
+            return {"backend": "off"}
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                "backend": config.RESPONSE_CACHE_BACKEND,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+            }
+        stats.update(self.backend.usage())
+        return stats
+
+
+def create_backend():
+    max_bytes = config.RESPONSE_CACHE_MAX_MB * 1024 * 1024
+    if config.RESPONSE_CACHE_BACKEND == 'memory':
+        return MemoryBackend(max_bytes)
+    if config.RESPONSE_CACHE_BACKEND == 'sqlite':
+        return SqliteBackend(config.RESPONSE_CACHE_PATH, max_bytes)
+    return None
+
+
+response_cache = ResponseCache(create_backend(), config.RESPONSE_CACHE_TTL_SECONDS, config.GEMINI_MODEL)
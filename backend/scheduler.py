@@ -0,0 +1,235 @@
+"""Admission control and fair queueing for model calls.
+
+Every chat turn takes a slot from ``model_scheduler`` before any work is done
+for it, and holds the slot until the reply is saved or the stream ends. Three
+limits apply, all per process:
+
+- ``MODEL_MAX_IN_FLIGHT`` turns at once, and ``MODEL_MAX_IN_FLIGHT_PER_USER``
+  for any one user.
+- A token bucket per user refilled at ``MODEL_USER_RATE_PER_MINUTE`` and
+  holding up to ``MODEL_USER_BURST`` turns.
+- Turns that cannot start yet wait in a queue served round-robin by user, so
+  one user's backlog never delays everyone else's next turn. A turn waits at
+  most ``MODEL_QUEUE_TIMEOUT_SECONDS``.
+
+Anything over a limit, or a queue that is full, is refused at once with
+``ModelBusy``, which the API turns into a 429 with ``Retry-After``.
+
+The scheduler lives on the event loop and is not thread-safe.
+"""
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+
+import config
+from metrics import MODEL_QUEUE_SECONDS, MODEL_REJECTIONS
+
+# Token buckets kept in memory; the least recently used one is dropped first (a bucket
+# untouched for long has refilled anyway)
+MAX_BUCKETS = 10000
+
+REJECTION_MESSAGES = {
+    'rate_limited': "You are sending messages too quickly. Please wait a moment and try again.",
+    'user_queue_full': "Your earlier messages are still being answered. Please wait for them to finish.",
+    'queue_full': "The assistant is busy right now. Please try again shortly.",
+    'queue_timeout': "The assistant is busy right now. Please try again shortly.",
+}
+
+
+class ModelBusy(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(REJECTION_MESSAGES[reason])
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated_at')
+
+    def __init__(self, tokens: float, updated_at: float):
+        self.tokens = tokens
+        self.updated_at = updated_at
+
+
+class Slot:
+    """A granted model call; release it exactly once, or use it as an async context manager."""
+
+    def __init__(self, scheduler, user_id: int):
+        self.scheduler = scheduler
+        self.user_id = user_id
+        self.acquired_at = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.scheduler._release(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
+class ModelScheduler:
+    def __init__(self, max_in_flight: int, max_per_user: int, rate_per_minute: float, burst: int,
+                 max_queued: int, max_queued_per_user: int, queue_timeout: float):
+        # 0 turns a limit off
+        self.max_in_flight = max_in_flight or math.inf
+        self.max_per_user = max_per_user or math.inf
+        self.rate = rate_per_minute / 60
+        self.burst = max(1, burst)
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self._user_in_flight = {}
+        # user id -> waiting futures; users are served in this order and move to the back once served
+        self._waiting = OrderedDict()
+        self._buckets = OrderedDict()
+        # Moving average of how long a slot is held, for Retry-After estimates
+        self._hold_seconds = 5.0
+        self.admitted = 0
+        self.rejected = {}
+
+    def _reject(self, reason: str, retry_after: float):
+        MODEL_REJECTIONS.inc(reason=reason)
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        return ModelBusy(reason, retry_after)
+
+    def _estimated_wait(self):
+        if self.max_in_flight == math.inf:
+            return self._hold_seconds
+        return self._hold_seconds * (self.queued + 1) / self.max_in_flight
+
+    def _take_token(self, user_id: int):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.burst, now)
+            while len(self._buckets) > MAX_BUCKETS:
+                self._buckets.popitem(last=False)
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated_at) * self.rate)
+            bucket.updated_at = now
+            self._buckets.move_to_end(user_id)
+        if bucket.tokens < 1:
+            raise self._reject('rate_limited', (1 - bucket.tokens) / self.rate)
+        bucket.tokens -= 1
+
+    def _refund_token(self, user_id: int):
+        bucket = self._buckets.get(user_id)
+        if bucket is not None:
+            bucket.tokens = min(self.burst, bucket.tokens + 1)
+
+    def _has_room(self, user_id: int):
+        return self.in_flight < self.max_in_flight and self._user_in_flight.get(user_id, 0) < self.max_per_user
+
+    def _grant(self, user_id: int):
+        self.in_flight += 1
+        self._user_in_flight[user_id] = self._user_in_flight.get(user_id, 0) + 1
+        self.admitted += 1
+        return Slot(self, user_id)
+
+    def _release(self, slot: Slot):
+        self.in_flight -= 1
+        remaining = self._user_in_flight[slot.user_id] - 1
+        if remaining:
+            self._user_in_flight[slot.user_id] = remaining
+        else:
+            del self._user_in_flight[slot.user_id]
+        self._hold_seconds = 0.9 * self._hold_seconds + 0.1 * (time.monotonic() - slot.acquired_at)
+        self._dispatch()
+
+    def _dispatch(self):
+        """Hand free slots to waiting users in round-robin order."""
+        while self.in_flight < self.max_in_flight:
+            for user_id, waiters in self._waiting.items():
+                if self._user_in_flight.get(user_id, 0) < self.max_per_user:
+                    break
+            else:
+                return
+            future = waiters.popleft()
+            self.queued -= 1
+            if waiters:
+                self._waiting.move_to_end(user_id)
+            else:
+                del self._waiting[user_id]
+            # A waiter that gave up is skipped; its own handler already counted it
+            if not future.done():
+                future.set_result(self._grant(user_id))
+
+    def _withdraw(self, user_id: int, future):
+        waiters = self._waiting.get(user_id)
+        if waiters is not None and future in waiters:
+            waiters.remove(future)
+            self.queued -= 1
+            if not waiters:
+                del self._waiting[user_id]
+        self._refund_token(user_id)
+
+    async def acquire(self, user_id: int) -> Slot:
+        """Wait for a slot for one of user_id's turns, or raise ModelBusy."""
+        self._take_token(user_id)
+        if not self._waiting and self._has_room(user_id):
+            return self._grant(user_id)
+
+        waiters = self._waiting.get(user_id)
+        if waiters is not None and len(waiters) >= self.max_queued_per_user:
+            self._refund_token(user_id)
+            raise self._reject('user_queue_full', self._hold_seconds)
+        if self.queued >= self.max_queued:
+            self._refund_token(user_id)
+            raise self._reject('queue_full', self._estimated_wait())
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(user_id, deque()).append(future)
+        self.queued += 1
+        self._dispatch()
+
+        started = time.monotonic()
+        try:
+            # Shielded so a timeout leaves the future alone and a late grant can still be read
+            slot = await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            # The slot may have been granted just as the deadline passed
+            if not future.done():
+                self._withdraw(user_id, future)
+                raise self._reject('queue_timeout', self._estimated_wait())
+            slot = future.result()
+        except asyncio.CancelledError:
+            # The client went away while waiting
+            if future.done() and not future.cancelled():
+                future.result().release()
+            else:
+                self._withdraw(user_id, future)
+            raise
+        MODEL_QUEUE_SECONDS.observe(time.monotonic() - started)
+        return slot
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "users_in_flight": len(self._user_in_flight),
+            "users_waiting": len(self._waiting),
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "avg_slot_seconds": round(self._hold_seconds, 3),
+        }
+
+
+model_scheduler = ModelScheduler(
+    config.MODEL_MAX_IN_FLIGHT,
+    config.MODEL_MAX_IN_FLIGHT_PER_USER,
+    config.MODEL_USER_RATE_PER_MINUTE,
+    config.MODEL_USER_BURST,
+    config.MODEL_QUEUE_MAX,
+    config.MODEL_QUEUE_MAX_PER_USER,
+    config.MODEL_QUEUE_TIMEOUT_SECONDS,
+)
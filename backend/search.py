@@ -0,0 +1,172 @@
+"""Full-text search over chat titles and message content.
+
+SQLite uses FTS5 tables kept in sync by triggers; Postgres uses generated
+tsvector columns with GIN indexes. Any other backend falls back to ILIKE.
+
+The FTS5 tables carry an indexed ``owner`` token (``u<user_id>``) so a query
+intersects the user's posting list with the search terms instead of matching
+every user's messages and filtering afterwards.
+"""
+import re
+
+from sqlalchemy import text
+
+SNIPPET_TOKENS = 12
+TITLE_RANK_BOOST = 2.0
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+SQLITE_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(
+        content, owner, chat_id UNINDEXED, tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS chat_fts USING fts5(
+        title, owner, tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS message_fts_insert AFTER INSERT ON message BEGIN
+        INSERT INTO message_fts(rowid, content, owner, chat_id)
+        SELECT new.id, new.content, 'u' || chat.user_id, new.chat_id FROM chat WHERE chat.id = new.chat_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS message_fts_update AFTER UPDATE OF content ON message BEGIN
+        UPDATE message_fts SET content = new.content WHERE rowid = new.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS message_fts_delete AFTER DELETE ON message BEGIN
+        DELETE FROM message_fts WHERE rowid = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS chat_fts_insert AFTER INSERT ON chat BEGIN
+        INSERT INTO chat_fts(rowid, title, owner) VALUES (new.id, new.title, 'u' || new.user_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS chat_fts_update AFTER UPDATE OF title ON chat BEGIN
+        UPDATE chat_fts SET title = new.title WHERE rowid = new.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS chat_fts_delete AFTER DELETE ON chat BEGIN
+        DELETE FROM chat_fts WHERE rowid = old.id;
+    END""",
+]
+
+SQLITE_BACKFILL = [
+    """INSERT INTO message_fts(rowid, content, owner, chat_id)
+       SELECT message.id, message.content, 'u' || chat.user_id, message.chat_id
+       FROM message JOIN chat ON chat.id = message.chat_id""",
+    """INSERT INTO chat_fts(rowid, title, owner) SELECT id, title, 'u' || user_id FROM chat""",
+]
+
+POSTGRES_SCHEMA = [
+    """ALTER TABLE message ADD COLUMN IF NOT EXISTS search_vector tsvector
+       GENERATED ALWAYS AS (to_tsvector('simple', coalesce(content, ''))) STORED""",
+    """CREATE INDEX IF NOT EXISTS ix_message_search_vector ON message USING GIN (search_vector)""",
+    """ALTER TABLE chat ADD COLUMN IF NOT EXISTS search_vector tsvector
+       GENERATED ALWAYS AS (to_tsvector('simple', coalesce(title, ''))) STORED""",
+    """CREATE INDEX IF NOT EXISTS ix_chat_search_vector ON chat USING GIN (search_vector)""",
+]
+
+
+def setup_search_index(engine):
+    """Create the full-text index for this backend, filling it from existing rows once."""
+    dialect = engine.dialect.name
+    with engine.begin() as conn:
+        if dialect == 'sqlite':
+            exists = conn.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'message_fts'"
+            )).first() is not None
+            for statement in SQLITE_SCHEMA:
+                conn.execute(text(statement))
+            if not exists:
+                for statement in SQLITE_BACKFILL:
+                    conn.execute(text(statement))
+        elif dialect == 'postgresql':
+            for statement in POSTGRES_SCHEMA:
+                conn.execute(text(statement))
+
+
+def search_terms(query: str):
+    return WORD_RE.findall(query.lower())
+
+
+def fts5_query(owner: str, column: str, terms):
+    # Quote every term so user input is never parsed as FTS syntax; the last one
+    # is a prefix match because searches run as the user types
+    phrases = [f'"{term}"' for term in terms[:-1]] + [f'"{terms[-1]}"*']
+    return f'owner:{owner} AND {column}:({" ".join(phrases)})'
+
+
+def tsquery(terms):
+    return ' & '.join([f"{term}" for term in terms[:-1]] + [f"{terms[-1]}:*"])
+
+
+def search_chats(db, user_id: int, archived: bool, query: str, limit: int = 50):
+    """Return [(chat_id, snippet)] for the user's chats matching query, best match first.
+
+    Returns None when the backend has no full-text index, so the caller can fall back.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return []
+
+    dialect = db.get_bind().dialect.name
+    if dialect == 'sqlite':
+        owner = f"u{user_id}"
+        rows = db.execute(text("""
+            WITH hits AS (
+                SELECT message_fts.chat_id AS chat_id,
+                       bm25(message_fts, 1.0, 0.0) AS rank,
+                       snippet(message_fts, 0, '', '', '…', :snippet_tokens) AS snippet
+                FROM message_fts WHERE message_fts MATCH :message_query
+                UNION ALL
+                SELECT chat_fts.rowid AS chat_id,
+                       bm25(chat_fts, 1.0, 0.0) * :title_boost AS rank,
+                       NULL AS snippet
+                FROM chat_fts WHERE chat_fts MATCH :title_query
+            )
+            SELECT hits.chat_id, MIN(hits.rank) AS best_rank, hits.snippet
+            FROM hits JOIN chat ON chat.id = hits.chat_id
+            WHERE chat.archived = :archived
+            GROUP BY hits.chat_id
+            ORDER BY best_rank
+            LIMIT :limit
+        """), {
+            "message_query": fts5_query(owner, 'content', terms),
+            "title_query": fts5_query(owner, 'title', terms),
+            "snippet_tokens": SNIPPET_TOKENS,
+            "title_boost": TITLE_RANK_BOOST,
+            "archived": archived,
+            "limit": limit,
+        }).all()
+        return [(row.chat_id, row.snippet) for row in rows]
+
+    if dialect == 'postgresql':
+        rows = db.execute(text("""
+            WITH q AS (SELECT to_tsquery('simple', :query) AS query),
+            hits AS (
+                SELECT message.chat_id AS chat_id,
+                       ts_rank(message.search_vector, q.query) AS rank,
+                       message.id AS message_id
+                FROM message JOIN chat ON chat.id = message.chat_id, q
+                WHERE message.search_vector @@ q.query AND chat.user_id = :user_id AND chat.archived = :archived
+                UNION ALL
+                SELECT chat.id, ts_rank(chat.search_vector, q.query) * :title_boost, NULL
+                FROM chat, q
+                WHERE chat.search_vector @@ q.query AND chat.user_id = :user_id AND chat.archived = :archived
+            ),
+            best AS (
+                SELECT DISTINCT ON (chat_id) chat_id, rank, message_id
+                FROM hits ORDER BY chat_id, rank DESC
+            )
+            SELECT best.chat_id,
+                   CASE WHEN best.message_id IS NULL THEN NULL ELSE
+                       ts_headline('simple', message.content, q.query,
+                                   'StartSel="",StopSel="",MaxWords=' || :snippet_tokens || ',MinWords=4')
+                   END AS snippet
+            FROM best LEFT JOIN message ON message.id = best.message_id, q
+            ORDER BY best.rank DESC
+            LIMIT :limit
+        """), {
+            "query": tsquery(terms),
+            "user_id": user_id,
+            "archived": archived,
+            "snippet_tokens": SNIPPET_TOKENS,
+            "title_boost": TITLE_RANK_BOOST,
+            "limit": limit,
+        }).all()
+        return [(row.chat_id, row.snippet) for row in rows]
+
+    return None
@@ -0,0 +1,41 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py reads its settings at import time, so point everything at a scratch directory first
+_scratch = tempfile.mkdtemp(prefix="obsidian-tests-")
+os.environ.update({
+    "DATABASE_URL": f"sqlite:///{os.path.join(_scratch, 'test.db')}",
+    "UPLOAD_FOLDER": os.path.join(_scratch, "uploads"),
+    "BLOB_FOLDER": os.path.join(_scratch, "blobs"),
+    "RESPONSE_CACHE_PATH": os.path.join(_scratch, "response_cache.db"),
+    "BLOB_SQLITE_PATH": os.path.join(_scratch, "blobs.db"),
+    "METRICS_ENABLED": "False",
+    "AUTH_HASH_WORKERS": "0",
+    "PDF_WORKERS": "0",
+    "MAIL_USERNAME": "",
+    "MAIL_PASSWORD": "",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def client():
+    from fastapi.testclient import TestClient
+    import app
+
+    with TestClient(app.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def db():
+    import app
+
+    session = app.SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta
+
+import config
+from models import EmailVerification
+from passwords import hash_verification_code
+
+EMAIL = "reset@example.com"
+CODE = "123456"
+
+
+def issue_code(db):
+    db.query(EmailVerification).filter(EmailVerification.email == EMAIL).delete()
+    db.add(EmailVerification(
+        email=EMAIL,
+        code_hash=hash_verification_code(EMAIL, CODE),
+        expires_at=datetime.utcnow() + timedelta(minutes=10),
+    ))
+    db.commit()
+
+
+def reset(client, code):
+    return client.post("/api/forgot-password-reset", json={"email": EMAIL, "code": code, "new_password": "new-secret"})
+
+
+def test_password_reset_counts_wrong_codes(client, db):
+    issue_code(db)
+
+    response = reset(client, "000000")
+
+    assert response.status_code == 400
+    db.expire_all()
+    assert db.query(EmailVerification).filter(EmailVerification.email == EMAIL).one().attempts == 1
+
+
+def test_password_reset_refuses_guess_after_max_attempts(client, db):
+    issue_code(db)
+    for _ in range(config.VERIFICATION_MAX_ATTEMPTS):
+        assert reset(client, "000000").status_code == 400
+
+    # Even the right code is refused once the attempts are used up, and the code is discarded
+    response = reset(client, CODE)
+
+    assert response.status_code == 400
+    assert "Too many incorrect attempts" in response.json()["detail"]
+    db.expire_all()
+    assert db.query(EmailVerification).filter(EmailVerification.email == EMAIL).first() is None
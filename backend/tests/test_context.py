@@ -0,0 +1,22 @@
+import asyncio
+
+import app
+import config
+
+
+def test_failed_summary_keeps_turns_that_fit_the_budget(monkeypatch):
+    async def failed_summary(api_key, previous_summary, messages):
+        return None
+
+    monkeypatch.setattr(app, "summarize_messages", failed_summary)
+    turn_tokens = config.CONTEXT_TOKEN_BUDGET // 8
+    messages = [{"id": index + 1, "role": "user" if index % 2 == 0 else "assistant", "content": "", "tokens": turn_tokens}
+                for index in range(10)]
+
+    kept, summary = asyncio.run(app.fit_context_window(1, messages, "old summary"))
+
+    assert summary == "old summary"
+    assert sum(msg["tokens"] for msg in kept) <= config.CONTEXT_TOKEN_BUDGET
+    # Folding would cut down to the smaller summary target; without a summary the whole budget is used
+    assert len(kept) > len(messages) - app.plan_fold(messages)
+    assert kept[-1] is messages[-1]
@@ -0,0 +1,21 @@
+import pytest
+
+pytest.importorskip("PIL")
+from PIL import Image
+
+import images
+from uploads import upload_path
+
+
+def test_failed_variant_save_falls_back_to_original(monkeypatch):
+    filename = "variant-failure.png"
+    Image.new("RGB", (64, 64), "red").save(upload_path(filename))
+
+    def broken_save(*args, **kwargs):
+        raise OSError("encoder not available")
+
+    monkeypatch.setattr(images, "save_image", broken_save)
+    images.build_variants(filename)
+
+    assert images.model_filename(filename) == filename
+    assert images.variant_urls(filename) == {}
@@ -0,0 +1,14 @@
+def test_prometheus_metrics_hidden_when_disabled(client):
+    assert client.get("/metrics").status_code == 404
+
+
+def test_db_pool_metrics_hidden_when_disabled(client):
+    assert client.get("/api/metrics/db-pool").status_code == 404
+
+
+def test_response_cache_metrics_hidden_when_disabled(client):
+    assert client.get("/api/metrics/response-cache").status_code == 404
+
+
+def test_model_scheduler_metrics_hidden_when_disabled(client):
+    assert client.get("/api/metrics/model-scheduler").status_code == 404
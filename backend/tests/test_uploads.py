@@ -0,0 +1,37 @@
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from uploads import UploadSizeLimitMiddleware
+
+LIMIT = 1024
+
+
+def limited_client():
+    limited_app = FastAPI()
+
+    @limited_app.post("/upload")
+    async def upload(request: Request):
+        return {"size": len(await request.body())}
+
+    limited_app.add_middleware(UploadSizeLimitMiddleware, path="/upload", max_bytes=LIMIT)
+    return TestClient(limited_app)
+
+
+def chunks(total, size=16 * 1024):
+    for start in range(0, total, size):
+        yield b"x" * min(size, total - start)
+
+
+def test_chunked_upload_over_limit_is_refused():
+    # A generator body is sent chunked, with no Content-Length to check up front
+    total = LIMIT + UploadSizeLimitMiddleware.FORM_OVERHEAD_BYTES + 1
+    response = limited_client().post("/upload", content=chunks(total))
+
+    assert response.status_code == 413
+
+
+def test_chunked_upload_within_limit_passes():
+    response = limited_client().post("/upload", content=chunks(LIMIT))
+
+    assert response.status_code == 200
+    assert response.json() == {"size": LIMIT}
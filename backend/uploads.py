@@ -0,0 +1,213 @@
+"""Content-addressed storage for uploaded files.
+
+Uploads are named by the SHA-256 of their bytes, so the same file uploaded
+twice is stored once. Because a content-addressed file never changes, its
+base64 encoding can be cached and reused on every later turn of a chat.
+
+Uploads are copied to disk in chunks and hashed on the way, so memory use does
+not grow with file size and oversized files are rejected part-way through.
+"""
+import base64
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+from starlette.responses import JSONResponse
+
+import config
+from metrics import cache_lookup
+
+CONTENT_HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class _BodyTooLarge(Exception):
+    pass
+
+
+class UploadSizeLimitMiddleware:
+    """Reject an upload over the limit before its whole body is read.
+
+    Multipart bodies are spooled by the form parser before the route runs, so the
+    limit has to be applied here. A declared Content-Length over the limit is turned
+    away without reading anything; a body without one (chunked) is counted as it is
+    received and cut off with the same 413 once the running total passes the limit.
+    """
+
+    # Room for the multipart boundaries and part headers around the file itself
+    FORM_OVERHEAD_BYTES = 64 * 1024
+
+    def __init__(self, app, path: str, max_bytes: int):
+        self.app = app
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def _too_large(self):
+        return JSONResponse(
+            {"detail": f"File exceeds the {self.max_bytes // (1024 * 1024)} MB upload limit"},
+            status_code=413
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            await self.app(scope, receive, send)
+            return
+
+        limit = self.max_bytes + self.FORM_OVERHEAD_BYTES
+        length = dict(scope["headers"]).get(b"content-length")
+        if length and length.isdigit() and int(length) > limit:
+            await self._too_large()(scope, receive, send)
+            return
+
+        received = 0
+        too_large = False
+        started = False
+
+        async def limited_receive():
+            nonlocal received, too_large
+            message = await receive()
+            if message["type"] == "http.request" and not started:
+                received += len(message.get("body", b""))
+                if received > limit:
+                    too_large = True
+                    raise _BodyTooLarge()
+            return message
+
+        async def guarded_send(message):
+            nonlocal started
+            # The form parser turns the cut-off body into its own error; the 413 below replaces it
+            if too_large:
+                return
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            # Whatever the cut-off body turned into on the way out, the answer is the 413
+            if not too_large:
+                raise
+        if too_large:
+            await self._too_large()(scope, receive, send)
+
+
+def upload_path(filename: str) -> Path:
+    # Only ever resolve names inside the upload folder
+    return config.UPLOAD_FOLDER_PATH / Path(filename).name
+
+
+def is_content_addressed(filename: str) -> bool:
+    return bool(CONTENT_HASH_RE.match(Path(filename).stem))
+
+
+def guess_extension(content_type: str, original_name: str = None) -> str:
+    ext = mimetypes.guess_extension(content_type or '') if content_type else None
+    if not ext and original_name:
+        ext = Path(original_name).suffix.lower()
+    return ext or '.jpg'
+
+
+def save_upload(source, content_type: str, original_name: str = None, max_bytes: int = None):
+    """Copy a binary file object into storage under its content hash.
+
+    Returns (filename, size); filename is None for an empty file. Raises
+    UploadTooLarge as soon as more than max_bytes have been read.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    tmp_path = config.UPLOAD_FOLDER_PATH / f".upload.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "wb") as buffer:
+            while True:
+                chunk = source.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    raise UploadTooLarge(f"File exceeds the {max_bytes // (1024 * 1024)} MB upload limit")
+                digest.update(chunk)
+                buffer.write(chunk)
+        if size == 0:
+            return None, 0
+
+        filename = f"{digest.hexdigest()}{guess_extension(content_type, original_name)}"
+        file_path = upload_path(filename)
+        if not file_path.exists():
+            os.replace(tmp_path, file_path)
+        return filename, size
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+class Base64Cache:
+    """Thread-safe LRU of base64 payloads, bounded by total encoded size."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+        cache_lookup('base64', value is not None)
+        return value
+
+    def put(self, key, value: str):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= len(self._entries.pop(key))
+            self._entries[key] = value
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= len(evicted)
+
+
+base64_cache = Base64Cache(config.UPLOAD_BASE64_CACHE_MB * 1024 * 1024)
+
+
+def read_upload_base64(filename: str):
+    """Return the stored file as base64, or None if it is missing or empty."""
+    file_path = upload_path(filename)
+    try:
+        if is_content_addressed(filename):
+            key = file_path.name
+        else:
+            # Legacy uuid-named uploads are keyed on their stat so edits are noticed
+            stat = file_path.stat()
+            key = (file_path.name, stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        return None
+
+    cached = base64_cache.get(key)
+    if cached is not None:
+        return cached
+
+    try:
+        with open(file_path, 'rb') as f:
+            file_content = f.read()
+    except FileNotFoundError:
+        return None
+    if not file_content:
+        return None
+
+    encoded = base64.b64encode(file_content).decode('utf-8')
+    base64_cache.put(key, encoded)
+    return encoded
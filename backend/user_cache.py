@@ -0,0 +1,129 @@
+"""Short-lived snapshots of the signed-in user.
+
+Authenticated routes used to SELECT the user row on every request. A snapshot
+(id, username, email, memory; never the password hash) is now kept in-process
+for ``USER_CACHE_TTL_SECONDS``. With ``SESSION_USER_CLAIMS`` the snapshot is
+also written into the signed session cookie, so a worker that has not seen the
+user yet can trust it for ``SESSION_CLAIMS_MAX_AGE_SECONDS`` without a query.
+
+Changes made through the API drop the cached copy and rewrite the claims; other
+workers pick them up once their own copy expires.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import config
+from metrics import cache_lookup
+
+# Keep the session cookie well under the 4 KB browser limit; larger snapshots stay server-side
+CLAIMS_MAX_CHARS = 1500
+
+
+class SessionUser:
+    """Read-only view of a user; load the User row for anything that writes."""
+
+    __slots__ = ('id', 'username', 'email', 'user_memory')
+
+    def __init__(self, id: int, username: str, email: str, user_memory=None):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.user_memory = user_memory
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.username, user.email, user.user_memory)
+
+    @classmethod
+    def from_claims(cls, claims):
+        return cls(claims['id'], claims['username'], claims['email'], claims.get('user_memory'))
+
+    def to_claims(self):
+        return {
+            'id': self.id,
+            'username': self.username,
+            'email': self.email,
+            'user_memory': self.user_memory,
+            'iat': time.time()
+        }
+
+
+class UserCache:
+    def __init__(self, ttl_seconds: int, max_users: int, claims_max_age: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_users = max_users
+        self.claims_max_age = claims_max_age
+        self._entries = OrderedDict()
+        # Oldest change first; claims issued before the oldest entry have expired anyway
+        self._changed_at = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int):
+        with self._lock:
+            cached = self._entries.get(user_id)
+            snapshot = None
+            if cached is not None:
+                if cached[0] < time.monotonic():
+                    del self._entries[user_id]
+                else:
+                    self._entries.move_to_end(user_id)
+                    snapshot = cached[1]
+        cache_lookup('user', snapshot is not None)
+        return snapshot
+
+    def put(self, snapshot: SessionUser):
+        if self.ttl_seconds <= 0:
+            return
+        with self._lock:
+            self._entries[snapshot.id] = (time.monotonic() + self.ttl_seconds, snapshot)
+            self._entries.move_to_end(snapshot.id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        """Drop the snapshot and reject session claims issued before this change."""
+        with self._lock:
+            self._entries.pop(user_id, None)
+            now = time.time()
+            self._changed_at[user_id] = now
+            self._changed_at.move_to_end(user_id)
+            while next(iter(self._changed_at.values())) + self.claims_max_age < now:
+                self._changed_at.popitem(last=False)
+
+    def changed_at(self, user_id: int) -> float:
+        with self._lock:
+            return self._changed_at.get(user_id, 0.0)
+
+
+user_cache = UserCache(config.USER_CACHE_TTL_SECONDS, config.USER_CACHE_MAX_USERS, config.SESSION_CLAIMS_MAX_AGE_SECONDS)
+
+
+def remember_user(session, user) -> SessionUser:
+    """Sign the user in to session and refresh their cached snapshot and claims."""
+    snapshot = SessionUser.from_user(user)
+    user_cache.put(snapshot)
+    session['user_id'] = user.id
+    session.pop('user_claims', None)
+    if config.SESSION_USER_CLAIMS:
+        claims = snapshot.to_claims()
+        if len(json.dumps(claims)) <= CLAIMS_MAX_CHARS:
+            session['user_claims'] = claims
+    return snapshot
+
+
+def cached_session_user(session, user_id: int):
+    """The user's snapshot from this process or from fresh session claims, else None."""
+    snapshot = user_cache.get(user_id)
+    if snapshot is not None:
+        return snapshot
+    claims = session.get('user_claims')
+    if not config.SESSION_USER_CLAIMS or not isinstance(claims, dict) or claims.get('id') != user_id:
+        return None
+    issued_at = claims.get('iat', 0)
+    if issued_at + config.SESSION_CLAIMS_MAX_AGE_SECONDS < time.time() or issued_at < user_cache.changed_at(user_id):
+        return None
+    snapshot = SessionUser.from_claims(claims)
+    user_cache.put(snapshot)
+    return snapshot
@@ -0,0 +1,11 @@
+"""Names and vocabulary shared by the data generator and the load scenarios."""
+
+BENCH_PASSWORD = "bench-password"
+VOCABULARY = ("python fastapi database index latency throughput kubernetes docker invoice revenue "
+              "photo receipt diagram error stacktrace timeout cache memory thread process queue "
+              "gradient tensor model training dataset recipe travel budget schedule contract").split()
+FILLER = "the a to of and in is for on with that this it as be are was".split()
+
+
+def username(index: int) -> str:
+    return f"bench{index}"
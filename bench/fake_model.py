@@ -0,0 +1,119 @@
+"""Local stand-in for the Gemini API, for benchmarks and offline runs.
+
+Serves ``generateContent``, ``streamGenerateContent`` (SSE) and the resumable
+file upload used by the backend, with configurable latency, streaming speed
+and error injection. Point the backend at it with::
+
+    GEMINI_API_BASE=http://127.0.0.1:8765/v1beta
+    GEMINI_UPLOAD_URL=http://127.0.0.1:8765/upload/v1beta/files
+
+Usage: python bench/fake_model.py --latency-ms 300 --tokens 200 --token-interval-ms 10 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+WORDS = ("the model answers with a steady stream of plausible words so that reply sizes "
+         "and streaming behave like a real generation would under load").split()
+
+parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("--port", type=int, default=8765)
+parser.add_argument("--latency-ms", type=float, default=300, help="time to first token (or to the full reply)")
+parser.add_argument("--jitter-ms", type=float, default=100, help="uniform random extra latency")
+parser.add_argument("--tokens", type=int, default=200, help="words per reply")
+parser.add_argument("--token-interval-ms", type=float, default=10, help="delay between streamed words")
+parser.add_argument("--chunk-tokens", type=int, default=8, help="words per streamed chunk")
+parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls that fail")
+parser.add_argument("--error-status", type=int, default=503, help="HTTP status of injected failures")
+parser.add_argument("--seed", type=int, default=None)
+args = parser.parse_args()
+
+random.seed(args.seed)
+app = FastAPI()
+stats = {"generate": 0, "stream": 0, "upload": 0, "errors": 0}
+
+
+def reply_words():
+    return [random.choice(WORDS) for _ in range(args.tokens)]
+
+
+def candidate(text):
+    return {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}]}
+
+
+async def wait_first_token():
+    await asyncio.sleep((args.latency_ms + random.uniform(0, args.jitter_ms)) / 1000)
+
+
+def injected_error():
+    if args.error_rate and random.random() < args.error_rate:
+        stats["errors"] += 1
+        return JSONResponse(
+            {"error": {"code": args.error_status, "message": "Injected failure", "status": "UNAVAILABLE"}},
+            status_code=args.error_status
+        )
+    return None
+
+
+@app.post("/v1beta/models/{model_action}")
+async def generate(model_action: str, request: Request):
+    await request.body()
+    error = injected_error()
+    if error is not None:
+        await wait_first_token()
+        return error
+
+    if model_action.endswith(":streamGenerateContent"):
+        stats["stream"] += 1
+        words = reply_words()
+
+        async def events():
+            await wait_first_token()
+            for start in range(0, len(words), args.chunk_tokens):
+                if start:
+                    await asyncio.sleep(args.token_interval_ms * args.chunk_tokens / 1000)
+                text = " ".join(words[start:start + args.chunk_tokens]) + " "
+                yield f"data: {json.dumps(candidate(text))}\r\n\r\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    stats["generate"] += 1
+    # A blocking call returns once the whole reply would have been generated
+    await wait_first_token()
+    await asyncio.sleep(args.token_interval_ms * args.tokens / 1000)
+    return candidate(" ".join(reply_words()))
+
+
+@app.post("/upload/v1beta/files")
+async def start_upload(request: Request):
+    await request.body()
+    session = uuid.uuid4().hex
+    return JSONResponse({}, headers={"x-goog-upload-url": f"http://{args.host}:{args.port}/upload/sessions/{session}"})
+
+
+@app.post("/upload/sessions/{session}")
+async def finish_upload(session: str, request: Request):
+    content = await request.body()
+    stats["upload"] += 1
+    return {"file": {
+        "uri": f"https://fake-model/files/{hashlib.sha256(content).hexdigest()[:16]}",
+        "expirationTime": "2099-01-01T00:00:00.000Z",
+        "state": "ACTIVE"
+    }}
+
+
+@app.get("/stats")
+def get_stats():
+    return stats
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,194 @@
+"""Scripted load scenarios against a running backend.
+
+Each scenario runs ``--concurrency`` virtual users for ``--duration`` seconds
+(after ``--warmup`` seconds whose results are dropped) and reports latency
+percentiles and throughput. Virtual users sign in as the synthetic ``benchN``
+accounts created by ``seed.py``.
+
+Scenarios:
+    login      fresh session per request: POST /api/login (password hashing)
+    sidebar    GET /api/chats, the chat list refresh
+    long-chat  POST a message to the user's longest chat (add --stream for SSE)
+    search     GET /api/chats?search=<word>, ranked full-text search
+
+Save a run with ``--json before.json``, make the change, then run again with
+``--compare before.json`` to print the difference.
+
+    python bench/scenarios.py --scenario all --concurrency 20 --duration 30 --json before.json
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+import httpx
+
+from common import BENCH_PASSWORD, VOCABULARY, username
+
+SCENARIOS = ["login", "sidebar", "long-chat", "search"]
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(fraction * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(name, latencies, errors, elapsed):
+    values = sorted(latencies)
+    return {
+        "scenario": name,
+        "requests": len(values),
+        "errors": errors,
+        "throughput_rps": round(len(values) / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(sum(values) / len(values) * 1000, 2) if values else 0.0,
+        "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+        "max_ms": round(values[-1] * 1000, 2) if values else 0.0,
+    }
+
+
+async def sign_in(client, index: int):
+    response = await client.post("/api/login", json={"username": username(index), "password": BENCH_PASSWORD})
+    response.raise_for_status()
+
+
+async def longest_chat(client):
+    response = await client.get("/api/chats", params={"limit": 200})
+    response.raise_for_status()
+    chats = response.json()["chats"]
+    if not chats:
+        raise RuntimeError("Seeded user has no chats; run seed.py first")
+    return max(chats, key=lambda chat: chat["message_count"])["id"]
+
+
+class VirtualUser:
+    def __init__(self, args, index: int):
+        self.args = args
+        self.index = index % args.users
+        self.rng = random.Random(args.seed + index)
+        self.client = httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout)
+        self.chat_id = None
+
+    async def setup(self, scenario: str):
+        if scenario != "login":
+            await sign_in(self.client, self.index)
+        if scenario == "long-chat":
+            self.chat_id = await longest_chat(self.client)
+
+    async def run_once(self, scenario: str):
+        if scenario == "login":
+            # A new client has no session cookie, like a user signing in from scratch
+            async with httpx.AsyncClient(base_url=self.args.base_url, timeout=self.args.timeout) as client:
+                await sign_in(client, self.index)
+        elif scenario == "sidebar":
+            (await self.client.get("/api/chats")).raise_for_status()
+        elif scenario == "search":
+            params = {"search": self.rng.choice(VOCABULARY)}
+            (await self.client.get("/api/chats", params=params)).raise_for_status()
+        elif scenario == "long-chat":
+            content = " ".join(self.rng.choice(VOCABULARY) for _ in range(12)) + "?"
+            url = f"/api/chats/{self.chat_id}/messages"
+            if self.args.stream:
+                async with self.client.stream("POST", url, params={"stream": "true"}, json={"content": content}) as response:
+                    response.raise_for_status()
+                    body = "".join([chunk async for chunk in response.aiter_text()])
+                if "event: done" not in body:
+                    raise RuntimeError("Stream ended without a reply")
+            else:
+                (await self.client.post(url, json={"content": content})).raise_for_status()
+
+    async def close(self):
+        await self.client.aclose()
+
+
+async def run_scenario(args, scenario: str):
+    users = [VirtualUser(args, index) for index in range(args.concurrency)]
+    await asyncio.gather(*[user.setup(scenario) for user in users])
+
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    measure_from = started + args.warmup
+    stop_at = measure_from + args.duration
+
+    async def worker(user):
+        nonlocal errors
+        while True:
+            begin = time.perf_counter()
+            if begin >= stop_at:
+                return
+            try:
+                await user.run_once(scenario)
+                failed = False
+            except Exception as error:
+                failed = True
+                if args.verbose:
+                    print(f"[Error] {scenario}: {error}", file=sys.stderr)
+            if begin >= measure_from:
+                if failed:
+                    errors += 1
+                else:
+                    latencies.append(time.perf_counter() - begin)
+
+    await asyncio.gather(*[worker(user) for user in users])
+    await asyncio.gather(*[user.close() for user in users])
+    return summarize(scenario, latencies, errors, args.duration)
+
+
+def print_table(results, baseline=None):
+    columns = ["requests", "errors", "throughput_rps", "p50_ms", "p95_ms", "p99_ms", "max_ms"]
+    print(f"{'scenario':<10} " + " ".join(f"{column:>14}" for column in columns))
+    for result in results:
+        print(f"{result['scenario']:<10} " + " ".join(f"{result[column]:>14}" for column in columns))
+        before = (baseline or {}).get(result["scenario"])
+        if before:
+            deltas = []
+            for column in columns:
+                if before.get(column):
+                    deltas.append(f"{(result[column] - before[column]) / before[column] * 100:>+13.1f}%")
+                else:
+                    deltas.append(f"{'-':>14}")
+            print(f"{'  vs base':<10} " + " ".join(deltas))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Run load scenarios against the backend.")
+    parser.add_argument("--base-url", default="http://127.0.0.1:5000")
+    parser.add_argument("--scenario", choices=SCENARIOS + ["all"], default="all")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=20, help="measured seconds per scenario")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds run before measuring")
+    parser.add_argument("--users", type=int, default=50, help="seeded benchN accounts to spread load over")
+    parser.add_argument("--stream", action="store_true", help="long-chat: request the reply as SSE")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results file from an earlier run to compare against")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--verbose", action="store_true", help="print every failed request")
+    args = parser.parse_args()
+
+    scenarios = SCENARIOS if args.scenario == "all" else [args.scenario]
+    results = []
+    for scenario in scenarios:
+        print(f"Running {scenario} with {args.concurrency} users for {args.duration:g}s", file=sys.stderr)
+        results.append(await run_scenario(args, scenario))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {result["scenario"]: result for result in json.load(f)["results"]}
+    print_table(results, baseline)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,149 @@
+"""Fill the configured database with synthetic users, chats, messages and attachments.
+
+Users are named ``bench0``, ``bench1``, ... with password ``common.BENCH_PASSWORD``. Each
+user's first chat is a long one (``--long-chat-messages``) for the long-chat
+scenario; the rest get ``--messages-per-chat``. Message text is drawn from a
+fixed vocabulary, so search terms from ``common.VOCABULARY`` always have hits.
+
+Runs against DATABASE_URL / UPLOAD_FOLDER from the backend's environment, so
+point those at a scratch location first:
+
+    DATABASE_URL=sqlite:///bench.db python bench/seed.py --users 200 --chats-per-user 50
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import struct
+import sys
+import time
+import zlib
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+from werkzeug.security import generate_password_hash
+
+from context import estimate_tokens
+from database import create_db_engine
+from logs import configure_logging
+from migrations import migrate
+from models import Chat, Message, User
+from uploads import save_upload
+
+from common import BENCH_PASSWORD, FILLER, VOCABULARY, username
+
+logger = logging.getLogger("bench.seed")
+
+
+def sentence(rng, words: int) -> str:
+    return " ".join(rng.choice(VOCABULARY) if rng.random() < 0.4 else rng.choice(FILLER) for _ in range(words))
+
+
+def tiny_png(rng) -> bytes:
+    """A valid 8x8 RGB PNG with random pixels, so every attachment has its own hash."""
+    raw = b"".join(b"\x00" + bytes(rng.randrange(256) for _ in range(24)) for _ in range(8))
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", 8, 8, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b"")
+
+
+def make_attachments(rng, count: int):
+    attachments = []
+    for _ in range(count):
+        filename, _ = save_upload(io.BytesIO(tiny_png(rng)), "image/png", "bench.png")
+        attachments.append({"filename": filename, "url": f"/uploads/{filename}", "type": "image/png", "name": "bench.png"})
+    return attachments
+
+
+def chat_messages(rng, chat_id: int, count: int, started: datetime, attachments, attachment_rate: float):
+    rows = []
+    for index in range(count):
+        role = "user" if index % 2 == 0 else "assistant"
+        content = sentence(rng, rng.randint(8, 40) if role == "user" else rng.randint(60, 300))
+        image_data = None
+        if role == "user" and attachments and rng.random() < attachment_rate:
+            image_data = json.dumps([rng.choice(attachments)])
+        rows.append({
+            "chat_id": chat_id,
+            "role": role,
+            "content": content,
+            "image_data": image_data,
+            "token_count": estimate_tokens(content, image_data),
+            "created_at": started + timedelta(seconds=30 * index),
+        })
+    return rows
+
+
+def seed(engine, args):
+    rng = random.Random(args.seed)
+    password_hash = generate_password_hash(BENCH_PASSWORD)
+    attachments = make_attachments(rng, args.attachments)
+    now = datetime.utcnow()
+    started = time.perf_counter()
+    total_messages = 0
+
+    for user_index in range(args.users):
+        with Session(engine) as db:
+            user = db.query(User).filter(User.username == username(user_index)).first()
+            if user is None:
+                user = User(username=username(user_index), email=f"{username(user_index)}@bench.local",
+                            password_hash=password_hash)
+                db.add(user)
+                db.flush()
+            elif not args.append:
+                continue
+
+            messages = []
+            for chat_index in range(args.chats_per_user):
+                chat_started = now - timedelta(days=rng.uniform(0, 90))
+                count = args.long_chat_messages if chat_index == 0 else args.messages_per_chat
+                chat = Chat(user_id=user.id, title=sentence(rng, 5)[:200], created_at=chat_started,
+                            updated_at=chat_started + timedelta(seconds=30 * count),
+                            archived=rng.random() < args.archived_rate)
+                db.add(chat)
+                db.flush()
+                messages.extend(chat_messages(rng, chat.id, count, chat_started, attachments, args.attachment_rate))
+            if messages:
+                db.execute(insert(Message), messages)
+            db.commit()
+            total_messages += len(messages)
+        if (user_index + 1) % 10 == 0 or user_index + 1 == args.users:
+            logger.info("Seeded %d/%d users, %d messages (%.1fs)",
+                        user_index + 1, args.users, total_messages, time.perf_counter() - started)
+    return total_messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic benchmark data.")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--chats-per-user", type=int, default=20)
+    parser.add_argument("--messages-per-chat", type=int, default=20)
+    parser.add_argument("--long-chat-messages", type=int, default=400)
+    parser.add_argument("--attachments", type=int, default=20, help="distinct image files shared by all users")
+    parser.add_argument("--attachment-rate", type=float, default=0.1, help="share of user messages with an image")
+    parser.add_argument("--archived-rate", type=float, default=0.1)
+    parser.add_argument("--append", action="store_true", help="add chats to users that already exist")
+    parser.add_argument("--recall", action="store_true", help="also build recall embeddings for the new messages")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    configure_logging()
+    engine = create_db_engine()
+    migrate(engine)
+    seed(engine, args)
+    if args.recall:
+        from recall import backfill, recall_enabled
+        if recall_enabled():
+            backfill(engine)
+
+
+if __name__ == "__main__":
+    main()
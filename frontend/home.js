@@ -1,6 +1,8 @@
 const API_BASE_URL = '/api';
 
 let currentChatId = null;
+let messagesNextCursor = null;
+let loadingOlderMessages = false;
 let currentFiles = []; // Array of {name, data, type}
 let chats = [];
 
@@ -61,7 +63,8 @@ async function handlePaste(event) {
                             const data = await response.json();
                             placeholder.filename = data.filename;
                             placeholder.url = data.url;
-                            placeholder.data = data.base64;
+                            placeholder.thumbnail_url = data.thumbnail_url;
+                            placeholder.preview_url = data.preview_url;
                             placeholder.isLoading = false;
                         } else {
                             const errorData = await response.json();
@@ -83,6 +86,22 @@ async function handlePaste(event) {
 // Check authentication on page load
 window.addEventListener('DOMContentLoaded', () => {
     checkAuth();
+
+    // Fetch the next page of chats when the sidebar is scrolled near its end
+    const chatsList = document.getElementById('chats-list');
+    chatsList.addEventListener('scroll', () => {
+        if (chatsList.scrollTop + chatsList.clientHeight >= chatsList.scrollHeight - 100) {
+            loadMoreChats();
+        }
+    });
+
+    // Fetch older messages when the conversation is scrolled near its top
+    const messagesContainer = document.getElementById('messages-container');
+    messagesContainer.addEventListener('scroll', () => {
+        if (messagesContainer.scrollTop < 100) {
+            loadOlderMessages();
+        }
+    });
 });
 
 async function checkAuth() {
@@ -129,15 +148,24 @@ async function checkAuth() {
 
 
 let showArchived = false;
+let chatsNextCursor = null;
+let loadingMoreChats = false;
 
-async function loadChats() {
+// Loads the first page of chats, or the next page when append is true
+async function loadChats(append = false) {
     try {
-        const response = await fetch(`${API_BASE_URL}/chats?archived=${showArchived}`, {
+        let url = `${API_BASE_URL}/chats?archived=${showArchived}`;
+        if (append && chatsNextCursor) {
+            url += `&cursor=${encodeURIComponent(chatsNextCursor)}`;
+        }
+        const response = await fetch(url, {
             credentials: 'include'
         });
 
         if (response.ok) {
-            chats = await response.json();
+            const data = await response.json();
+            chats = append ? chats.concat(data.chats) : data.chats;
+            chatsNextCursor = data.next_cursor;
             renderChats();
         }
     } catch (error) {
@@ -145,6 +173,16 @@ async function loadChats() {
     }
 }
 
+async function loadMoreChats() {
+    if (!chatsNextCursor || loadingMoreChats) return;
+    loadingMoreChats = true;
+    try {
+        await loadChats(true);
+    } finally {
+        loadingMoreChats = false;
+    }
+}
+
 function toggleArchivedView() {
     showArchived = !showArchived;
     const toggleText = document.getElementById('archive-toggle-text');
@@ -169,6 +207,15 @@ function renderChats() {
         chatItem.innerHTML = `
             <span class="chat-item-title" onclick="loadChat(${chat.id})">${chat.title}</span>
         `;
+        // Search results carry a snippet of the best matching message
+        if (chat.snippet) {
+            chatItem.classList.add('has-snippet');
+            const snippet = document.createElement('span');
+            snippet.className = 'chat-item-snippet';
+            snippet.textContent = chat.snippet;
+            snippet.onclick = () => loadChat(chat.id);
+            chatItem.appendChild(snippet);
+        }
         chatsList.appendChild(chatItem);
     });
 }
@@ -187,6 +234,7 @@ async function createNewChat() {
         if (response.ok) {
             const chat = await response.json();
             currentChatId = chat.id;
+            messagesNextCursor = null;
             document.getElementById('chat-title').textContent = chat.title;
 
             // Save to persistence
@@ -214,6 +262,7 @@ async function createNewChat() {
                             });
                             if (currentChatId === chat.id) {
                                 currentChatId = null;
+                                messagesNextCursor = null;
                                 document.getElementById('messages-container').innerHTML = WELCOME_HTML;
                             }
                             await loadChats();
@@ -248,7 +297,8 @@ async function loadChat(chatId) {
             localStorage.setItem('lastChatId', chat.id);
             window.location.hash = chat.id;
 
-            // Render messages
+            // Render the newest page; older messages load when scrolled to the top
+            messagesNextCursor = chat.next_cursor;
             renderMessages(chat.messages);
 
             // Update active chat in sidebar
@@ -277,118 +327,159 @@ function renderMessages(messages) {
     }
 
     messages.forEach(message => {
-        const messageDiv = document.createElement('div');
-        messageDiv.className = `message ${message.role}`;
-
-        const content = document.createElement('div');
-        content.className = 'message-content';
-
-        // Handle multiple images/files
-        let imageData = message.image_data;
-        if (typeof imageData === 'string') {
-            try {
-                imageData = JSON.parse(imageData);
-            } catch (e) {
-                // leave as-is for backward compatibility
-            }
+        messagesContainer.appendChild(createMessageElement(message));
+    });
+}
+
+// Insert an older page of messages above the current ones, keeping the view where it was
+function prependMessages(messages) {
+    const messagesContainer = document.getElementById('messages-container');
+    const previousHeight = messagesContainer.scrollHeight;
+    const fragment = document.createDocumentFragment();
+    messages.forEach(message => {
+        fragment.appendChild(createMessageElement(message));
+    });
+    messagesContainer.insertBefore(fragment, messagesContainer.firstChild);
+    messagesContainer.scrollTop += messagesContainer.scrollHeight - previousHeight;
+}
+
+async function loadOlderMessages() {
+    if (!currentChatId || !messagesNextCursor || loadingOlderMessages) return;
+    loadingOlderMessages = true;
+    const chatId = currentChatId;
+    try {
+        const response = await fetch(`${API_BASE_URL}/chats/${chatId}/messages?before=${messagesNextCursor}`, {
+            credentials: 'include'
+        });
+        if (response.ok && chatId === currentChatId) {
+            const data = await response.json();
+            messagesNextCursor = data.next_cursor;
+            prependMessages(data.messages);
         }
+    } catch (error) {
+        console.error('Failed to load older messages:', error);
+    } finally {
+        loadingOlderMessages = false;
+    }
+}
 
-        // Create image container first
-        const imageContainer = document.createElement('div');
-        imageContainer.className = 'message-images';
-
-        if (imageData) {
-            if (Array.isArray(imageData)) {
-                imageData.forEach((fileData, index) => {
-                    if (fileData.type && fileData.type.startsWith('image/')) {
-                        const img = document.createElement('img');
-                        // Use URL if available (from filename), otherwise fallback to base64
-                        if (fileData.filename) {
-                            // Construct URL from filename
-                            img.src = `/uploads/${fileData.filename}`;
-                        } else if (fileData.url) {
-                            img.src = fileData.url;
-                        } else if (fileData.data) {
-                            img.src = `data:${fileData.type};base64,${fileData.data}`;
-                        }
-                        img.className = 'message-image';
-                        img.alt = fileData.name || 'Uploaded image';
-                        img.onerror = function () {
-                            // Fallback if image fails to load
-                            if (fileData.data) {
-                                this.src = `data:${fileData.type};base64,${fileData.data}`;
-                            } else {
-                                this.alt = 'Image failed to load';
-                            }
-                        };
-                        imageContainer.appendChild(img);
-                    } else if (fileData.type === 'application/pdf') {
-                        const pdfInfo = document.createElement('div');
-                        pdfInfo.className = 'file-info-message';
-                        pdfInfo.style.cssText = 'padding: 0.5rem; background: rgba(0,0,0,0.05); border-radius: 6px; margin: 0.25rem 0;';
-                        pdfInfo.textContent = `${fileData.name || 'PDF File'} (PDF)`;
-                        imageContainer.appendChild(pdfInfo);
-                    }
-                });
-            } else if (imageData.data && imageData.type) {
-                // Single file object (backward compatibility)
-                if (imageData.type.startsWith('image/')) {
+function createMessageElement(message) {
+    const messageDiv = document.createElement('div');
+    messageDiv.className = `message ${message.role}`;
+
+    const content = document.createElement('div');
+    content.className = 'message-content';
+
+    // Handle multiple images/files
+    let imageData = message.image_data;
+    if (typeof imageData === 'string') {
+        try {
+            imageData = JSON.parse(imageData);
+        } catch (e) {
+            // leave as-is for backward compatibility
+        }
+    }
+
+    // Create image container first
+    const imageContainer = document.createElement('div');
+    imageContainer.className = 'message-images';
+
+    if (imageData) {
+        if (Array.isArray(imageData)) {
+            imageData.forEach((fileData, index) => {
+                if (fileData.type && fileData.type.startsWith('image/')) {
                     const img = document.createElement('img');
-                    if (imageData.filename) {
-                        img.src = `/uploads/${imageData.filename}`;
-                    } else if (imageData.url) {
-                        img.src = imageData.url;
-                    } else if (imageData.data) {
-                        img.src = `data:${imageData.type};base64,${imageData.data}`;
+                    // Prefer the downscaled preview, then the original (from filename or URL), then base64
+                    const originalSrc = fileData.filename ? `/uploads/${fileData.filename}` : fileData.url;
+                    if (fileData.preview_url) {
+                        img.src = fileData.preview_url;
+                    } else if (fileData.filename) {
+                        // Construct URL from filename
+                        img.src = `/uploads/${fileData.filename}`;
+                    } else if (fileData.url) {
+                        img.src = fileData.url;
+                    } else if (fileData.data) {
+                        img.src = `data:${fileData.type};base64,${fileData.data}`;
                     }
                     img.className = 'message-image';
-                    img.alt = imageData.name || 'Uploaded image';
+                    img.alt = fileData.name || 'Uploaded image';
                     img.onerror = function () {
-                        if (imageData.data) {
-                            this.src = `data:${imageData.type};base64,${imageData.data}`;
+                        // Fallback if image fails to load
+                        if (fileData.preview_url && originalSrc && this.src.indexOf(fileData.preview_url) !== -1) {
+                            this.src = originalSrc;
+                        } else if (fileData.data) {
+                            this.src = `data:${fileData.type};base64,${fileData.data}`;
                         } else {
                             this.alt = 'Image failed to load';
                         }
                     };
                     imageContainer.appendChild(img);
-                } else if (imageData.type === 'application/pdf') {
+                } else if (fileData.type === 'application/pdf') {
                     const pdfInfo = document.createElement('div');
                     pdfInfo.className = 'file-info-message';
                     pdfInfo.style.cssText = 'padding: 0.5rem; background: rgba(0,0,0,0.05); border-radius: 6px; margin: 0.25rem 0;';
-                    pdfInfo.textContent = `${imageData.name || 'PDF File'} (PDF)`;
+                    pdfInfo.textContent = `${fileData.name || 'PDF File'} (PDF)`;
                     imageContainer.appendChild(pdfInfo);
                 }
-            } else {
-                // Single base64 image string (legacy)
+            });
+        } else if (imageData.data && imageData.type) {
+            // Single file object (backward compatibility)
+            if (imageData.type.startsWith('image/')) {
                 const img = document.createElement('img');
-                img.src = `data:image/jpeg;base64,${message.image_data}`;
+                if (imageData.filename) {
+                    img.src = `/uploads/${imageData.filename}`;
+                } else if (imageData.url) {
+                    img.src = imageData.url;
+                } else if (imageData.data) {
+                    img.src = `data:${imageData.type};base64,${imageData.data}`;
+                }
                 img.className = 'message-image';
-                img.alt = 'Uploaded image';
+                img.alt = imageData.name || 'Uploaded image';
+                img.onerror = function () {
+                    if (imageData.data) {
+                        this.src = `data:${imageData.type};base64,${imageData.data}`;
+                    } else {
+                        this.alt = 'Image failed to load';
+                    }
+                };
                 imageContainer.appendChild(img);
+            } else if (imageData.type === 'application/pdf') {
+                const pdfInfo = document.createElement('div');
+                pdfInfo.className = 'file-info-message';
+                pdfInfo.style.cssText = 'padding: 0.5rem; background: rgba(0,0,0,0.05); border-radius: 6px; margin: 0.25rem 0;';
+                pdfInfo.textContent = `${imageData.name || 'PDF File'} (PDF)`;
+                imageContainer.appendChild(pdfInfo);
             }
+        } else {
+            // Single base64 image string (legacy)
+            const img = document.createElement('img');
+            img.src = `data:image/jpeg;base64,${message.image_data}`;
+            img.className = 'message-image';
+            img.alt = 'Uploaded image';
+            imageContainer.appendChild(img);
         }
+    }
 
-        // Add images first
-        if (imageContainer.children.length > 0) {
-            content.appendChild(imageContainer);
-        }
+    // Add images first
+    if (imageContainer.children.length > 0) {
+        content.appendChild(imageContainer);
+    }
 
-        // Then add text content
-        if (message.content) {
-            const textContent = document.createElement('div');
-            // Render markdown content
-            if (typeof marked !== 'undefined') {
-                textContent.innerHTML = marked.parse(message.content);
-            } else {
-                // Fallback to plain text if marked is not loaded
-                textContent.textContent = message.content;
-            }
-            content.appendChild(textContent);
+    // Then add text content
+    if (message.content) {
+        const textContent = document.createElement('div');
+        // Render markdown content
+        if (typeof marked !== 'undefined') {
+            textContent.innerHTML = marked.parse(message.content);
+        } else {
+            // Fallback to plain text if marked is not loaded
+            textContent.textContent = message.content;
         }
+        content.appendChild(textContent);
+    }
 
-        messageDiv.appendChild(content);
-        messagesContainer.appendChild(messageDiv);
-    });
+    messageDiv.appendChild(content);
+    return messageDiv;
 }
 
 async function handleFileUpload(event) {
@@ -434,7 +525,8 @@ async function handleFileUpload(event) {
                 const data = await response.json();
                 placeholder.filename = data.filename;
                 placeholder.url = data.url;
-                placeholder.data = data.base64; // Keep base64 for preview
+                placeholder.thumbnail_url = data.thumbnail_url;
+                placeholder.preview_url = data.preview_url;
                 placeholder.isLoading = false;
             } else {
                 const errorData = await response.json();
@@ -476,7 +568,7 @@ function updateFilePreview() {
 
         if (!file.isLoading && file.type.startsWith('image/') && (file.url || file.data)) {
             const img = document.createElement('img');
-            img.src = file.url || `data:${file.type};base64,${file.data}`;
+            img.src = file.thumbnail_url || file.url || `data:${file.type};base64,${file.data}`;
             img.alt = file.name;
             item.appendChild(img);
         } else if (!file.isLoading && file.type === 'application/pdf') {
@@ -551,7 +643,7 @@ async function sendMessage() {
     if (filesToSend.length > 0) {
         filesToSend.forEach(file => {
             if (file.type.startsWith('image/')) {
-                const src = file.url || `data:${file.type};base64,${file.data}`;
+                const src = file.preview_url || file.url || `data:${file.type};base64,${file.data}`;
                 messageHtml += `<img src="${src}" class="message-image" alt="${file.name}">`;
             } else if (file.type === 'application/pdf') {
                 messageHtml += `<div style="padding: 0.5rem; background: rgba(0,0,0,0.05); border-radius: 6px; margin: 0.25rem 0;">${file.name} (PDF)</div>`;
@@ -601,57 +693,57 @@ async function sendMessage() {
             image_data: filesData || null // Send as array for multiple files
         };
 
-        const response = await fetch(`${API_BASE_URL}/chats/${currentChatId}/messages`, {
+        const response = await fetch(`${API_BASE_URL}/chats/${currentChatId}/messages?stream=true`, {
             method: 'POST',
             headers: {
-                'Content-Type': 'application/json'
+                'Content-Type': 'application/json',
+                'Accept': 'text/event-stream'
             },
             credentials: 'include',
             body: JSON.stringify(requestBody)
         });
 
-        const data = await response.json();
-
-        // Remove loading message
-        document.getElementById('loading-message').remove();
-
         if (response.ok) {
-            // Add assistant response with typing animation
-            await typeMessage(data.assistant_message.content, messagesContainer);
-
-            // Chat title is now updated dynamically on the backend based on first message
-            // Reload chats to update title
-            await loadChats();
-
-            // Update displayed title
-            if (data.assistant_message && currentChatId) {
-                try {
-                    const chatResponse = await fetch(`${API_BASE_URL}/chats/${currentChatId}`, {
-                        credentials: 'include'
-                    });
-                    if (chatResponse.ok) {
-                        const chatData = await chatResponse.json();
-                        document.getElementById('chat-title').textContent = chatData.title;
+            // Render the reply as chunks arrive instead of waiting for the whole answer
+            const loadingContent = document.querySelector('#loading-message .message-content');
+            let replyText = '';
+            let streamError = null;
+            let finalTitle = null;
+
+            await readEventStream(response, (event, data) => {
+                if (event === 'chunk') {
+                    replyText += data.text;
+                    if (typeof marked !== 'undefined') {
+                        loadingContent.innerHTML = marked.parse(replyText);
+                    } else {
+                        loadingContent.textContent = replyText;
                     }
-                } catch (error) {
-                    console.error('Failed to update chat title:', error);
+                    messagesContainer.scrollTop = messagesContainer.scrollHeight;
+                } else if (event === 'done') {
+                    finalTitle = data.title;
+                } else if (event === 'error') {
+                    streamError = data.error;
                 }
+            });
+
+            const loadingMessage = document.getElementById('loading-message');
+            if (streamError) {
+                loadingMessage.remove();
+                showMessageError(streamError, messagesContainer);
+            } else {
+                loadingMessage.removeAttribute('id');
+                if (finalTitle) {
+                    document.getElementById('chat-title').textContent = finalTitle;
+                }
+                // Reload chats to update title
+                await loadChats();
             }
         } else {
-            // Show error message in chat
-            const errorMessageDiv = document.createElement('div');
-            errorMessageDiv.className = 'message assistant';
-            errorMessageDiv.innerHTML = `
-                <div class="message-content" style="color: var(--danger-color);">
-                    Error: ${data.error || 'Failed to send message'}
-                </div>
-            `;
-            messagesContainer.appendChild(errorMessageDiv);
+            const data = await response.json();
 
-            // Also show alert for important errors
-            if (data.error && (data.error.includes('balance') || data.error.includes('key'))) {
-                alert(data.error);
-            }
+            // Remove loading message
+            document.getElementById('loading-message').remove();
+            showMessageError(data.detail || data.error, messagesContainer);
         }
 
         messagesContainer.scrollTop = messagesContainer.scrollHeight;
@@ -662,6 +754,55 @@ async function sendMessage() {
     }
 }
 
+function showMessageError(errorText, messagesContainer) {
+    // Show error message in chat
+    const errorMessageDiv = document.createElement('div');
+    errorMessageDiv.className = 'message assistant';
+    errorMessageDiv.innerHTML = `
+        <div class="message-content" style="color: var(--danger-color);">
+            Error: ${errorText || 'Failed to send message'}
+        </div>
+    `;
+    messagesContainer.appendChild(errorMessageDiv);
+
+    // Also show alert for important errors
+    if (errorText && (errorText.includes('balance') || errorText.includes('key'))) {
+        alert(errorText);
+    }
+}
+
+// Parse a Server-Sent Events response body, calling onEvent(event, data) per message
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            let event = 'message';
+            let data = '';
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('event:')) {
+                    event = line.slice(6).trim();
+                } else if (line.startsWith('data:')) {
+                    data += line.slice(5).trim();
+                }
+            });
+            if (data) {
+                onEvent(event, JSON.parse(data));
+            }
+        }
+    }
+}
+
 // Typing animation function - 5000 words per minute
 async function typeMessage(text, container) {
     const assistantMessageDiv = document.createElement('div');
@@ -721,17 +862,21 @@ function toggleSearch() {
 
 async function searchChats() {
     const query = document.getElementById('search-input').value;
+    if (!query) {
+        await loadChats();
+        return;
+    }
     try {
-        const url = query
-            ? `${API_BASE_URL}/chats?search=${encodeURIComponent(query)}&archived=${showArchived}`
-            : `${API_BASE_URL}/chats?archived=${showArchived}`;
+        const url = `${API_BASE_URL}/chats?search=${encodeURIComponent(query)}&archived=${showArchived}`;
 
         const response = await fetch(url, {
             credentials: 'include'
         });
 
         if (response.ok) {
-            chats = await response.json();
+            const data = await response.json();
+            chats = data.chats;
+            chatsNextCursor = null;
             renderChats();
         }
     } catch (error) {
@@ -766,6 +911,7 @@ async function deleteCurrentChat() {
 
         if (response.ok) {
             currentChatId = null;
+            messagesNextCursor = null;
             document.getElementById('chat-title').textContent = 'New Chat';
             document.getElementById('messages-container').innerHTML = WELCOME_HTML;
             await loadChats();
@@ -793,6 +939,7 @@ async function archiveCurrentChat() {
 
         if (response.ok) {
             currentChatId = null;
+            messagesNextCursor = null;
             document.getElementById('chat-title').textContent = 'New Chat';
             document.getElementById('messages-container').innerHTML = WELCOME_HTML;
             await loadChats();